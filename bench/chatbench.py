@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+Load generator and benchmark for chatserverd.
+
+Starts a server (or attaches to a running one with --attach), connects
+--clients line framed clients, lets --senders of them send --rate messages
+per second in total for --duration seconds and reports:
+
+  * delivered messages/sec and fan-out bytes/sec seen by the clients
+  * p50/p99/p999 end to end latency (send to receive, same host clock)
+  * server CPU seconds per delivered message (utime+stime from /proc)
+  * server RSS growth per connection (VmRSS from /proc)
+
+Results are printed as JSON so runs against different pollers, framings
+or --workers settings can be compared, e.g.
+
+  python bench/chatbench.py --clients=1000 --rate=2000 -- --poller=select
+  python bench/chatbench.py --clients=1000 --rate=2000 -- --poller=epoll
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHATSERVERD = os.path.join(os.path.dirname(HERE), 'chatserverd.py')
+PIDFILE = '/tmp/chatserver.pid'
+MARKER = b'bench '
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='load generator and benchmark for chatserverd',
+        epilog='arguments after -- are passed to chatserverd.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--clients', type=int, default=100,
+                        help='connected clients (default: %(default)s)')
+    parser.add_argument('--senders', type=int, default=10,
+                        help='clients which also send (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='messages/sec over all senders (default: %(default)s)')
+    parser.add_argument('--size', type=int, default=64,
+                        help='message size in bytes (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='measured seconds (default: %(default)s)')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='unmeasured seconds before the run (default: %(default)s)')
+    parser.add_argument('--attach', action='store_true',
+                        help='benchmark the server in %s instead of starting one' % PIDFILE)
+    parser.add_argument('--output', help='also write the JSON results here')
+    args, server_args = parser.parse_known_args(argv)
+    if server_args and server_args[0] == '--':
+        server_args = server_args[1:]
+    args.server_args = server_args
+    args.senders = max(1, min(args.senders, args.clients))
+    return args
+
+def raise_nofile(wanted):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError):
+            pass
+
+def read_pidfile():
+    try:
+        with open(PIDFILE) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+def server_pids(pid):
+    # the master and, with --workers, its forked workers
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+def cpu_seconds(pids):
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        # utime and stime are fields 14 and 15, counted from the pid
+        total += int(fields[11]) + int(fields[12])
+    return float(total) / ticks
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%s/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            continue
+    return total
+
+def start_server(args):
+    if read_pidfile() is not None:
+        sys.exit('%s exists, is a server already running? use --attach' % PIDFILE)
+    command = [sys.executable, CHATSERVERD, '--port=%d' % args.port,
+               '--framing=line'] + args.server_args
+    if subprocess.call(command) != 0:
+        sys.exit('could not start %s' % ' '.join(command))
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        pid = read_pidfile()
+        if pid is not None and can_connect(args.host, args.port):
+            return pid
+        time.sleep(0.1)
+    sys.exit('server did not come up on port %d' % args.port)
+
+def stop_server(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + 10
+    while time.time() < deadline and os.path.exists('/proc/%d' % pid):
+        time.sleep(0.1)
+
+def can_connect(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.connect((host, port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def percentile_ms(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return round(ordered[index] * 1000, 3)
+
+class Client:
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.inbuf = b''
+        self.outbuf = b''
+        self.sent = 0
+
+    def send(self, data):
+        # keep whatever the kernel did not take; the poll loop flushes it
+        self.outbuf += data
+        self.flush()
+
+    def flush(self):
+        while self.outbuf:
+            try:
+                n = self.sock.send(self.outbuf)
+            except socket.error as why:
+                if why.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.outbuf = self.outbuf[n:]
+
+    def read_lines(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error as why:
+            if why.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return [], 0
+            raise
+        if not data:
+            raise EOFError
+        lines = (self.inbuf + data).split(b'\n')
+        self.inbuf = lines.pop()
+        return lines, len(data)
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.clients = {}
+        self.senders = []
+        self.poll = select.poll()
+        self.latencies = []
+        self.received = 0
+        self.received_bytes = 0
+        self.sent = 0
+        self.measuring = False
+
+    def connect(self):
+        for i in range(self.args.clients):
+            client = Client(self.args.host, self.args.port)
+            self.clients[client.fd] = client
+            self.poll.register(client.fd, select.POLLIN)
+        self.senders = list(self.clients.values())[:self.args.senders]
+
+    def payload(self, client):
+        header = MARKER + ('%d %d %.9f ' % (client.fd, client.sent, time.time())).encode('ascii')
+        client.sent += 1
+        return header + b'x' * max(0, self.args.size - len(header) - 1) + b'\n'
+
+    def run(self, seconds, measure):
+        self.measuring = measure
+        interval = 1.0 / self.args.rate
+        start = time.time()
+        end = start + seconds
+        next_send = start
+        turn = 0
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            while next_send <= now and next_send < end:
+                sender = self.senders[turn % len(self.senders)]
+                sender.send(self.payload(sender))
+                if sender.outbuf:
+                    self.poll.modify(sender.fd, select.POLLIN | select.POLLOUT)
+                turn += 1
+                next_send += interval
+                if measure:
+                    self.sent += 1
+            timeout = max(0, min(next_send, end) - time.time())
+            for fd, event in self.poll.poll(timeout * 1000):
+                self.handle_event(self.clients[fd], event)
+
+    def drain(self, seconds):
+        # let in-flight messages arrive so they are not counted as lost
+        end = time.time() + seconds
+        while time.time() < end:
+            events = self.poll.poll(100)
+            if not events:
+                break
+            for fd, event in events:
+                self.handle_event(self.clients[fd], event)
+
+    def handle_event(self, client, event):
+        if event & select.POLLOUT:
+            client.flush()
+            if not client.outbuf:
+                self.poll.modify(client.fd, select.POLLIN)
+        if event & (select.POLLIN | select.POLLERR | select.POLLHUP):
+            try:
+                lines, nbytes = client.read_lines()
+            except (EOFError, socket.error):
+                sys.exit('server closed client %d' % client.fd)
+            if not self.measuring:
+                return
+            now = time.time()
+            self.received_bytes += nbytes
+            for line in lines:
+                index = line.find(MARKER)
+                if index < 0:
+                    continue
+                fields = line[index + len(MARKER):].split(b' ', 3)
+                self.received += 1
+                self.latencies.append(now - float(fields[2]))
+
+    def report(self, duration, cpu, rss_idle, rss_connected):
+        self.latencies.sort()
+        expected = self.sent * (self.args.clients - 1)
+        return {
+            'clients': self.args.clients,
+            'senders': self.args.senders,
+            'rate': self.args.rate,
+            'size': self.args.size,
+            'duration': round(duration, 3),
+            'server_args': self.args.server_args,
+            'sent': self.sent,
+            'delivered': self.received,
+            'delivery_ratio': expected and round(float(self.received) / expected, 4),
+            'msgs_per_sec': round(self.received / duration, 1),
+            'bytes_per_sec': round(self.received_bytes / duration, 1),
+            'latency_ms_p50': percentile_ms(self.latencies, 0.50),
+            'latency_ms_p99': percentile_ms(self.latencies, 0.99),
+            'latency_ms_p999': percentile_ms(self.latencies, 0.999),
+            'cpu_us_per_msg': self.received and round(cpu / self.received * 1e6, 3),
+            'rss_bytes_per_conn': round(float(rss_connected - rss_idle) / self.args.clients, 1),
+        }
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    raise_nofile(args.clients + 64)
+    if args.attach:
+        pid = read_pidfile()
+        if pid is None:
+            sys.exit('no server pid in %s' % PIDFILE)
+    else:
+        pid = start_server(args)
+    try:
+        pids = server_pids(pid)
+        rss_idle = rss_bytes(pids)
+        bench = Bench(args)
+        bench.connect()
+        bench.run(args.warmup, False)
+        bench.drain(1.0)
+        pids = server_pids(pid)
+        rss_connected = rss_bytes(pids)
+        cpu = cpu_seconds(pids)
+        start = time.time()
+        bench.run(args.duration, True)
+        bench.drain(5.0)
+        duration = time.time() - start
+        cpu = cpu_seconds(pids) - cpu
+    finally:
+        if not args.attach:
+            stop_server(pid)
+    result = bench.report(duration, cpu, rss_idle, rss_connected)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
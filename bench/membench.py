@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Memory per connection of chatserverd's channels.
+
+Makes --connections chat channels over socketpairs in this process, the
+way chat_server.handle_accept makes them, and reports what they cost:
+
+  * Python heap bytes per connection (tracemalloc, Python 3 only)
+  * RSS bytes per connection (VmRSS from /proc)
+  * the allocations which make up most of it, with --top
+
+Nothing is sent, so the channels are measured as an idle connection in
+the lobby is kept.  chatbench.py's rss_bytes_per_conn measures a running
+server under load instead.
+
+  python bench/membench.py --connections=10000
+  python bench/membench.py --connections=10000 --framing=length
+"""
+
+import os
+import sys
+import gc
+import json
+import socket
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from chatbench import raise_nofile, rss_bytes
+
+from chatserver.logger import Logger
+from chatserver.timers import TimerWheel
+from chatserver.medusa import asyncore_25 as asyncore
+from chatserver.chat_server import af_inet_server
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='memory per connection of chatserverd channels')
+    parser.add_argument('--connections', type=int, default=10000,
+                        help='channels to make (default: %(default)s)')
+    parser.add_argument('--framing', default='line',
+                        choices=('raw', 'line', 'length'))
+    parser.add_argument('--binary', action='store_true')
+    parser.add_argument('--idle-timeout', type=float, default=0,
+                        help='give every channel an idle timer')
+    parser.add_argument('--top', type=int, default=0,
+                        help='also list the N biggest allocation sites')
+    parser.add_argument('--output', help='also write the JSON results here')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    raise_nofile(2 * args.connections + 64)
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except ImportError:
+        limit = resource = None
+    if resource is not None and limit != resource.RLIM_INFINITY:
+        # both ends of every socketpair are open here
+        if 2 * args.connections + 64 > limit:
+            args.connections = (limit - 64) // 2
+            sys.stderr.write('only %d connections fit in the file descriptor limit\n'
+                             % args.connections)
+    logfile = tempfile.NamedTemporaryFile(suffix='.log', delete=False)
+    logger = Logger(logfile.name)
+    timers = TimerWheel(logger=logger)
+    binary = args.binary or args.framing == 'length'
+    server = af_inet_server('127.0.0.1', 0, logger, binary=binary,
+                            framing=args.framing, timers=timers,
+                            idle_timeout=args.idle_timeout)
+    peers = []
+    channels = []
+    pid = os.getpid()
+
+    gc.collect()
+    rss_before = rss_bytes([pid])
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    for i in range(args.connections):
+        ours, theirs = socket.socketpair()
+        peers.append(theirs)
+        channels.append(server.new_channel(ours, ('127.0.0.1', 1024 + i % 60000)))
+        # the greetings would be fanned out by the event loop
+        asyncore.data_queue.drain()
+    gc.collect()
+    rss_after = rss_bytes([pid])
+    result = {
+        'connections': args.connections,
+        'framing': args.framing,
+        'binary': binary,
+        'python': sys.version.split()[0],
+        'rss_bytes_per_conn': round(float(rss_after - rss_before) / args.connections, 1),
+    }
+    if tracemalloc is not None:
+        after = tracemalloc.take_snapshot()
+        stats = after.compare_to(before, 'lineno')
+        total = sum(stat.size_diff for stat in stats)
+        result['heap_bytes_per_conn'] = round(float(total) / args.connections, 1)
+        if args.top:
+            result['top'] = [
+                {'where': '%s:%d' % (stat.traceback[0].filename.replace(os.path.dirname(HERE) + os.sep, ''),
+                                     stat.traceback[0].lineno),
+                 'bytes_per_conn': round(float(stat.size_diff) / args.connections, 1)}
+                for stat in stats[:args.top]]
+        tracemalloc.stop()
+
+    for channel in channels:
+        channel.close()
+    for peer in peers:
+        peer.close()
+    server.close()
+    logger.close()
+    os.unlink(logfile.name)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
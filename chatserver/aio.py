@@ -0,0 +1,748 @@
+"""
+asyncio engine for chatserverd, selected with --engine=asyncio or
+--engine=uvloop.
+
+The chat semantics are those of chat_server.chat_session; this module
+only replaces the medusa dispatcher/async_chat layer with asyncio
+Protocols and Transports, so writes go through the transport's buffer
+and a fan-out batch reaches every recipient with one writelines().
+Payloads are bytes end to end, as with --binary.
+
+Python 3 only; the medusa engine stays the default.
+"""
+
+import sys
+import time
+import socket
+import asyncio
+import collections
+
+from chatserver.compat import as_bytes, as_string
+from chatserver.broadcast import Broadcaster
+from chatserver.rooms import RoomRegistry
+from chatserver.nicks import NickRegistry, delivered
+from chatserver.history import History
+from chatserver.message_queue import MessageQueue
+from chatserver.backlog import OutputBacklog
+from chatserver.relay import HEADER, ROOM_HEADER
+from chatserver.metrics import MAX_REQUEST
+from chatserver.ratelimit import TokenBucket, RateTable
+from chatserver.chat_server import chat_session, chat_server, FRAME_HEADER
+from chatserver.chat_server import set_socket_options
+
+ENGINES = ('asyncore', 'asyncio', 'uvloop')
+
+
+def new_event_loop(engine):
+    if engine == 'uvloop':
+        import uvloop
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+# ===========================================================================
+#                            Chat Channel Protocol
+# ===========================================================================
+
+class aio_chat_channel(asyncio.Protocol, chat_session):
+
+    # as chat_channel, no __dict__ and lists only once they are used
+    __slots__ = ('server', 'logger', 'framing', 'transport', '_fileno',
+                 'addr', 'prefix', 'creation_time', 'rooms', 'room', 'nick',
+                 'in_buffer', 'frame_size', 'pending', 'held', 'held_bytes',
+                 'writing_paused', 'buffered', 'evicted', 'dropped_messages',
+                 'rejected', 'limited', 'idle_timer', 'keepalive_timer')
+
+    ac_in_empty = b''
+    command_char = b'/'
+
+    # longest message accepted in line and length framing
+    max_frame_size = 1<<20
+
+    def __init__(self, server):
+        self.server = server
+        self.logger = server.logger
+        self.framing = server.framing
+        self.transport = None
+        self._fileno = None
+        self.rooms = ()
+        self.room = None
+        self.nick = None
+        # data read but not yet framed into a message
+        self.in_buffer = b''
+        self.frame_size = None
+        # output of the current fan-out batch, handed to the transport
+        # in one writelines() by flush()
+        self.pending = ()
+        # messages held back while the transport is over its high
+        # watermark, for drop-oldest
+        self.held = ()
+        self.held_bytes = 0
+        self.idle_timer = None
+        self.keepalive_timer = None
+        self.writing_paused = False
+        self.buffered = 0       # transport buffer size last accounted
+        self.evicted = False
+        self.dropped_messages = 0
+        # closed at once by the accept rate limit
+        self.rejected = False
+        # set while over a rate limit, see chat_session.spend_token()
+        self.limited = False
+
+    def __repr__(self):
+        return '<aio_chat_channel %s at %#x>' % (self.prefix.strip(), id(self))
+
+    # --------------------------------------------------
+    # asyncio.Protocol methods
+    # --------------------------------------------------
+
+    def connection_made(self, transport):
+        server = self.server
+        self.transport = transport
+        limiter = server.accept_limiter
+        if limiter is not None and not limiter.take():
+            # the loop accepts on its own, so a connection over the
+            # rate is turned away instead of left in the kernel's queue
+            self.rejected = True
+            server.metrics.throttled += 1
+            transport.abort()
+            return
+        self._fileno = transport.get_extra_info('socket').fileno()
+        self.addr = transport.get_extra_info('peername')
+        self.prefix = as_bytes('[%s:%d]: ' % self.addr[:2])
+        self.creation_time = int(time.time())
+        server.metrics.accepted += 1
+        # pause_writing() past the high watermark, resume_writing()
+        # once the transport is back down to the low one
+        transport.set_write_buffer_limits(high=server.high_watermark,
+                                          low=server.low_watermark)
+        server.channels[self._fileno] = self
+        server.broadcaster.register(self._fileno, self)
+        self.start_timers()
+        if server.out_backlog.full():
+            transport.pause_reading()
+        if server.broadcaster.history is not None:
+            self.replay(server.broadcaster)
+        self.add_data(self.frame(b"I'm online now!!!\n"))
+
+    def connection_lost(self, exc):
+        if self.rejected:
+            return
+        server = self.server
+        server.metrics.closed += 1
+        server.channels.pop(self._fileno, None)
+        server.broadcaster.unregister(self._fileno)
+        for room in self.rooms:
+            server.rooms.part(room, self._fileno)
+        self.rooms = ()
+        self.room = None
+        self.drop_nick()
+        self.stop_timers()
+        self.forget_limits()
+        server.out_backlog.remove(self.buffered + self.held_bytes)
+        server.congested.discard(self)
+        self.buffered = 0
+        self.held = ()
+        self.held_bytes = 0
+        self.pending = ()
+
+    def data_received(self, data):
+        if self.idle_timer is not None:
+            self.idle_timer.reset(self.server.idle_timeout)
+        self.server.metrics.bytes_in += len(data)
+        if self.framing == 'raw':
+            self.handle_message(data)
+        elif self.framing == 'line':
+            self.scan_lines(data)
+        else:
+            self.scan_frames(data)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def pause_reading(self):
+        self.transport.pause_reading()
+
+    def resume_reading(self):
+        if self.transport.is_closing():
+            return
+        # the rest of the data which went over the limit
+        if self.in_buffer:
+            if self.framing == 'line':
+                self.scan_lines(b'')
+            else:
+                self.scan_frames(b'')
+        # unless the backlog has all clients paused
+        if not self.server.reads_paused and not self.limited:
+            self.transport.resume_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.dropped_messages:
+            self.logger.info('resuming messages for %r, %d dropped',
+                             self, self.dropped_messages)
+        if self.held:
+            self.server.out_backlog.remove(self.held_bytes)
+            self.server.metrics.bytes_out += self.held_bytes
+            self.transport.writelines(self.held)
+            self.held = ()
+            self.held_bytes = 0
+        self.account()
+
+    # --------------------------------------------------
+    # input framing
+    # --------------------------------------------------
+
+    def scan_lines(self, data):
+        buf = self.in_buffer + data
+        start = 0
+        while True:
+            index = buf.find(b'\n', start)
+            if index < 0:
+                break
+            self.handle_message(buf[start:index], b'\n')
+            start = index + 1
+            if self.transport.is_closing():
+                return
+            if self.limited:
+                break
+        self.in_buffer = buf[start:]
+        if len(self.in_buffer) > self.max_frame_size:
+            # a line which never ends
+            self.logger.warn('closing channel %r: more than %d bytes without a terminator',
+                             self, self.max_frame_size)
+            self.close()
+
+    def scan_frames(self, data):
+        buf = self.in_buffer + data
+        start = 0
+        while True:
+            if self.frame_size is None:
+                if len(buf) - start < FRAME_HEADER.size:
+                    break
+                size = FRAME_HEADER.unpack_from(buf, start)[0]
+                start += FRAME_HEADER.size
+                if size > self.max_frame_size:
+                    self.logger.warn('closing channel %r: frame of %d bytes is too big',
+                                     self, size)
+                    self.close()
+                    return
+                if not size:
+                    continue
+                self.frame_size = size
+            if len(buf) - start < self.frame_size:
+                break
+            end = start + self.frame_size
+            self.frame_size = None
+            self.handle_message(buf[start:end])
+            start = end
+            if self.transport.is_closing():
+                return
+            if self.limited:
+                break
+        self.in_buffer = buf[start:]
+
+    # --------------------------------------------------
+    # output
+    # --------------------------------------------------
+
+    def add_data(self, data, target=None):
+        self.server.add_data(self._fileno, data, target)
+
+    def push_data(self, data):
+        if self.evicted or self.transport.is_closing():
+            return
+        if self.writing_paused:
+            self.handle_overflow(data)
+            return
+        if self.pending:
+            self.pending.append(data)
+        else:
+            self.server.flushing.append(self)
+            self.server.schedule()
+            self.pending = [data]
+
+    def handle_overflow(self, data):
+        # the client is not keeping up with what is sent to it
+        server = self.server
+        backlog = server.out_backlog
+        if server.overflow == 'disconnect':
+            self.logger.warn('evicting slow consumer %r with %d bytes buffered',
+                             self, self.transport.get_write_buffer_size())
+            self.evicted = True
+            backlog.dropped(len(data))
+            backlog.evict(self)
+        elif server.overflow == 'drop-newest':
+            if not self.dropped_messages:
+                self.logger.info('dropping new messages for %r', self)
+            self.dropped_messages += 1
+            backlog.dropped(len(data))
+        else:
+            # what the transport holds cannot be taken back, so the
+            # oldest of the messages held back since are dropped
+            if not self.held:
+                self.held = collections.deque()
+            self.held.append(data)
+            self.held_bytes += len(data)
+            backlog.add(len(data))
+            limit = server.low_watermark
+            while len(self.held) > 1 and self.held_bytes > limit:
+                nbytes = len(self.held.popleft())
+                self.held_bytes -= nbytes
+                self.dropped_messages += 1
+                backlog.dropped(nbytes)
+                backlog.remove(nbytes)
+
+    def flush(self):
+        pending = self.pending
+        self.pending = ()
+        if pending and not self.transport.is_closing():
+            # counted once handed to the transport, which does not say
+            # when it has sent them
+            self.server.metrics.bytes_out += sum(map(len, pending))
+            self.transport.writelines(pending)
+            if self.keepalive_timer is not None:
+                self.keepalive_timer.reset(self.server.keepalive)
+            self.account()
+
+    def account(self):
+        # the transport does not say when it has sent something, so the
+        # backlog is brought up to date here and from the server's tick
+        size = self.transport.get_write_buffer_size()
+        self.server.out_backlog.add(size - self.buffered)
+        self.buffered = size
+        if size:
+            self.server.congested.add(self)
+        else:
+            self.server.congested.discard(self)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def abort(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+
+# ===========================================================================
+#                            Relay Protocol
+# ===========================================================================
+
+class aio_relay(asyncio.Protocol):
+    '''
+    The worker's end of the socketpair to ChatServerMaster, or one end of
+    the bridge between two chatserverds during a reload; speaks the same
+    length-prefixed format as relay.relay_channel.
+    '''
+
+    def __init__(self, on_message, on_close):
+        self.on_message = on_message
+        self.on_close = on_close
+        self.transport = None
+        self.in_buffer = b''
+        # what was forwarded before the connection was made
+        self.pending = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        pending, self.pending = self.pending, []
+        if pending:
+            transport.writelines(pending)
+
+    def connection_lost(self, exc):
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close(self)
+
+    def data_received(self, data):
+        buf = self.in_buffer + data
+        start = 0
+        while len(buf) - start >= HEADER.size:
+            size = HEADER.unpack_from(buf, start)[0]
+            end = start + HEADER.size + size
+            if len(buf) < end:
+                break
+            body = start + HEADER.size
+            name_end = body + ROOM_HEADER.size + ROOM_HEADER.unpack_from(buf, body)[0]
+            room = as_string(buf[body + ROOM_HEADER.size:name_end]) or None
+            self.on_message(self, room, buf[name_end:end])
+            start = end
+        self.in_buffer = buf[start:]
+
+    def forward(self, messages):
+        chunks = []
+        for room, message in messages:
+            data = as_bytes(message)
+            name = as_bytes(room or '')
+            size = ROOM_HEADER.size + len(name) + len(data)
+            chunks.append(HEADER.pack(size) + ROOM_HEADER.pack(len(name)) + name)
+            chunks.append(data)
+        if self.transport is None:
+            self.pending.extend(chunks)
+        elif chunks and not self.transport.is_closing():
+            self.transport.writelines(chunks)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+# ===========================================================================
+#                            Metrics Protocol
+# ===========================================================================
+
+class aio_metrics_channel(asyncio.Protocol):
+    '''One scrape of the admin port, as metrics.metrics_channel.'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.transport = None
+        self.in_buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.transport.is_closing():
+            return
+        buf = self.in_buffer + data
+        index = buf.find(b'\r\n\r\n')
+        if index >= 0:
+            self.transport.write(self.metrics.respond(buf[:index]))
+            self.transport.close()
+        elif len(buf) > MAX_REQUEST:
+            self.transport.close()
+        else:
+            self.in_buffer = buf
+
+
+# ===========================================================================
+#                            Chat Server
+# ===========================================================================
+
+class aio_chat_server:
+    '''
+    The listening socket and everything the channels of one port share:
+    lobby, rooms, ingress queue and output backlog.  The socket is bound
+    when the server is made, before daemonizing, and served once the
+    event loop runs.
+    '''
+
+    binary = True
+    high_watermark = chat_server.high_watermark
+    low_watermark = chat_server.low_watermark
+    overflow = chat_server.overflow
+    idle_timeout = chat_server.idle_timeout
+    keepalive = chat_server.keepalive
+    history_size = chat_server.history_size
+    journal = None
+    metrics = chat_server.metrics
+    listen_backlog = chat_server.listen_backlog
+    accept_batch = chat_server.accept_batch
+    accept_rate = 0
+    message_rate = 0
+    ip_rate = 0
+    tcp_nodelay = False
+    sndbuf = 0
+    rcvbuf = 0
+    # only the asyncore engine links up with other nodes
+    cluster = None
+
+    def __init__(self, ip, port, logger_object, framing='raw',
+                 reuse_port=False, timers=None, sock=None, **limits):
+        self.ip = ip
+        self.port = port
+        self.logger = logger_object
+        self.framing = framing
+        self.timers = timers
+        for name, value in limits.items():
+            setattr(self, name, value)
+        if sock is not None:
+            # inherited from the chatserverd we are reloading
+            self.socket = sock
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            set_socket_options(self.socket, self.tcp_nodelay, self.sndbuf, self.rcvbuf)
+            self.socket.bind((ip, port))
+        self.socket.listen(self.listen_backlog)
+        self.socket.setblocking(False)
+        self.accept_limiter = None
+        if self.accept_rate:
+            self.accept_limiter = TokenBucket(self.accept_rate)
+        self.conn_limits = self.ip_limits = None
+        if self.message_rate:
+            self.conn_limits = RateTable(self.message_rate, timers=timers)
+        if self.ip_rate:
+            self.ip_limits = RateTable(self.ip_rate, timers=timers)
+        self.broadcaster = Broadcaster()
+        if self.history_size:
+            self.broadcaster.history = History(self.history_size)
+        self.rooms = RoomRegistry(self.history_size)
+        self.nicks = NickRegistry()
+        self.channels = {}
+        self.data_queue = MessageQueue()
+        if self.journal is not None:
+            # message numbers carry on from the journal
+            self.data_queue.seq = self.journal.last_seq
+        self.out_backlog = OutputBacklog()
+        self.flushing = []
+        self.congested = set()
+        self.reads_paused = False
+        self.relay = None
+        self.bridge = None
+        self.loop = None
+        self.aserver = None
+        self.drain_scheduled = False
+
+    def start(self, loop):
+        self.loop = loop
+        self.aserver = loop.run_until_complete(
+            # asyncio listen()s again with backlog, and takes up to
+            # that many connections per wake-up
+            loop.create_server(lambda: aio_chat_channel(self), sock=self.socket,
+                               backlog=self.listen_backlog))
+        self.logger.log('Chat Server started on port %d with %s' %
+                        (self.port, type(loop).__module__))
+
+    def stop_accepting(self):
+        # a reload leaves new connections to the new chatserverd
+        if self.aserver is not None:
+            self.aserver.close()
+        else:
+            self.socket.close()
+
+    def close(self):
+        if self.aserver is not None:
+            self.aserver.close()
+            for channel in list(self.channels.values()):
+                channel.abort()
+        else:
+            self.socket.close()
+        if self.relay is not None:
+            self.relay.close()
+        if self.bridge is not None:
+            self.bridge.close()
+
+    def add_data(self, key, data, target=None):
+        # everything read in one pass of the loop is fanned out together
+        self.data_queue.put(key, data, target)
+        self.schedule()
+
+    def schedule(self):
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.loop.call_soon(self.broadcast_messages)
+
+    def broadcast_messages(self):
+        messages = self.data_queue.drain()
+        journal = self.journal
+        if journal is not None:
+            for seq, key, message, target in messages:
+                if target is None or not target.private:
+                    journal.append(seq, getattr(target, 'name', None), message)
+            journal.commit()
+        deliveries = 0
+        for seq, key, message, target in messages:
+            if target is None:
+                deliveries += self.broadcaster.fanout(key, message, seq)
+            else:
+                deliveries += target.fanout(key, message, seq)
+        self.metrics.messages += len(messages)
+        self.metrics.deliveries += deliveries
+
+        flushing = self.flushing
+        self.flushing = []
+        for channel in flushing:
+            channel.flush()
+
+        relay = self.relay
+        if relay is not None:
+            relay.forward([(getattr(target, 'name', None), message)
+                           for seq, key, message, target in messages
+                           if key is not relay and not delivered(target)])
+
+        bridge = self.bridge
+        if bridge is not None:
+            bridge.forward([(getattr(target, 'name', None), message)
+                            for seq, key, message, target in messages
+                            if key is not bridge and not delivered(target)])
+
+        for channel in self.out_backlog.take_evictions():
+            channel.abort()
+        self.check_backlog()
+        # the fan-out above does not need another turn
+        self.drain_scheduled = False
+
+    def relay_received(self, relay, room, message):
+        target = None
+        if room is not None:
+            if room.startswith('#'):
+                target = self.rooms.get(room)
+            else:
+                target = self.nicks.get(room)
+            if target is None:
+                return
+        self.add_data(relay, message, target)
+
+    def tick(self):
+        # bring the backlog of channels with unsent output up to date
+        for channel in list(self.congested):
+            channel.account()
+        self.check_backlog()
+        if self.journal is not None:
+            # fsyncs which are due although nothing new was written
+            self.journal.commit()
+
+    def check_backlog(self):
+        backlog = self.out_backlog
+        if backlog.full() == self.reads_paused:
+            return
+        self.reads_paused = backlog.full()
+        if self.reads_paused:
+            self.logger.warn('%d bytes waiting to be sent, not reading from clients',
+                             backlog.nbytes)
+        else:
+            self.logger.info('backlog down to %d bytes, reading from clients again',
+                             backlog.nbytes)
+        for channel in self.channels.values():
+            if self.reads_paused:
+                channel.transport.pause_reading()
+            elif not channel.limited:
+                channel.transport.resume_reading()
+
+
+def make_server(helpers):
+    config = helpers.server_config
+    server = aio_chat_server(config['host'], config['port'], helpers.logger,
+                             framing=config['framing'],
+                             reuse_port=config['reuse_port'],
+                             timers=helpers.timers,
+                             high_watermark=config['high_watermark'],
+                             low_watermark=config['low_watermark'],
+                             overflow=config['overflow'],
+                             idle_timeout=config['idle_timeout'],
+                             keepalive=config['keepalive'],
+                             history_size=config['history'],
+                             journal=helpers.journal,
+                             metrics=helpers.metrics,
+                             listen_backlog=config['listen_backlog'],
+                             accept_batch=config['accept_batch'],
+                             accept_rate=config['max_accept_rate'],
+                             message_rate=config['max_message_rate'],
+                             ip_rate=config['max_ip_rate'],
+                             tcp_nodelay=config['tcp_nodelay'],
+                             sndbuf=config['sndbuf'],
+                             rcvbuf=config['rcvbuf'],
+                             sock=helpers.inherited_listener(True))
+    server.out_backlog.max_bytes = config['max_backlog']
+    server.out_backlog.low_bytes = config['max_backlog'] // 2
+    helpers.metrics.backlog = server.out_backlog
+    helpers.metrics.queue = server.data_queue
+    sys.stdout.write("Chat Server is listening on port %d\n" % config['port'])
+    return [(config, server)]
+
+
+# ===========================================================================
+#                            Event loop
+# ===========================================================================
+
+class aio_engine:
+    '''
+    Runs the servers made by make_server() on an asyncio event loop, in
+    place of ChatServer's medusa loop.  Signals are still received by
+    Helpers and looked at from a periodic tick, as in runforever.
+    '''
+
+    # longest time between ticks
+    timeout = 1
+    # tick interval while some channel has unsent output
+    congested_interval = 0.1
+
+    def __init__(self, helpers, engine):
+        self.helpers = helpers
+        self.engine = engine
+        self.loop = None
+        self.relay_sock = None
+        self.relay_closed = None
+        self.bridge_sock = None
+        self.bridge = None
+        self.running = None
+        self.admin = None
+
+    def open_relay(self, sock, on_close):
+        # connected once the loop exists, in runforever()
+        self.relay_sock = sock
+        self.relay_closed = on_close
+
+    def open_bridge(self, sock, on_close):
+        # connected once the loop exists, or right away while it runs
+        server = self.helpers.chatserver[0][1]
+        self.bridge = aio_relay(server.relay_received, on_close)
+        self.bridge_sock = sock
+        if self.loop is not None:
+            self.connect_bridge()
+        return self.bridge
+
+    def connect_bridge(self):
+        bridge = self.bridge
+        sock, self.bridge_sock = self.bridge_sock, None
+        self.loop.create_task(
+            self.loop.create_unix_connection(lambda: bridge, sock=sock))
+
+    def runforever(self, chatserverd):
+        helpers = self.helpers
+        # the mood runforever() is entered with; anything lower stops it
+        self.running = helpers.mood
+        loop = self.loop = new_event_loop(self.engine)
+        asyncio.set_event_loop(loop)
+        servers = [server for config, server in helpers.chatserver]
+        try:
+            for server in servers:
+                server.start(loop)
+            if self.relay_sock is not None:
+                server = servers[0]
+                transport, relay = loop.run_until_complete(
+                    loop.create_unix_connection(
+                        lambda: aio_relay(server.relay_received, self.relay_closed),
+                        sock=self.relay_sock))
+                server.relay = relay
+            if self.bridge_sock is not None:
+                self.connect_bridge()
+            if helpers.admin is not None:
+                self.admin = loop.run_until_complete(
+                    loop.create_server(lambda: aio_metrics_channel(helpers.metrics),
+                                       sock=helpers.admin))
+            loop.call_soon(self.tick, chatserverd, servers)
+            loop.run_forever()
+        finally:
+            for server in servers:
+                server.close()
+            self.close_admin()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    def close_admin(self):
+        if self.admin is not None:
+            self.admin.close()
+            self.admin = None
+
+    def tick(self, chatserverd, servers):
+        helpers = self.helpers
+        timers = helpers.timers
+        timers.run()
+        interval = timers.next_timeout()
+        if interval is None or interval > self.timeout:
+            interval = self.timeout
+        for server in servers:
+            server.tick()
+            if server.congested:
+                interval = min(interval, self.congested_interval)
+        chatserverd.handle_signal()
+        if helpers.mood < self.running:
+            self.loop.stop()
+            return
+        self.loop.call_later(interval, self.tick, chatserverd, servers)
@@ -0,0 +1,98 @@
+import threading
+
+OVERFLOW_STRATEGIES = ('drop-oldest', 'drop-newest', 'disconnect')
+
+class OutputBacklog:
+    '''
+    Accounts for the bytes queued on all chat channels and not yet sent.
+
+    Once the total reaches max_bytes the channels stop reading, so the
+    senders are held back in their kernel socket buffers, until the total
+    falls to low_bytes again.  Slow consumers which went over their own
+    high watermark and are to be disconnected are collected in evictions
+    and closed after the current fan-out.
+    '''
+
+    def __init__(self, max_bytes=1<<28, low_bytes=None):
+        self.max_bytes = max_bytes
+        if low_bytes is None:
+            low_bytes = max_bytes // 2
+        self.low_bytes = low_bytes
+        self.nbytes = 0
+        self.peak_bytes = 0
+        self.paused = False
+        self.evictions = []
+        # totals since start
+        self.pauses = 0
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.evicted = 0
+
+    def add(self, nbytes):
+        self.nbytes += nbytes
+        if self.nbytes > self.peak_bytes:
+            self.peak_bytes = self.nbytes
+        if not self.paused and self.max_bytes and self.nbytes >= self.max_bytes:
+            self.paused = True
+            self.pauses += 1
+
+    def remove(self, nbytes):
+        self.nbytes -= nbytes
+        if self.paused and self.nbytes <= self.low_bytes:
+            self.paused = False
+
+    def full(self):
+        return self.paused
+
+    def dropped(self, nbytes):
+        self.dropped_messages += 1
+        self.dropped_bytes += nbytes
+
+    def evict(self, channel):
+        self.evicted += 1
+        self.evictions.append(channel)
+
+    def take_evictions(self):
+        evictions = self.evictions
+        self.evictions = []
+        return evictions
+
+    def stats(self):
+        return {
+            'buffered_bytes': self.nbytes,
+            'peak_buffered_bytes': self.peak_bytes,
+            'read_pauses': self.pauses,
+            'dropped_messages': self.dropped_messages,
+            'dropped_bytes': self.dropped_bytes,
+            'evicted': self.evicted,
+        }
+
+class LockedOutputBacklog(OutputBacklog):
+    '''
+    An OutputBacklog which the fan-out threads add to and take from
+    alongside the loop thread.
+    '''
+
+    def __init__(self, max_bytes=1<<28, low_bytes=None):
+        OutputBacklog.__init__(self, max_bytes, low_bytes)
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            OutputBacklog.add(self, nbytes)
+
+    def remove(self, nbytes):
+        with self.lock:
+            OutputBacklog.remove(self, nbytes)
+
+    def dropped(self, nbytes):
+        with self.lock:
+            OutputBacklog.dropped(self, nbytes)
+
+    def evict(self, channel):
+        with self.lock:
+            OutputBacklog.evict(self, channel)
+
+    def take_evictions(self):
+        with self.lock:
+            return OutputBacklog.take_evictions(self)
@@ -0,0 +1,86 @@
+from chatserver.compat import as_bytes
+from chatserver import protocol
+
+class Broadcaster:
+    '''
+    Keeps the set of chat channels which take part in broadcasts so that
+    a message can be fanned out without walking the whole socket_map.
+    Every message is encoded once and the same bytes object is queued
+    on each recipient.
+
+    Channels on the compact protocol are kept apart; each message is
+    made into one batch entry for all of them, which they collect until
+    the end of the turn, see chat_channel.queue_entry().
+    '''
+
+    # the lobby has no name, rooms do; the id is the compact protocol's
+    name = None
+    id = protocol.LOBBY
+
+    # a History of what was fanned out, when it is kept
+    history = None
+
+    # number of the last message fanned out
+    seq = 0
+
+    # what is fanned out is journaled and relayed; see nicks.Nick
+    private = False
+
+    def __init__(self, shards=0, header_size=0):
+        self.channels = {}
+        self.compact = {}
+        # bytes of length header on every message, which the compact
+        # protocol leaves out
+        self.header_size = header_size
+        # with fan-out threads, the channels once more split by fd into
+        # one dict per thread, which each walks on its own
+        self.parts = None
+        if shards:
+            self.parts = [{} for i in range(shards)]
+
+    def register(self, fd, channel):
+        if channel.framing == 'compact':
+            self.compact[fd] = channel
+            return
+        self.channels[fd] = channel
+        if self.parts is not None:
+            self.parts[fd % len(self.parts)][fd] = channel
+
+    def unregister(self, fd):
+        self.channels.pop(fd, None)
+        self.compact.pop(fd, None)
+        if self.parts is not None and fd is not None:
+            self.parts[fd % len(self.parts)].pop(fd, None)
+
+    def __len__(self):
+        return len(self.channels) + len(self.compact)
+
+    def record(self, message, seq=None):
+        # seq is the message's number from the ingress queue; returns
+        # the message as it is queued on the recipients
+        data = as_bytes(message)
+        if seq is None:
+            seq = self.seq + 1
+        self.seq = seq
+        if self.history is not None:
+            self.history.append(seq, data)
+        return data
+
+    def recipients(self, sender_fd):
+        channels = self.channels
+        compact = self.compact
+        return (len(channels) + len(compact) -
+                (sender_fd in channels or sender_fd in compact))
+
+    def fanout(self, sender_fd, message, seq=None):
+        # returns the number of channels the message was queued on
+        data = self.record(message, seq)
+        for fd, channel in self.channels.items():
+            if fd != sender_fd:
+                channel.push_data(data)
+        if self.compact:
+            entry = protocol.entry(self.id, self.seq, data[self.header_size:])
+            for fd, channel in self.compact.items():
+                if fd != sender_fd:
+                    channel.queue_entry(entry)
+        return self.recipients(sender_fd)
@@ -2,8 +2,23 @@
 import os
 import sys
 import time
+import errno
 import socket
+import struct
+import threading
+import collections
 
+from chatserver.compat import as_bytes, as_string
+from chatserver.broadcast import Broadcaster
+from chatserver.rooms import RoomRegistry
+from chatserver.nicks import Nick, NickRegistry
+from chatserver.history import History
+from chatserver.metrics import Metrics
+from chatserver.ratelimit import TokenBucket, RateTable
+from chatserver.timers import clock
+from chatserver.backlog import LockedOutputBacklog
+from chatserver.fanout import FanoutPool, PUSH, CLOSE
+from chatserver import protocol
 from chatserver.medusa import text_socket
 from chatserver.medusa import asyncore_25 as asyncore
 from chatserver.medusa import asynchat_25 as asynchat
@@ -11,25 +26,428 @@ from chatserver.medusa.counter import counter
 
 VERSION_STRING = '1.0'
 
+# framing of chat messages on the wire:
+#   raw     every read is a message (the original behaviour)
+#   line    messages end with a newline
+#   length  every message is preceded by a 4 byte big-endian length
+# and, per client, the compact protocol of chatserver.protocol
+FRAMINGS = ('raw', 'line', 'length')
+FRAME_HEADER = struct.Struct('!I')
+
+
+def set_socket_options(sock, tcp_nodelay=False, sndbuf=0, rcvbuf=0):
+    # set on the listening socket, which the accepted sockets inherit
+    # them from, instead of once per connection; buffer sizes have to
+    # be set before listen() to be taken into account for the TCP
+    # window scale
+    if tcp_nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
 
 # ===========================================================================
 #                            Chat Channel Object
 # ===========================================================================
 
-class chat_channel(asynchat.async_chat):
+class chat_session(object):
+    '''
+    What a chat client can do, independent of the event loop it is served
+    by: commands, rooms, framing of outgoing messages and the idle and
+    keepalive timers.  The channel class provides server, logger, addr,
+    prefix, command_char, line_terminator, framing, rooms, room, nick,
+    _fileno, limited, ac_in_empty, add_data(), push_data(), close(),
+    pause_reading() and resume_reading(), and start_compact() and
+    push_entries() where compact_protocol is set.
+    '''
+
+    __slots__ = ()
+
+    # whether the channel can switch to the compact protocol
+    compact_protocol = False
+
+    # most messages replayed from the journal at once, without --history
+    journal_page = 100
+
+    # --------------------------------------------------
+    # timers
+    # --------------------------------------------------
+
+    def start_timers(self):
+        server = self.server
+        self.idle_timer = None
+        self.keepalive_timer = None
+        if server.idle_timeout:
+            self.idle_timer = server.timers.schedule(server.idle_timeout,
+                                                     self.handle_idle)
+        if server.keepalive:
+            self.keepalive_timer = server.timers.schedule(server.keepalive,
+                                                          self.handle_keepalive)
+
+    def stop_timers(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        if self.keepalive_timer is not None:
+            self.keepalive_timer.cancel()
+
+    def handle_idle(self):
+        # nothing read for idle_timeout seconds; most likely the peer is
+        # gone without the connection being closed
+        self.logger.info('closing idle channel %r, connected for %d seconds',
+                         self, int(time.time()) - self.creation_time)
+        self.close()
+
+    def handle_keepalive(self):
+        # nothing sent for keepalive seconds; keep NAT state on the way
+        # alive and find out about dead peers from the send
+        self.notice('ping')
+        self.keepalive_timer.reset(self.server.keepalive)
+
+    # --------------------------------------------------
+    # rate limits
+    # --------------------------------------------------
+
+    def spend_token(self):
+        # every message and command read takes a token from the buckets
+        # of the connection and of its address; once one of them is
+        # empty, nothing more is read until it has a token again, and
+        # what the client sends meanwhile waits in the kernel
+        server = self.server
+        delay = 0
+        if server.conn_limits is not None:
+            delay = server.conn_limits.spend(self._fileno)
+        if server.ip_limits is not None:
+            delay = max(delay, server.ip_limits.spend(self.addr[0]))
+        if delay and not self.limited:
+            self.limited = True
+            server.metrics.rate_limited += 1
+            self.pause_reading()
+            server.timers.schedule(delay, self.check_limits)
+
+    def check_limits(self):
+        if not self.limited:
+            # closed meanwhile
+            return
+        server = self.server
+        delay = 0
+        if server.conn_limits is not None:
+            delay = server.conn_limits.wait(self._fileno)
+        if server.ip_limits is not None:
+            delay = max(delay, server.ip_limits.wait(self.addr[0]))
+        if delay:
+            # what was read with the last message had more in it
+            server.timers.schedule(delay, self.check_limits)
+        else:
+            self.limited = False
+            self.resume_reading()
+
+    def forget_limits(self):
+        self.limited = False
+        if self.server.conn_limits is not None:
+            # the fd goes to the next connection, with a full bucket
+            self.server.conn_limits.forget(self._fileno)
+
+    # --------------------------------------------------
+    # rooms
+    # --------------------------------------------------
+
+    def handle_message(self, data, tail=None):
+        # data is one message without its terminator, tail is the
+        # terminator to send on with it
+        self.spend_token()
+        if data[:1] == self.command_char:
+            self.handle_command(data, tail)
+            return
+        if tail is not None:
+            data = data + tail
+        self.add_data(self.frame(data), self.room)
+
+    def handle_command(self, data, tail=None):
+        words = data.split(None, 2)
+        command = as_string(words[0]).lower()
+        args = [as_string(word) for word in words[1:2]]
+        if command == '/join' and args:
+            self.join(args[0].lower())
+        elif command == '/part':
+            self.part(args and args[0].lower() or None)
+        elif command == '/msg' and len(words) == 3:
+            self.msg(args[0].lower(), words[2], tail)
+        elif command == '/nick' and args:
+            self.set_nick(args[0])
+        elif command == '/history' and (not args or args[0].isdigit()):
+            since = None
+            if args:
+                since = int(args[0])
+            self.replay(self.room or self.server.broadcaster, since)
+        elif command == '/protocol' and args:
+            self.set_protocol(args[0].lower())
+        else:
+            self.notice('usage: /nick name, /join #room, /part [#room], '
+                        '/msg #room|nick text, /history [seq], '
+                        '/protocol compact')
+
+    def join(self, name):
+        registry = self.server.rooms
+        if not registry.valid_name(name):
+            self.notice('invalid room name %s' % name)
+            return
+        for room in self.rooms:
+            if room.name == name:
+                self.room = room
+                self.notice('now talking in %s' % name)
+                return
+        room = registry.join(name, self._fileno, self)
+        if not self.rooms:
+            # members of a room no longer get the lobby's messages
+            self.server.broadcaster.unregister(self._fileno)
+            self.rooms = []
+        self.rooms.append(room)
+        self.room = room
+        if self.framing == 'compact':
+            self.push_room(room)
+        self.notice('joined %s (%d members)' % (name, len(room)))
+        if room.history is not None:
+            self.replay(room)
+
+    def part(self, name=None):
+        if name is None and self.room is not None:
+            name = self.room.name
+        for room in self.rooms:
+            if room.name == name:
+                break
+        else:
+            self.notice('not in room %s' % name)
+            return
+        self.server.rooms.part(room, self._fileno)
+        self.rooms.remove(room)
+        if self.rooms:
+            self.room = self.rooms[-1]
+        else:
+            self.rooms = ()
+            self.room = None
+            self.server.broadcaster.register(self._fileno, self)
+        self.notice('left %s' % name)
+
+    def msg(self, name, text, tail=None):
+        if not name.startswith('#'):
+            self.direct(name, text, tail)
+            return
+        for room in self.rooms:
+            if room.name == name:
+                if tail is not None:
+                    text = text + tail
+                self.add_data(self.frame(text), room)
+                return
+        self.notice('not in room %s' % name)
+
+    # --------------------------------------------------
+    # nicknames
+    # --------------------------------------------------
+
+    def set_nick(self, name):
+        key = name.lower()
+        registry = self.server.nicks
+        if not registry.valid_name(key):
+            self.notice('invalid nickname %s' % name)
+            return
+        cluster = self.server.cluster
+        if registry.get(key) is None and cluster is not None and \
+           cluster.knows(key):
+            # a client of another node has it
+            self.notice('nickname %s is taken' % name)
+            return
+        nick = registry.take(key, self)
+        if nick is None:
+            self.notice('nickname %s is taken' % name)
+            return
+        if self.nick is not None and self.nick is not nick:
+            registry.release(self.nick)
+        self.nick = nick
+        # what everyone else sees our messages come from
+        prefix = '[%s]: ' % name
+        if self.server.binary:
+            prefix = as_bytes(prefix)
+        self.prefix = prefix
+        self.notice('you are now %s' % name)
+
+    def drop_nick(self):
+        if self.nick is not None:
+            self.server.nicks.release(self.nick)
+            self.nick = None
+
+    def lose_nick(self, node):
+        # another node gave out our nickname before either heard of the
+        # other's, and keeps it
+        name = self.nick.name
+        self.drop_nick()
+        prefix = '[%s:%d]: ' % self.addr[:2]
+        if self.server.binary:
+            prefix = as_bytes(prefix)
+        self.prefix = prefix
+        self.notice('nickname %s is taken on %s' % (name, node))
+
+    def direct(self, name, text, tail=None):
+        # queued on the one channel with that nickname, through the
+        # ingress queue so it keeps its place among our other messages
+        nick = self.server.nicks.get(name)
+        if nick is None:
+            cluster = self.server.cluster
+            if self.server.relay is None and self.server.bridge is None and \
+               (cluster is None or not cluster.knows(name)):
+                self.notice('no such nickname %s' % name)
+                return
+            # another worker's, node's or chatserverd's client
+            nick = Nick(name)
+        if tail is not None:
+            text = text + tail
+        tag = '(private) '
+        if self.server.binary:
+            tag = as_bytes(tag)
+        self.add_data(self.frame(tag + text), nick)
+
+    def replay(self, target, since=None):
+        # what the lobby or room target sent after message number since,
+        # or the recent messages when since is None, then the number to
+        # ask for more from next time; the ring goes out as one buffer,
+        # the journal as views onto its mapped files, and either as one
+        # batch on the compact protocol
+        server = self.server
+        history = target.history
+        journal = server.journal
+        compact = self.framing == 'compact'
+        last = target.seq
+        if history is not None and (since is None or journal is None or
+                                    history.covers(since)):
+            frames = history.since(since or 0, compact)
+            if compact:
+                self.push_entries(target, frames)
+            elif frames:
+                self.push_data(b''.join(frames))
+        elif journal is not None:
+            # a page at a time: the journal may hold far more than a
+            # client's buffer, and it is read in the loop
+            limit = server.history_size or self.journal_page
+            if since is None:
+                since = max(0, target.seq - limit)
+            frames = journal.read_since(since, target.name, True, limit,
+                                        server.low_watermark)
+            nbytes = 0
+            for seq, frame in frames:
+                nbytes += len(frame)
+            if frames and (len(frames) == limit or nbytes >= server.low_watermark):
+                # stopped short, the next page starts after this one
+                last = frames[-1][0]
+            if compact:
+                self.push_entries(target, frames)
+            else:
+                for seq, frame in frames:
+                    self.push_data(frame)
+        else:
+            self.notice('no history is kept')
+            return
+        self.notice('history %d' % last)
+
+    def notice(self, text):
+        # a message from the server to this client only
+        if self.framing == 'compact':
+            self.push_data(protocol.frame(protocol.NOTICE, as_bytes(text)))
+            return
+        text = '*** %s\n' % text
+        if self.server.binary:
+            text = as_bytes(text)
+        self.push_data(self.frame(text, self.ac_in_empty))
+
+    # --------------------------------------------------
+    # framing
+    # --------------------------------------------------
+
+    def set_protocol(self, name):
+        if name != 'compact':
+            self.notice('unknown protocol %s' % name)
+        elif self.framing == 'compact':
+            self.notice('protocol compact')
+        elif not self.compact_protocol:
+            self.notice('protocol compact is not available')
+        else:
+            # the last notice in the server's framing
+            self.notice('protocol compact')
+            self.start_compact()
+
+    def frame(self, data, prefix=None):
+        # the prefix and, in length framing, the header are added once
+        # here; every recipient gets the same framed message, in the
+        # server's framing whichever protocol the sender is on
+        if prefix is None:
+            prefix = self.prefix
+        message = prefix + data
+        if self.server.framing == 'length':
+            return FRAME_HEADER.pack(len(message)) + message
+        return message
+
+
+class chat_channel(asynchat.async_chat, chat_session):
+
+    # a server may hold a great many mostly idle channels: everything a
+    # channel does not need its own copy of is a class attribute, and
+    # lists are only made once there is something to put in them
+    __slots__ = ('server', 'logger', 'prefix', 'framing', 'creation_time',
+                 'overflowing', 'evicted', 'dropped_messages', 'idle_timer',
+                 'keepalive_timer', 'pieces', 'rooms', 'room', 'nick',
+                 'in_header', 'in_bytes', 'batch', 'limited')
 
     # use a larger default output buffer
     ac_out_buffer_size = 1<<16
 
+    # longest message accepted in line and length framing
+    max_frame_size = 1<<20
+
+    command_char = '/'
+    line_terminator = '\n'
+    greeting = "I'm online now!!!\n"
+
     def __init__(self, server, conn, addr, logger_object):
+        # known from accept(), the dispatcher need not ask getpeername()
+        self.addr = addr
         asynchat.async_chat.__init__(self, conn)
         self.server = server
-        self.addr = addr
         self.logger = logger_object
-        self.in_buffer = ''
+        prefix = '[%s:%d]: ' % addr
+        if server.binary:
+            # encode the peer prefix once per connection
+            prefix = as_bytes(prefix)
+        self.prefix = prefix
         self.creation_time = int(time.time())
-        self.set_terminator(None)
-        self.collect_incoming_data("I'm online now!!!\n")
+        # set while drop-newest is discarding messages, until the
+        # buffer is back down to the low watermark
+        self.overflowing = False
+        self.evicted = False
+        self.dropped_messages = 0
+        # set while over a rate limit, see spend_token()
+        self.limited = False
+        self.start_timers()
+        self.framing = server.framing
+        server.broadcaster.register(self._fileno, self)
+        # pieces of the message being read, rooms joined (most recent
+        # last); plain messages go to self.room, or to the lobby when
+        # that is None
+        self.pieces = ()
+        self.rooms = ()
+        self.room = None
+        self.nick = None
+        # batch entries collected in this turn, on the compact protocol
+        self.batch = None
+        if self.framing == 'line':
+            self.set_terminator(self.line_terminator)
+        elif self.framing == 'length':
+            self.in_header = True
+            self.set_terminator(FRAME_HEADER.size)
+        else:
+            self.set_terminator(None)
+        if server.broadcaster.history is not None:
+            self.replay(server.broadcaster)
+        self.add_data(self.frame(self.greeting))
 
     def repr(self):
         ar = asynchat.async_chat.__repr__(self)[1:-1]
@@ -43,6 +461,7 @@ class chat_channel(asynchat.async_chat):
     def recv(self, buffer_size):
         try:
             result = asynchat.async_chat.recv(self, buffer_size)
+            self.server.metrics.bytes_in += len(result)
             return result
         except MemoryError:
             sys.exit("Out of Memory!")
@@ -55,22 +474,376 @@ class chat_channel(asynchat.async_chat):
             asynchat.async_chat.handle_error(self)
 
     def push_data(self, data):
-        self.ac_out_buffer = self.ac_out_buffer + data
+        # broadcasts are shared between recipients, queue them by reference
+        if (self.overflowing or
+                self.ac_out_bytes + len(data) > self.server.high_watermark):
+            self.handle_overflow(data)
+        else:
+            self.push_buffer(data)
+
+    def handle_overflow(self, data):
+        # the client is not keeping up with what is sent to it
+        backlog = asyncore.out_backlog
+        if self.evicted:
+            backlog.dropped(len(data))
+            return
+        overflow = self.server.overflow
+        if overflow == 'disconnect':
+            self.logger.warn('evicting slow consumer %r with %d bytes buffered',
+                             self, self.ac_out_bytes)
+            self.evicted = True
+            backlog.dropped(len(data))
+            backlog.evict(self)
+        elif overflow == 'drop-newest':
+            if not self.overflowing:
+                self.logger.info('dropping new messages for %r', self)
+                self.overflowing = True
+            self.dropped_messages += 1
+            backlog.dropped(len(data))
+        else:
+            self.drop_oldest(self.server.low_watermark - len(data))
+            self.push_buffer(data)
+
+    def drop_oldest(self, limit):
+        # discard whole queued messages from the front until at most
+        # limit bytes are left; a partly sent one has to go out complete
+        queue = self.ac_out_buffer
+        head = None
+        if self.ac_out_offset and queue:
+            head = queue.popleft()
+        dropped = 0
+        while queue and self.ac_out_bytes - dropped > limit:
+            nbytes = len(queue.popleft())
+            dropped += nbytes
+            self.dropped_messages += 1
+            asyncore.out_backlog.dropped(nbytes)
+        if head is not None:
+            queue.appendleft(head)
+        self.ac_out_bytes -= dropped
+        asyncore.out_backlog.remove(dropped)
+
+    def push_buffer(self, data):
+        nbytes = self.ac_out_bytes
+        asynchat.async_chat.push_buffer(self, data)
+        asyncore.out_backlog.add(self.ac_out_bytes - nbytes)
+        if self.keepalive_timer is not None:
+            self.keepalive_timer.reset(self.server.keepalive)
+
+    def consume_out_buffer(self, num_sent):
+        asynchat.async_chat.consume_out_buffer(self, num_sent)
+        asyncore.out_backlog.remove(num_sent)
+        self.server.metrics.bytes_out += num_sent
+        if self.overflowing and self.ac_out_bytes <= self.server.low_watermark:
+            self.logger.info('resuming messages for %r, %d dropped',
+                             self, self.dropped_messages)
+            self.overflowing = False
+
+    def readable(self):
+        if (self.limited or asyncore.data_queue.full() or
+                asyncore.out_backlog.full()):
+            return False
+        return asynchat.async_chat.readable(self)
+
+    def pause_reading(self):
+        # readable() is about to change
+        asyncore.dirty.add(self._fileno)
+
+    def resume_reading(self):
+        if self._fileno is None:
+            return
+        asyncore.dirty.add(self._fileno)
+        # the rest of the read which went over the limit
+        if self.ac_in_buffer:
+            self.process_input(self.ac_in_buffer)
+        elif self.framing == 'compact' and self.pieces:
+            self.read_frames(self.ac_in_empty)
+
+    def input_paused(self):
+        return self.limited
+
+    def handle_read(self):
+        if self.idle_timer is not None:
+            self.idle_timer.reset(self.server.idle_timeout)
+        # the broadcaster is behind; leave the data in the kernel until
+        # the queue has been drained
+        if asyncore.data_queue.full():
+            asyncore.data_queue.deferred += 1
+            return
+        asynchat.async_chat.handle_read(self)
 
     def writable(self):
-        if len(self.ac_out_buffer) > 0:
+        if self.ac_out_bytes > 0:
             return True
         else:
             return False
 
+    def close(self):
+        if self._fileno is not None:
+            # not closed already
+            self.server.metrics.closed += 1
+        self.forget()
+        asyncore.out_backlog.remove(self.ac_out_bytes)
+        self.discard_buffers()
+        asynchat.async_chat.close(self)
+
+    def forget(self):
+        # out of the lobby, the rooms and the nickname index
+        self.server.broadcaster.unregister(self._fileno)
+        for room in self.rooms:
+            self.server.rooms.part(room, self._fileno)
+        self.rooms = ()
+        self.room = None
+        self.drop_nick()
+        self.stop_timers()
+        self.forget_limits()
+
     # --------------------------------------------------
     # async_chat methods
     # --------------------------------------------------
 
     def collect_incoming_data(self, data):
-        recv_msg = '[%s:%d]: ' % self.addr + data
-        self.add_data(recv_msg)
-        # self.logger.log(recv_msg)
+        if self.framing == 'raw':
+            self.handle_message(data)
+        elif self.framing == 'compact':
+            self.read_frames(data)
+        else:
+            if self.pieces:
+                self.pieces.append(data)
+                self.in_bytes += len(data)
+            else:
+                self.pieces = [data]
+                self.in_bytes = len(data)
+            if self.in_bytes > self.max_frame_size:
+                # a line which never ends
+                self.logger.warn('closing channel %r: more than %d bytes without a terminator',
+                                 self, self.max_frame_size)
+                self.close()
+
+    def found_terminator(self):
+        data = self.ac_in_empty.join(self.pieces)
+        self.pieces = ()
+        if self.framing == 'line':
+            self.handle_message(data, self.terminator)
+        elif self.in_header:
+            size = FRAME_HEADER.unpack(data)[0]
+            if size > self.max_frame_size:
+                self.logger.warn('closing channel %r: frame of %d bytes is too big',
+                                 self, size)
+                self.close()
+            elif size:
+                self.in_header = False
+                self.set_terminator(size)
+        else:
+            self.in_header = True
+            self.set_terminator(FRAME_HEADER.size)
+            self.handle_message(data)
+
+    # --------------------------------------------------
+    # compact protocol
+    # --------------------------------------------------
+
+    def start_compact(self):
+        # whatever follows the command on the connection is compact
+        # frames, and the lobby or rooms keep us with their compact
+        # channels from now on
+        fd = self._fileno
+        targets = self.rooms or (self.server.broadcaster,)
+        for target in targets:
+            target.unregister(fd)
+        self.framing = 'compact'
+        self.set_terminator(None)
+        self.pieces = ()
+        for target in targets:
+            target.register(fd, self)
+        for room in self.rooms:
+            self.push_room(room)
+
+    def read_frames(self, data):
+        # pieces is the bytearray of an incomplete frame
+        buf = self.pieces
+        if buf:
+            buf.extend(data)
+        else:
+            buf = bytearray(data)
+        offset = 0
+        try:
+            while self._fileno is not None and not self.limited:
+                frame = protocol.parse(buf, offset, self.max_frame_size)
+                if frame is None:
+                    break
+                kind, start, offset = frame
+                self.handle_frame(kind, buf[start:offset])
+        except ValueError as why:
+            self.logger.warn('closing channel %r: %s', self, why)
+            self.close()
+            return
+        if offset:
+            del buf[:offset]
+        self.pieces = buf or ()
+
+    def handle_frame(self, kind, body):
+        # text clients' messages carry the terminator of line framing,
+        # so the compact ones get it too
+        tail = None
+        if self.server.framing == 'line':
+            tail = self.line_terminator
+        self.spend_token()
+        if kind == protocol.MESSAGE:
+            room_id, data = protocol.message(body)
+            room = self.room
+            if room_id != protocol.LOBBY:
+                for room in self.rooms:
+                    if room.id == room_id:
+                        break
+                else:
+                    self.notice('not in room %d' % room_id)
+                    return
+            if tail is not None:
+                data = data + tail
+            self.add_data(self.frame(data), room)
+        elif kind == protocol.COMMAND:
+            self.handle_command(bytes(body), tail)
+        else:
+            raise ValueError('frame of kind %d from a client' % kind)
+
+    def push_room(self, room):
+        self.push_data(protocol.frame(
+            protocol.ROOM, protocol.varint(room.id) + as_bytes(room.name)))
+
+    def push_entries(self, target, frames):
+        # the (number, frame) of a replay as one batch
+        header_size = self.server.header_size
+        entries = [protocol.entry(target.id, seq, frame[header_size:])
+                   for seq, frame in frames]
+        if entries:
+            self.push_data(protocol.batch(entries))
+
+    def queue_entry(self, entry):
+        # sent with the rest of the turn's by chat_server.flush_batches()
+        batch = self.batch
+        if batch is None:
+            self.batch = [entry]
+            self.server.batching.append(self)
+        else:
+            batch.append(entry)
+
+    def flush_batch(self):
+        entries, self.batch = self.batch, None
+        if entries and self._fileno is not None:
+            self.push_data(protocol.batch(entries))
+
+
+class binary_chat_channel(chat_channel):
+    '''A chat_channel whose payloads stay bytes from recv() to send().'''
+
+    __slots__ = ()
+
+    compact_protocol = True
+
+    ac_in_empty = b''
+    command_char = b'/'
+    line_terminator = b'\n'
+    greeting = b"I'm online now!!!\n"
+
+class sharded_chat_channel(chat_channel):
+    '''
+    A chat_channel whose output side belongs to a fan-out thread, with
+    --fanout-threads.  The loop thread reads from it and hands it to its
+    shard for everything else: push_data() queues the data behind the
+    batches the shard has been given, close() leaves closing the socket
+    to the shard.  What runs in the shard's thread keeps away from the
+    loop's state: no dirty fds and no timers; it leaves the time of its
+    last output in last_output for the keepalive timer to look at.
+    '''
+
+    __slots__ = ('shard', 'writing', 'last_output')
+
+    def __init__(self, server, conn, addr, logger_object):
+        self.shard = server.fanout.shard_for(conn.fileno())
+        self.writing = True
+        self.last_output = clock()
+        chat_channel.__init__(self, server, conn, addr, logger_object)
+
+    def handle_keepalive(self):
+        # pushed back by what was sent since, instead of being reset on
+        # every push as it is in the loop thread
+        idle = clock() - self.last_output
+        if idle < self.server.keepalive:
+            self.keepalive_timer.reset(self.server.keepalive - idle)
+        else:
+            chat_channel.handle_keepalive(self)
+
+    def push_data(self, data):
+        self.shard.put(PUSH, self, data)
+
+    def deliver(self, data):
+        # in the shard's thread
+        if self.writing:
+            chat_channel.push_data(self, data)
+
+    def push_buffer(self, data):
+        if not isinstance(data, memoryview):
+            data = as_bytes(data)
+        if self.ac_out_buffer is asynchat.EMPTY:
+            self.ac_out_buffer = collections.deque()
+        self.ac_out_buffer.append(data)
+        self.ac_out_bytes += len(data)
+        self.shard.pending += len(data)
+        self.last_output = clock()
+
+    def consume_out_buffer(self, num_sent):
+        self.ac_out_bytes -= num_sent
+        queue = self.ac_out_buffer
+        offset = num_sent + self.ac_out_offset
+        while queue and offset >= len(queue[0]):
+            offset -= len(queue.popleft())
+        self.ac_out_offset = offset
+        if not queue:
+            self.ac_out_buffer = asynchat.EMPTY
+        self.shard.pending -= num_sent
+        self.shard.bytes_out += num_sent
+        if self.overflowing and self.ac_out_bytes <= self.server.low_watermark:
+            self.logger.info('resuming messages for %r, %d dropped',
+                             self, self.dropped_messages)
+            self.overflowing = False
+
+    def discard_output(self):
+        self.shard.pending -= self.ac_out_bytes
+        self.ac_out_buffer = asynchat.EMPTY
+        self.ac_out_offset = 0
+        self.ac_out_bytes = 0
+        self.producer_fifo = asynchat.EMPTY
+
+    def writable(self):
+        # the shard writes, the loop never does
+        return False
+
+    def handle_error(self):
+        if threading.current_thread() is self.shard:
+            # a failed send(); the loop thread closes the channel
+            self.shard.send_failed(self)
+        else:
+            chat_channel.handle_error(self)
+
+    def close(self):
+        fd = self._fileno
+        if fd is None:
+            return
+        self.writing = False
+        self.server.metrics.closed += 1
+        self.forget()
+        self.del_channel()
+        self.shard.put(CLOSE, self, fd)
+
+class sharded_binary_chat_channel(sharded_chat_channel):
+
+    __slots__ = ()
+
+    ac_in_empty = b''
+    command_char = b'/'
+    line_terminator = b'\n'
+    greeting = b"I'm online now!!!\n"
+
 
 
 # ===========================================================================
@@ -81,6 +854,68 @@ class chat_server(asyncore.dispatcher):
 
     SERVER_IDENT = 'Chat Server (V%s)' % VERSION_STRING
 
+    # channels work on str by default, and on bytes end to end when set
+    binary = False
+    framing = 'raw'
+
+    # per channel output buffer limits: past high_watermark the overflow
+    # strategy applies, drop-newest resumes below low_watermark and
+    # drop-oldest trims down to it
+    high_watermark = 1<<22
+    low_watermark = 1<<20
+    overflow = 'disconnect'
+
+    # seconds without input before a channel is closed and without
+    # output before it is sent a ping, 0 to turn off; both are timers
+    # on the timer wheel in self.timers
+    idle_timeout = 0
+    keepalive = 0
+    timers = None
+
+    # messages kept by the lobby and by each room and replayed to new
+    # clients and members, 0 to keep none
+    history_size = 0
+
+    # the Journal of all messages, when there is one
+    journal = None
+
+    # the counters the channels add to
+    metrics = Metrics()
+
+    # connections the kernel queues until they are accepted, and the
+    # most accepted in one go when the listener is readable
+    listen_backlog = 1024
+    accept_batch = 64
+
+    # a TokenBucket limiting the rate of accepts, when there is one;
+    # while it is empty the listener is not read and new connections
+    # wait in the kernel's queue
+    accept_limiter = None
+    throttled = False
+
+    # the relay_channel to the master with --workers
+    relay = None
+
+    # the relay to the chatserverd at the other end of a reload
+    bridge = None
+
+    # the Cluster of nodes this one is linked to, with --peers
+    cluster = None
+
+    # RateTables of the messages each connection and each address may
+    # send, with --max-message-rate and --max-ip-rate
+    conn_limits = None
+    ip_limits = None
+
+    # the FanoutPool writing to the channels, with --fanout-threads
+    fanout_threads = 0
+    fanout = None
+
+    # bytes of length header on every message, and the channels on the
+    # compact protocol with batch entries to send at the end of the turn
+    header_size = 0
+    batching = ()
+
     def __init__(self, ip, port, resolver=None, logger_object=None):
         self.ip = ip
         self.port = port
@@ -93,7 +928,7 @@ class chat_server(asyncore.dispatcher):
         self.bind((ip, port))
 
         # lower this to 5 if your OS complains
-        self.listen(1024)
+        self.listen(self.listen_backlog)
 
         host, port = self.socket.getsockname()
         if not ip:
@@ -107,6 +942,15 @@ class chat_server(asyncore.dispatcher):
 
         self.server_port = port
         self.total_clients = counter()
+        if self.framing == 'length':
+            self.header_size = FRAME_HEADER.size
+        self.broadcaster = Broadcaster(self.fanout_threads, self.header_size)
+        if self.history_size:
+            self.broadcaster.history = History(self.history_size)
+        self.rooms = RoomRegistry(self.history_size, self.fanout_threads,
+                                  self.header_size)
+        self.nicks = NickRegistry()
+        self.batching = []
 
         self.log_info(
                 'Chat Server (V%s) started at %s'
@@ -131,25 +975,64 @@ class chat_server(asyncore.dispatcher):
         pass
 
     def readable(self):
-        return self.accepting
+        return self.accepting and not self.throttled
 
     def handle_connect(self):
         pass
 
     def handle_accept(self):
-        self.total_clients.increment()
-        try:
-            conn, addr = self.accept()
-            self.logger.log("handle_accept addr = %s" % str(addr))
-            self.logger.log("handle_accept peername = %s" % str(conn.getpeername()))
-        except socket.error:
-            self.log_info('warning: server accept() threw an exception', 'warning')
-            return
-        except TypeError:
-            self.log_info('warning: server accept() threw EWOULDBLOCK', 'warning')
-            return
+        # take what has queued up since the last wake-up, a reconnect
+        # storm would overflow the kernel's queue one accept at a time
+        limiter = self.accept_limiter
+        for i in range(self.accept_batch):
+            if limiter is not None:
+                delay = limiter.wait()
+                if delay:
+                    self.throttle(delay)
+                    return
+            try:
+                pair = self.accept()
+            except socket.error as why:
+                if why.args[0] == errno.ECONNABORTED:
+                    # reset by the peer while it was queued
+                    continue
+                # most likely out of file descriptors
+                self.log_info('warning: server accept() threw an exception: %s' % why,
+                              'warning')
+                return
+            if pair is None:
+                # EWOULDBLOCK, the queue is empty
+                return
+            conn, addr = pair
+            if limiter is not None:
+                limiter.take()
+            self.total_clients.increment()
+            self.metrics.accepted += 1
+            self.logger.trace('accepted %s', addr)
+            self.new_channel(conn, addr)
+
+    def new_channel(self, conn, addr):
+        if self.fanout is not None:
+            if self.binary:
+                return sharded_binary_chat_channel(self, conn, addr, self.logger)
+            return sharded_chat_channel(self, conn, addr, self.logger)
+        if self.binary:
+            return binary_chat_channel(self, conn, addr, self.logger)
+        return chat_channel(self, conn, addr, self.logger)
 
-        chat_channel(self, conn, addr, self.logger)
+    def throttle(self, delay):
+        # stop accepting until the limiter has a token again
+        self.logger.debug('accept rate limit reached, not accepting for %.3f seconds',
+                          delay)
+        self.throttled = True
+        self.metrics.throttled += 1
+        asyncore.dirty.add(self._fileno)
+        self.timers.schedule(delay, self.unthrottle)
+
+    def unthrottle(self):
+        self.throttled = False
+        if self._fileno is not None:
+            asyncore.dirty.add(self._fileno)
 
     def prebind(self, sock, logger_object):
         self.logger = logger_object
@@ -162,10 +1045,28 @@ class chat_server(asyncore.dispatcher):
         sock.setblocking(0)
         self.set_reuse_addr()
 
+    def stop_accepting(self):
+        # a reload leaves new connections to the new chatserverd; the
+        # channels carry on until they are closed
+        self.accepting = False
+        asyncore.dispatcher.close(self)
+
+    def set_reuse_port(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
     def postbind(self):
-        self.listen(1024)
+        self.listen(self.listen_backlog)
 
         self.total_clients = counter()
+        if self.framing == 'length':
+            self.header_size = FRAME_HEADER.size
+        self.broadcaster = Broadcaster(self.fanout_threads, self.header_size)
+        if self.history_size:
+            self.broadcaster.history = History(self.history_size)
+        self.rooms = RoomRegistry(self.history_size, self.fanout_threads,
+                                  self.header_size)
+        self.nicks = NickRegistry()
+        self.batching = []
 
         self.log_info(
                 'Chat Server (V%s) started at %s'
@@ -179,6 +1080,11 @@ class chat_server(asyncore.dispatcher):
                         )
                 )
 
+    def flush_batches(self):
+        channels, self.batching = self.batching, []
+        for channel in channels:
+            channel.flush_batch()
+
     def log_info(self, message, type='info'):
         ip = ''
         if getattr(self, 'ip', None) is not None:
@@ -188,12 +1094,59 @@ class chat_server(asyncore.dispatcher):
 class af_inet_server(chat_server):
     """ AF_INET version of  Chat Server """
 
-    def __init__(self, ip, port, logger_object):
+    def __init__(self, ip, port, logger_object, binary=False,
+                 reuse_port=False, framing='raw', high_watermark=None,
+                 low_watermark=None, overflow=None, timers=None,
+                 idle_timeout=0, keepalive=0, history_size=0, journal=None,
+                 metrics=None, listen_backlog=None, accept_batch=None,
+                 accept_rate=0, tcp_nodelay=False, sndbuf=0, rcvbuf=0,
+                 sock=None, fanout_threads=0, message_rate=0, ip_rate=0):
         self.ip = ip
         self.port = port
-        sock = text_socket.text_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.prebind(sock, logger_object)
-        self.bind((ip, port))
+        self.binary = binary
+        self.framing = framing
+        if high_watermark is not None:
+            self.high_watermark = high_watermark
+        if low_watermark is not None:
+            self.low_watermark = low_watermark
+        if overflow is not None:
+            self.overflow = overflow
+        self.timers = timers
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.history_size = history_size
+        self.journal = journal
+        if metrics is not None:
+            self.metrics = metrics
+        if listen_backlog is not None:
+            self.listen_backlog = listen_backlog
+        if accept_batch is not None:
+            self.accept_batch = accept_batch
+        if accept_rate:
+            self.accept_limiter = TokenBucket(accept_rate)
+        if message_rate:
+            self.conn_limits = RateTable(message_rate, timers=timers)
+        if ip_rate:
+            self.ip_limits = RateTable(ip_rate, timers=timers)
+        self.fanout_threads = fanout_threads
+        if sock is not None:
+            # the listener of the chatserverd we are reloading, already
+            # bound and with connections waiting in its queue
+            self.prebind(sock, logger_object)
+        else:
+            if binary:
+                # a plain socket hands out plain sockets from accept(), so
+                # nothing is decoded or encoded on the way through
+                sock = text_socket.bin_socket(socket.AF_INET, socket.SOCK_STREAM)
+            else:
+                sock = text_socket.text_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.prebind(sock, logger_object)
+            if reuse_port:
+                # every worker binds its own listener and the kernel
+                # spreads the incoming connections between them
+                self.set_reuse_port()
+            set_socket_options(self.socket, tcp_nodelay, sndbuf, rcvbuf)
+            self.bind((ip, port))
 
         if not ip:
             self.log_info('Computing default hostname', 'warning')
@@ -213,16 +1166,43 @@ class af_inet_server(chat_server):
 
 def make_server(helpers):
     servers = []
-    class LogWrapper:
-        def log(self, msg):
-            if msg.endswith('\n'):
-                msg = msg[:-1]
-            helpers.logger.log(msg)
-    wrapper = LogWrapper()
 
     config = helpers.server_config
     host, port = config['host'], config['port']
-    hs = af_inet_server(host, port, logger_object=wrapper)
+    # the logger strips trailing newlines itself
+    hs = af_inet_server(host, port, logger_object=helpers.logger,
+                        binary=config['binary'],
+                        reuse_port=config['reuse_port'],
+                        framing=config['framing'],
+                        high_watermark=config['high_watermark'],
+                        low_watermark=config['low_watermark'],
+                        overflow=config['overflow'],
+                        timers=helpers.timers,
+                        idle_timeout=config['idle_timeout'],
+                        keepalive=config['keepalive'],
+                        history_size=config['history'],
+                        journal=helpers.journal,
+                        metrics=helpers.metrics,
+                        listen_backlog=config['listen_backlog'],
+                        accept_batch=config['accept_batch'],
+                        accept_rate=config['max_accept_rate'],
+                        tcp_nodelay=config['tcp_nodelay'],
+                        sndbuf=config['sndbuf'],
+                        rcvbuf=config['rcvbuf'],
+                        sock=helpers.inherited_listener(config['binary']),
+                        fanout_threads=config['fanout_threads'],
+                        message_rate=config['max_message_rate'],
+                        ip_rate=config['max_ip_rate'])
+    if config['fanout_threads']:
+        # started by the event loop, in the process which runs it
+        hs.fanout = helpers.fanout = FanoutPool(
+            hs, config['fanout_threads'], helpers.poller_class, helpers)
+        asyncore.out_backlog = LockedOutputBacklog()
+        helpers.metrics.fanout = hs.fanout
+    asyncore.out_backlog.max_bytes = config['max_backlog']
+    asyncore.out_backlog.low_bytes = config['max_backlog'] // 2
+    helpers.metrics.backlog = asyncore.out_backlog
+    helpers.metrics.queue = asyncore.data_queue
     sys.stdout.write("Chat Server is listening on port %d\n" % port)
 
     servers.append((config, hs))
@@ -0,0 +1,407 @@
+import os
+import sys
+import socket
+import struct
+
+from chatserver.compat import as_bytes, as_string
+from chatserver.nicks import delivered
+from chatserver.medusa import asyncore_25 as asyncore
+from chatserver.medusa import asynchat_25 as asynchat
+
+# every frame on a link starts with the length of what follows the
+# header and its kind
+FRAME_HEADER = struct.Struct('!IB')
+HELLO, SUBSCRIBE, UNSUBSCRIBE, BATCH = range(4)
+
+# a batch is the sending node's id, preceded by its length, then one
+# entry per message: the lengths of the room name or nickname (0 for the
+# lobby) and of the message, the name and the message
+ORIGIN_HEADER = struct.Struct('!B')
+ENTRY_HEADER = struct.Struct('!BI')
+
+# longest frame taken from a peer
+MAX_FRAME = 1<<26
+
+def listen(host, port, backlog=64):
+    # bound before daemonizing, like the chat and admin sockets
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+def parse_peers(value):
+    # host:port[,host:port...]
+    peers = []
+    for item in value.split(','):
+        host, sep, port = item.strip().rpartition(':')
+        if not sep or not port.isdigit():
+            raise ValueError('invalid peer %s' % item)
+        peers.append((host or '127.0.0.1', int(port)))
+    return peers
+
+class peer_channel(asynchat.async_chat):
+    '''
+    One link between two nodes of a cluster, dialed by either of them.
+    Each end says hello with its node id and the rooms and nicknames it
+    has members for, then keeps the other up to date with what it
+    subscribes to and sends it batches of its clients' messages; nothing
+    waits for an answer, frames follow each other on the connection.
+    '''
+
+    ac_in_empty = b''
+    ac_in_buffer_size = 1<<16
+    ac_out_buffer_size = 1<<16
+
+    def __init__(self, cluster, conn=None, address=None):
+        asynchat.async_chat.__init__(self, conn)
+        self.cluster = cluster
+        self.logger = cluster.logger
+        # the peer's listener when we dialed it, None when it dialed us
+        self.address = address
+        # the peer's node id, once it has said hello
+        self.node = None
+        # the rooms and nicknames the peer has members for
+        self.names = set()
+        self.pieces = []
+        self.kind = None
+        self.set_terminator(FRAME_HEADER.size)
+        if conn is None:
+            # bytes both ways, whatever the chat sockets carry
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            self.set_socket(sock)
+            self.set_options()
+            try:
+                self.connect(address)
+            except socket.error:
+                # closing it has the peer dialed again later
+                self.handle_error()
+                return
+        else:
+            self.set_options()
+        self.send_frame(HELLO, as_bytes(cluster.node_id))
+        self.subscribe(cluster.subscriptions())
+
+    def set_options(self):
+        # batches are sent once per turn of the loop, as they are
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def send_frame(self, kind, body):
+        self.push_buffer(FRAME_HEADER.pack(len(body), kind))
+        if body:
+            self.push_buffer(body)
+
+    def subscribe(self, names):
+        if names:
+            self.send_frame(SUBSCRIBE, b' '.join(as_bytes(name) for name in names))
+
+    def unsubscribe(self, names):
+        if names:
+            self.send_frame(UNSUBSCRIBE, b' '.join(as_bytes(name) for name in names))
+
+    def forward(self, origin, entries):
+        # entries are (entry header and name, message) pairs, shared
+        # between the links and queued by reference
+        size = len(origin)
+        for head, data in entries:
+            size += len(head) + len(data)
+        self.push_buffer(FRAME_HEADER.pack(size, BATCH) + origin)
+        for head, data in entries:
+            self.push_buffer(head)
+            self.push_buffer(data)
+
+    def peer(self):
+        if self.node is not None:
+            return self.node
+        if self.address is not None:
+            return '%s:%d' % self.address
+        return repr(self.addr)
+
+    def handle_connect(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+
+    def collect_incoming_data(self, data):
+        self.pieces.append(data)
+
+    def found_terminator(self):
+        data = b''.join(self.pieces)
+        self.pieces = []
+        if self.kind is None:
+            size, kind = FRAME_HEADER.unpack(data)
+            if size > MAX_FRAME:
+                self.logger.error('%d byte frame from %s, closing',
+                                  size, self.peer())
+                self.close()
+                return
+            if size:
+                self.kind = kind
+                self.set_terminator(size)
+                return
+            data = b''
+        else:
+            kind, self.kind = self.kind, None
+        self.set_terminator(FRAME_HEADER.size)
+
+        if kind == BATCH:
+            self.batch(data)
+        elif kind == SUBSCRIBE:
+            names = as_string(data).split()
+            self.names.update(names)
+            self.cluster.claimed(self, names)
+        elif kind == UNSUBSCRIBE:
+            self.names.difference_update(as_string(data).split())
+        elif kind == HELLO and self.node is None:
+            self.node = as_string(data)
+            self.cluster.link_up(self)
+
+    def batch(self, data):
+        end = ORIGIN_HEADER.size + ORIGIN_HEADER.unpack(data[:ORIGIN_HEADER.size])[0]
+        origin = as_string(data[ORIGIN_HEADER.size:end])
+        if origin == self.cluster.node_id:
+            # our own messages, back through a peer which shares our id
+            self.logger.warn('batch from our own node id %s, dropped', origin)
+            return
+        entries = []
+        while end < len(data):
+            start = end + ENTRY_HEADER.size
+            name_size, size = ENTRY_HEADER.unpack(data[end:start])
+            end = start + name_size + size
+            name = as_string(data[start:start + name_size]) or None
+            entries.append((name, data[start + name_size:end]))
+        self.cluster.received(self, entries)
+
+    def readable(self):
+        # held back with the clients while too much is waiting to be sent
+        if asyncore.out_backlog.full():
+            return False
+        return asynchat.async_chat.readable(self)
+
+    def handle_error(self):
+        t, v = sys.exc_info()[:2]
+        if issubclass(t, socket.error):
+            # peers come and go, that needs no traceback
+            self.logger.info('link to %s: %s', self.peer(), v)
+            self.close()
+        else:
+            asynchat.async_chat.handle_error(self)
+
+    def handle_expt(self):
+        self.close()
+
+    def close(self):
+        if self._fileno is None:
+            return
+        asynchat.async_chat.close(self)
+        self.cluster.link_closed(self)
+
+    def log_info(self, message, type='info'):
+        self.logger.log('%s %s' % (type, message))
+
+class cluster_server(asyncore.dispatcher):
+    '''Accepts the links dialed by the other nodes.'''
+
+    def __init__(self, sock, cluster):
+        asyncore.dispatcher.__init__(self)
+        self.set_socket(sock)
+        self.accepting = True
+        self.cluster = cluster
+        self.logger = cluster.logger
+        host, port = sock.getsockname()
+        self.logger.log('cluster links accepted on port %d' % port)
+
+    def readable(self):
+        return self.accepting
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            self.cluster.add_link(peer_channel(self.cluster, pair[0]))
+
+    def log_info(self, message, type='info'):
+        self.logger.log('%s %s' % (type, message))
+
+class Cluster:
+    '''
+    This node's links to the other chatserverd nodes of a cluster, with
+    --cluster-port and --peers.
+
+    Every node keeps a link to each of its peers, redialing the ones it
+    was given when they go away.  The messages of our own clients are
+    sent on once per turn of the loop, in one batch per peer which holds
+    only what the peer has members for: lobby messages, messages to the
+    rooms it subscribed to and to its nicknames.  What comes from a peer
+    goes through the ingress queue with the link as its sender, so it is
+    fanned out here like a local message and never sent on again; with
+    every node linked to every other one, that is all it takes for a
+    message to reach each node once.
+
+    A nickname one of the peers has is not given out here.  When two
+    nodes give out the same one before hearing of each other, the node
+    whose id sorts first keeps it and the other takes it back.
+    '''
+
+    # seconds before a peer that went away is dialed again, doubled up
+    # to max_retry_delay while it stays away
+    retry_delay = 0.5
+    max_retry_delay = 30
+
+    def __init__(self, node_id, peers, helpers):
+        self.node_id = node_id
+        self.origin = ORIGIN_HEADER.pack(len(as_bytes(node_id))) + as_bytes(node_id)
+        self.peers = peers
+        self.helpers = helpers
+        self.logger = helpers.logger
+        self.listener = None
+        self.links = {}         # fd -> peer_channel
+        self.nodes = {}         # node id -> its peer_channels, first one used
+        self.delays = {}        # peer address -> seconds before redialing
+        # subscriptions changed since the last turn, name -> subscribed
+        self.changes = {}
+        self.running = False
+        self.forwarded = 0
+        self.received_messages = 0
+
+    def serve(self, sock):
+        self.listener = cluster_server(sock, self)
+
+    def start(self):
+        self.running = True
+        for address in self.peers:
+            self.dial(address)
+
+    def dial(self, address):
+        if self.running:
+            self.add_link(peer_channel(self, address=address))
+
+    def redial(self, address):
+        delay = self.delays.get(address, self.retry_delay)
+        self.delays[address] = min(delay * 2, self.max_retry_delay)
+        self.helpers.timers.schedule(delay, self.dial, address)
+
+    def add_link(self, link):
+        if link._fileno is not None:
+            self.links[link._fileno] = link
+
+    def link_up(self, link):
+        if link.node == self.node_id:
+            self.logger.error('%r has our own node id %s', link, link.node)
+            link.close()
+            return
+        links = self.nodes.setdefault(link.node, [])
+        if not links:
+            self.logger.info('linked to node %s', link.node)
+        # when both ends dialed, the first link carries the batches
+        links.append(link)
+        if link.address is not None:
+            self.delays.pop(link.address, None)
+
+    def link_closed(self, link):
+        for fd, other in list(self.links.items()):
+            if other is link:
+                del self.links[fd]
+        links = self.nodes.get(link.node)
+        if links is not None and link in links:
+            links.remove(link)
+            if not links:
+                del self.nodes[link.node]
+                self.logger.info('lost node %s', link.node)
+        if link.address is not None and self.running:
+            self.redial(link.address)
+
+    def subscriptions(self):
+        names = []
+        for config, server in self.helpers.chatserver:
+            names.extend(server.rooms.rooms)
+            names.extend(server.nicks.nicks)
+        return names
+
+    # called by the room and nickname registries
+
+    def subscribe(self, name):
+        self.changes[name] = True
+
+    def unsubscribe(self, name):
+        self.changes[name] = False
+
+    def claimed(self, link, names):
+        # what a peer subscribed to; a nickname we gave out as well is
+        # the peer's if its node id sorts first
+        if link.node is None or link.node >= self.node_id:
+            return
+        for name in names:
+            if name.startswith('#'):
+                continue
+            nick = self.helpers.find_target(name)
+            if nick is not None and nick.channel is not None:
+                self.logger.info('nickname %s is taken on node %s too, '
+                                 'giving it up', name, link.node)
+                nick.channel.lose_nick(link.node)
+
+    def knows(self, name):
+        # whether a peer has a client with that nickname
+        for links in self.nodes.values():
+            if name in links[0].names:
+                return True
+        return False
+
+    def forward(self, messages):
+        # messages are the (seq, key, message, target) of one turn
+        links = self.links.values()
+        if self.changes:
+            changes, self.changes = self.changes, {}
+            added = [name for name, on in changes.items() if on]
+            removed = [name for name, on in changes.items() if not on]
+            for link in links:
+                link.unsubscribe(removed)
+                link.subscribe(added)
+        entries = []
+        for seq, key, message, target in messages:
+            if key in self.links or delivered(target):
+                continue
+            name = getattr(target, 'name', None)
+            data = as_bytes(message)
+            head = as_bytes(name or '')
+            entries.append((name, ENTRY_HEADER.pack(len(head), len(data)) + head, data))
+        if not entries:
+            return
+        for links in self.nodes.values():
+            link = links[0]
+            names = link.names
+            batch = [(head, data) for name, head, data in entries
+                     if name is None or name in names]
+            if batch:
+                link.forward(self.origin, batch)
+                self.forwarded += len(batch)
+
+    def received(self, link, entries):
+        # through the ingress queue like local messages, fanned out with
+        # them in the next turn
+        find_target = self.helpers.find_target
+        for name, message in entries:
+            target = None
+            if name is not None:
+                target = find_target(name)
+                if target is None:
+                    # its last member here left meanwhile
+                    continue
+            link.add_data(message, target)
+            self.received_messages += 1
+
+    def close(self):
+        self.running = False
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for link in list(self.links.values()):
+            link.close()
@@ -0,0 +1,231 @@
+import errno
+import socket
+import threading
+import collections
+
+from chatserver.medusa import asyncore_25 as asyncore
+
+# what the loop thread hands a shard
+BATCH, PUSH, CLOSE, STOP = range(4)
+
+class FanoutShard(threading.Thread):
+    '''
+    A fan-out thread and the channels whose fd falls in its shard.  It
+    queues every message of a batch on its own recipients, then writes
+    to each of them once, and keeps a poller of its own for the sockets
+    which could not take everything at once.
+
+    Everything on the output side of its channels happens in this
+    thread: the loop thread hands it messages for one channel (PUSH) and
+    channels to close (CLOSE) through the same queue as the batches, so
+    every recipient gets its messages in the order they were queued.
+    '''
+
+    # longest sleep in poll(); the loop thread wakes a shard up anyway
+    timeout = 1.0
+
+    def __init__(self, index, pool):
+        threading.Thread.__init__(self, name='chatserver-fanout-%d' % index)
+        self.daemon = True
+        self.index = index
+        self.pool = pool
+        self.logger = pool.logger
+        self.inbox = collections.deque()
+        self.writers = {}       # fd -> channel with output left
+        self.failed = []        # channels whose send() failed
+        self.bytes_out = 0
+        # bytes queued less bytes sent since the backlog was last told,
+        # so that its lock is taken once a round and not once a message
+        self.pending = 0
+        self.poller = None
+        self.wakeup = None
+        self.waker = None
+
+    def open(self):
+        # made in the process which runs the loop, after daemonizing
+        self.poller = self.pool.poller_class(self.pool.helpers)
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(0)
+        self.waker.setblocking(0)
+        self.poller.set_interest(self.wakeup.fileno(), True, False)
+
+    def put(self, op, a=None, b=None):
+        self.inbox.append((op, a, b))
+        try:
+            self.waker.send(b'x')
+        except socket.error as why:
+            # a full socketpair has woken the thread already
+            if why.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def run(self):
+        wakeup_fd = self.wakeup.fileno()
+        while 1:
+            try:
+                r, w = self.poller.poll(self.timeout)
+                if wakeup_fd in r:
+                    self.drain_wakeups()
+                for fd in w:
+                    channel = self.writers.get(fd)
+                    if channel is not None:
+                        self.send(channel)
+                running = self.work()
+                self.account()
+                if not running:
+                    return
+            except:
+                nil, t, v, tbinfo = asyncore.compact_traceback()
+                self.logger.error('fan-out thread %d: %s:%s %s',
+                                  self.index, t, v, tbinfo)
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def work(self):
+        inbox = self.inbox
+        index = self.index
+        touched = set()
+        # what came in during the last round makes up this one, and goes
+        # out before what comes in meanwhile is queued: the larger the
+        # load, the more messages each send() takes, as in the loop
+        for i in range(len(inbox)):
+            op, a, b = inbox.popleft()
+            if op == BATCH:
+                for key, data, target in a:
+                    if target.private:
+                        channel = target.channel
+                        if channel is not None and channel.shard is self:
+                            channel.deliver(data)
+                            touched.add(channel)
+                        continue
+                    # a copy, the loop thread goes on joining and parting
+                    for fd, channel in list(target.parts[index].items()):
+                        if fd != key:
+                            channel.deliver(data)
+                            touched.add(channel)
+            elif op == PUSH:
+                a.deliver(b)
+                touched.add(a)
+            elif op == CLOSE:
+                touched.discard(a)
+                self.close_channel(a, b)
+            else:
+                return False
+        for channel in touched:
+            self.send(channel)
+        return True
+
+    def account(self):
+        pending = self.pending
+        if pending:
+            self.pending = 0
+            if pending > 0:
+                asyncore.out_backlog.add(pending)
+            else:
+                asyncore.out_backlog.remove(-pending)
+
+    def send(self, channel):
+        fd = channel._fileno
+        if channel.writing and fd is not None:
+            channel.initiate_send()
+        if channel.writing and channel.ac_out_bytes:
+            if fd not in self.writers:
+                self.writers[fd] = channel
+                self.poller.set_interest(fd, False, True)
+        elif self.writers.get(fd) is channel:
+            del self.writers[fd]
+            self.poller.unregister(fd)
+
+    def send_failed(self, channel):
+        # closed by the loop thread, see FanoutPool.take_failed()
+        channel.writing = False
+        self.failed.append(channel)
+
+    def close_channel(self, channel, fd):
+        if self.writers.get(fd) is channel:
+            del self.writers[fd]
+            self.poller.unregister(fd)
+        channel.discard_output()
+        channel.socket.close()
+
+    def close(self):
+        for sock in (self.wakeup, self.waker):
+            if sock is not None:
+                sock.close()
+        self.wakeup = self.waker = None
+
+
+class FanoutPool:
+    '''
+    The fan-out threads of one chat server, with --fanout-threads.
+
+    The loop thread reads, runs the commands and numbers the messages as
+    before; put() then hands one reference to the batch of a turn of the
+    loop to every shard.  The Python work of queuing a message still
+    holds the GIL, but the send() calls, the bulk of a large fan-out,
+    release it and run on as many cores as there are shards.
+    '''
+
+    # seconds stop() waits for a thread to finish what it was given
+    join_timeout = 5
+
+    def __init__(self, server, threads, poller_class, helpers):
+        self.server = server
+        self.poller_class = poller_class
+        self.helpers = helpers
+        self.logger = helpers.logger
+        self.shards = [FanoutShard(i, self) for i in range(threads)]
+
+    def __len__(self):
+        return len(self.shards)
+
+    def shard_for(self, fd):
+        # the same split as Broadcaster.parts
+        return self.shards[fd % len(self.shards)]
+
+    def start(self):
+        for shard in self.shards:
+            shard.open()
+            shard.start()
+
+    def put(self, messages):
+        # the (seq, key, message, target) drained from the ingress
+        # queue; returns the number of deliveries
+        lobby = self.server.broadcaster
+        batch = []
+        deliveries = 0
+        for seq, key, message, target in messages:
+            if target is None:
+                target = lobby
+            batch.append((key, target.record(message, seq), target))
+            deliveries += target.recipients(key)
+        if batch:
+            for shard in self.shards:
+                shard.put(BATCH, batch)
+        return deliveries
+
+    def take_failed(self):
+        failed = []
+        for shard in self.shards:
+            # the shard may be adding to its list meanwhile
+            n = len(shard.failed)
+            if n:
+                failed.extend(shard.failed[:n])
+                del shard.failed[:n]
+        return failed
+
+    def bytes_out(self):
+        return sum(shard.bytes_out for shard in self.shards)
+
+    def stop(self):
+        for shard in self.shards:
+            if shard.is_alive():
+                shard.put(STOP)
+        for shard in self.shards:
+            if shard.is_alive():
+                shard.join(self.join_timeout)
+            shard.close()
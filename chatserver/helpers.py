@@ -4,15 +4,33 @@ import os
 import sys
 import errno
 import signal
+import fcntl
 
 from chatserver import poller
 from chatserver import logger
+from chatserver.relay import relay_channel
 from chatserver.medusa import asyncore_25 as asyncore
-from chatserver.chat_server import chat_channel
+from chatserver.medusa import text_socket
 from chatserver.chat_server import make_server
+from chatserver.chat_server import FRAMINGS
+from chatserver.backlog import OVERFLOW_STRATEGIES
+from chatserver.timers import TimerWheel, clock
+from chatserver.journal import Journal
+from chatserver.nicks import delivered
+from chatserver import metrics
+from chatserver import cluster
 
 VERSION = '1.0'
 
+# the environment variables which hand the listening sockets of a
+# reloading chatserverd on to the one replacing it
+LISTEN_FD = 'CHATSERVER_LISTEN_FD'
+ADMIN_FD = 'CHATSERVER_ADMIN_FD'
+CLUSTER_FD = 'CHATSERVER_CLUSTER_FD'
+# and its end of the socketpair the two relay messages over until the old
+# one has drained
+BRIDGE_FD = 'CHATSERVER_BRIDGE_FD'
+
 class SignalReceiver:
     def __init__(self):
         self._signals_recvd = []
@@ -35,19 +53,94 @@ class Helpers:
 
     progname = sys.argv[0]
 
+    # seconds a reload waits for the new chatserverd to write the pidfile
+    successor_timeout = 30
+
     def __init__(self):
-        self.poller = poller.Poller(self)
+        self.poller_class = poller.Poller
+        self.poller = self.poller_class(self)
         self.logger = logger.Logger()
+        self.timers = TimerWheel(logger=self.logger)
+        self.metrics = metrics.Metrics(self.timers)
         self.signal_receiver = SignalReceiver()
         self.server_config = {}
         self.server_config['host'] = ''
         self.server_config['port'] = 9001
+        self.server_config['binary'] = False
+        self.server_config['workers'] = 1
+        self.server_config['reuse_port'] = False
+        self.server_config['framing'] = 'raw'
+        self.server_config['high_watermark'] = 1<<22
+        self.server_config['low_watermark'] = 1<<20
+        self.server_config['overflow'] = 'disconnect'
+        self.server_config['max_backlog'] = 1<<28
+        self.server_config['idle_timeout'] = 0
+        self.server_config['keepalive'] = 0
+        self.server_config['engine'] = 'asyncore'
+        self.server_config['history'] = 0
+        self.server_config['journal'] = None
+        self.server_config['journal_segment'] = 1<<26
+        self.server_config['journal_segments'] = 16
+        self.server_config['journal_fsync'] = 1.0
+        self.server_config['admin_port'] = None
+        self.server_config['listen_backlog'] = 1024
+        self.server_config['accept_batch'] = 64
+        self.server_config['max_accept_rate'] = 0
+        self.server_config['max_message_rate'] = 0
+        self.server_config['max_ip_rate'] = 0
+        self.server_config['tcp_nodelay'] = False
+        self.server_config['sndbuf'] = 0
+        self.server_config['rcvbuf'] = 0
+        self.server_config['drain_timeout'] = 30
+        self.server_config['fanout_threads'] = 0
+        self.server_config['cluster_port'] = None
+        self.server_config['peers'] = []
+        self.server_config['node_id'] = None
+        self.chatserver = []
+        self.relay = None
+        # the relay to the chatserverd at the other end of a reload,
+        # until the old one exits
+        self.bridge = None
+        # the asyncio engine, None while the medusa loop is used
+        self.engine = None
+        self.journal = None
+        # the FanoutPool of --fanout-threads
+        self.fanout = None
+        # the links to the other nodes with --cluster-port or --peers
+        self.cluster = None
+        # the listener of the admin port, once it is open
+        self.admin = None
+        # which of the --workers this process is, it is served on
+        # admin_port + worker_number
+        self.worker_number = 0
+        # the new chatserverd started by a reload, until it is up
+        self.successor = None
+        self.successor_status = None
+        self.successor_deadline = None
         self.umask = 22
         self.pidfile = '/tmp/chatserver.pid'
 
     def usage(self, msg):
         self.stderr.write("Error: %s\n" % str(msg))
-        self.stderr.write("Please use %s --port=<port>\n" % self.progname)
+        self.stderr.write("Please use %s --port=<port> [--binary] [--workers=<n>] "
+                          "[--loglevel=<level>] [--framing=raw|line|length] "
+                          "[--poller=%s] [--high-watermark=<bytes>] "
+                          "[--low-watermark=<bytes>] [--overflow=%s] "
+                          "[--max-backlog=<bytes>] [--idle-timeout=<seconds>] "
+                          "[--keepalive=<seconds>] [--engine=asyncore|asyncio|uvloop] "
+                          "[--history=<n>] [--journal=<directory>] "
+                          "[--journal-segment=<bytes>] [--journal-segments=<n>] "
+                          "[--journal-fsync=<seconds>|never] [--admin-port=<port>] "
+                          "[--listen-backlog=<n>] [--accept-batch=<n>] "
+                          "[--max-accept-rate=<n>] [--max-message-rate=<n>] "
+                          "[--max-ip-rate=<n>] [--tcp-nodelay] "
+                          "[--sndbuf=<bytes>] [--rcvbuf=<bytes>] "
+                          "[--drain-timeout=<seconds>] [--fanout-threads=<n>] "
+                          "[--cluster-port=<port>] [--peers=<host:port>[,...]] "
+                          "[--node-id=<id>] [--pidfile=<path>]\n" % (
+                              self.progname,
+                              '|'.join(sorted(poller.pollers)),
+                              '|'.join(OVERFLOW_STRATEGIES)))
         self.exit(2)
 
     def getopts(self):
@@ -60,7 +153,32 @@ class Helpers:
 
         # Call getopt
         try:
-            options, a = getopt.getopt(args, 'p', ["port="])
+            options, a = getopt.getopt(args, 'p', ["port=", "binary",
+                                                   "workers=", "loglevel=",
+                                                   "framing=", "poller=",
+                                                   "high-watermark=",
+                                                   "low-watermark=",
+                                                   "overflow=",
+                                                   "max-backlog=",
+                                                   "idle-timeout=",
+                                                   "keepalive=",
+                                                   "engine=", "history=",
+                                                   "journal=",
+                                                   "journal-segment=",
+                                                   "journal-segments=",
+                                                   "journal-fsync=",
+                                                   "admin-port=",
+                                                   "listen-backlog=",
+                                                   "accept-batch=",
+                                                   "max-accept-rate=",
+                                                   "max-message-rate=",
+                                                   "max-ip-rate=",
+                                                   "tcp-nodelay",
+                                                   "sndbuf=", "rcvbuf=",
+                                                   "drain-timeout=",
+                                                   "fanout-threads=",
+                                                   "cluster-port=", "peers=",
+                                                   "node-id=", "pidfile="])
         except getopt.error as exc:
             self.usage(repr(exc))
 
@@ -69,13 +187,174 @@ class Helpers:
             if opt == '--port':
                 self.server_config['port'] = int(val)
                 is_valid = True
+            elif opt == '--binary':
+                self.server_config['binary'] = True
+            elif opt == '--workers':
+                try:
+                    self.server_config['workers'] = int(val)
+                except ValueError:
+                    self.usage("invalid number of workers %s" % val)
+                if self.server_config['workers'] < 1:
+                    self.usage("invalid number of workers %s" % val)
+            elif opt == '--loglevel':
+                level = logger.getLevelNumByDescription(val)
+                if level is None:
+                    self.usage("invalid log level %s" % val)
+                self.logger.level = level
+            elif opt == '--poller':
+                if val not in poller.pollers:
+                    self.usage("unsupported poller %s" % val)
+                # drop the default backend's kernel object before replacing it
+                self.poller.before_daemonize()
+                self.poller_class = poller.pollers[val]
+                self.poller = self.poller_class(self)
+            elif opt == '--framing':
+                if val not in FRAMINGS:
+                    self.usage("invalid framing %s" % val)
+                self.server_config['framing'] = val
+            elif opt in ('--high-watermark', '--low-watermark', '--max-backlog'):
+                key = opt[2:].replace('-', '_')
+                try:
+                    self.server_config[key] = int(val)
+                except ValueError:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+                if self.server_config[key] < 1:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+            elif opt in ('--idle-timeout', '--keepalive', '--drain-timeout'):
+                key = opt[2:].replace('-', '_')
+                try:
+                    self.server_config[key] = float(val)
+                except ValueError:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+                if self.server_config[key] < 0:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+            elif opt == '--history':
+                try:
+                    self.server_config['history'] = int(val)
+                except ValueError:
+                    self.usage("invalid history size %s" % val)
+                if self.server_config['history'] < 0:
+                    self.usage("invalid history size %s" % val)
+            elif opt == '--journal':
+                self.server_config['journal'] = os.path.abspath(val)
+            elif opt in ('--journal-segment', '--journal-segments'):
+                key = opt[2:].replace('-', '_')
+                try:
+                    self.server_config[key] = int(val)
+                except ValueError:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+                if self.server_config[key] < 1:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+            elif opt == '--journal-fsync':
+                if val == 'never':
+                    self.server_config['journal_fsync'] = None
+                else:
+                    try:
+                        self.server_config['journal_fsync'] = float(val)
+                    except ValueError:
+                        self.usage("invalid journal-fsync %s" % val)
+            elif opt == '--admin-port':
+                try:
+                    self.server_config['admin_port'] = int(val)
+                except ValueError:
+                    self.usage("invalid admin port %s" % val)
+            elif opt in ('--listen-backlog', '--accept-batch'):
+                key = opt[2:].replace('-', '_')
+                try:
+                    self.server_config[key] = int(val)
+                except ValueError:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+                if self.server_config[key] < 1:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+            elif opt in ('--sndbuf', '--rcvbuf', '--fanout-threads'):
+                key = opt[2:].replace('-', '_')
+                try:
+                    self.server_config[key] = int(val)
+                except ValueError:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+                if self.server_config[key] < 0:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+            elif opt in ('--max-accept-rate', '--max-message-rate',
+                         '--max-ip-rate'):
+                key = opt[2:].replace('-', '_')
+                try:
+                    self.server_config[key] = float(val)
+                except ValueError:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+                if self.server_config[key] < 0:
+                    self.usage("invalid %s %s" % (opt[2:], val))
+            elif opt == '--tcp-nodelay':
+                self.server_config['tcp_nodelay'] = True
+            elif opt == '--cluster-port':
+                try:
+                    self.server_config['cluster_port'] = int(val)
+                except ValueError:
+                    self.usage("invalid cluster port %s" % val)
+            elif opt == '--peers':
+                try:
+                    self.server_config['peers'] = cluster.parse_peers(val)
+                except ValueError as why:
+                    self.usage(why.args[0])
+            elif opt == '--node-id':
+                if not 0 < len(val) < 256 or len(val.split()) != 1:
+                    self.usage("invalid node id %s" % val)
+                self.server_config['node_id'] = val
+            elif opt == '--pidfile':
+                self.pidfile = os.path.abspath(val)
+            elif opt == '--engine':
+                self.server_config['engine'] = val
+            elif opt == '--overflow':
+                if val not in OVERFLOW_STRATEGIES:
+                    self.usage("invalid overflow strategy %s" % val)
+                self.server_config['overflow'] = val
 
         if not is_valid:
             self.usage("invalid options")
 
+        if self.server_config['framing'] == 'length':
+            # length headers are binary, they must not go through utf-8
+            self.server_config['binary'] = True
+
+        if self.server_config['low_watermark'] > self.server_config['high_watermark']:
+            self.usage("the low watermark must not be above the high watermark")
+
+        if self.server_config['journal'] and self.server_config['workers'] > 1:
+            # every worker would write the relayed messages again
+            self.usage("--journal cannot be used with --workers")
+
+        clustered = (self.server_config['cluster_port'] is not None or
+                     self.server_config['peers'])
+        if clustered and self.server_config['workers'] > 1:
+            # the workers are linked through the master instead
+            self.usage("--cluster-port and --peers cannot be used with --workers")
+        if clustered and self.server_config['node_id'] is None:
+            self.server_config['node_id'] = '%s:%d' % (
+                socket.gethostname(), self.server_config['port'])
+
+        engine = self.server_config['engine']
+        if engine != 'asyncore' and self.server_config['fanout_threads']:
+            self.usage("--fanout-threads needs the asyncore engine")
+        if engine != 'asyncore' and clustered:
+            self.usage("--cluster-port and --peers need the asyncore engine")
+        if engine != 'asyncore':
+            try:
+                from chatserver import aio
+            except (ImportError, SyntaxError):
+                self.usage("the %s engine needs Python 3" % engine)
+            if engine not in aio.ENGINES:
+                self.usage("unknown engine %s" % engine)
+            if engine == 'uvloop':
+                try:
+                    import uvloop
+                except ImportError:
+                    self.usage("uvloop is not installed")
+            self.engine = aio.aio_engine(self, engine)
+
     def daemonize(self):
         self.poller.before_daemonize()
+        self.logger.before_fork()
         self._daemonize()
+        self.logger.after_fork()
         self.poller.after_daemonize()
 
     def _daemonize(self):
@@ -106,8 +385,17 @@ class Helpers:
         else:
             self.logger.log('chatserverd started with pid %s' % pid)
 
+    def read_pidfile(self):
+        try:
+            with open(self.pidfile) as f:
+                return int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
     def cleanup(self):
-        self._try_unlink(self.pidfile)
+        # after a reload the pidfile is the new chatserverd's
+        if self.read_pidfile() in (None, os.getpid()):
+            self._try_unlink(self.pidfile)
 
     def _try_unlink(self, path):
         try:
@@ -117,18 +405,37 @@ class Helpers:
 
     def close_chatserver(self):
         dispatcher_servers = []
-        server = self.chatserver
-        server.close()
+        for config, server in self.chatserver:
+            server.close()
 
-        # server._map is a reference to the asyncore socket_map
-        for dispatcher in self.get_socket_map().values():
-            dispatcher_server = getattr(dispatcher, 'server', None)
-            if dispatcher_server is server:
-                dispatcher_servers.append(dispatcher)
+            # server._map is a reference to the asyncore socket_map
+            for dispatcher in list(self.get_socket_map().values()):
+                dispatcher_server = getattr(dispatcher, 'server', None)
+                if dispatcher_server is server:
+                    dispatcher_servers.append(dispatcher)
 
         for server in dispatcher_servers:
             server.close()
 
+        if self.fanout is not None:
+            # after the channels, whose sockets the threads close
+            self.fanout.stop()
+            self.fanout = None
+
+        if self.relay is not None:
+            self.relay.close()
+
+        self.close_bridge()
+        self.close_cluster()
+
+        if self.journal is not None:
+            self.journal.close()
+            self.set_journal(None)
+
+        if self.admin is not None:
+            self.admin.close()
+            self.admin = None
+
     def close_logger(self):
         self.logger.close()
 
@@ -146,6 +453,7 @@ class Helpers:
 
     def openchatserver(self, chatserverd):
         try:
+            self.open_journal()
             self.chatserver = self.make_chat_server()
         except socket.error as why:
             if why.args[0] == errno.EADDRINUSE:
@@ -165,21 +473,372 @@ class Helpers:
         except ValueError as why:
             self.usage(why.args[0])
 
+    def open_journal(self):
+        config = self.server_config
+        if not config['journal'] or self.journal is not None:
+            return
+        try:
+            self.set_journal(self.new_journal())
+        except (IOError, OSError) as why:
+            self.usage('cannot open journal %s: %s' % (config['journal'], why))
+        # message numbers carry on from the journal
+        asyncore.data_queue.seq = self.journal.last_seq
+
+    def new_journal(self):
+        config = self.server_config
+        journal = Journal(config['journal'],
+                          segment_bytes=config['journal_segment'],
+                          max_segments=config['journal_segments'],
+                          fsync_interval=config['journal_fsync'],
+                          logger=self.logger)
+        journal.open()
+        return journal
+
+    def set_journal(self, journal):
+        self.journal = self.metrics.journal = journal
+        for config, server in self.chatserver:
+            server.journal = journal
+
+    def open_admin(self):
+        port = self.server_config['admin_port']
+        if port is None or self.admin is not None:
+            return
+        port += self.worker_number
+        sock = self.inherited_socket(ADMIN_FD, True)
+        if sock is None:
+            try:
+                sock = metrics.listen(self.server_config['host'], port,
+                                      reuse_port=self.server_config['reuse_port'])
+            except socket.error as why:
+                self.usage('cannot open admin port %d: %s' % (port, why))
+        else:
+            sock.setblocking(0)
+        if self.engine is not None:
+            # served once the engine's event loop runs
+            self.admin = sock
+        else:
+            self.admin = metrics.metrics_server(sock, self.metrics, self.logger)
+
+    def open_cluster(self):
+        port = self.server_config['cluster_port']
+        peers = self.server_config['peers']
+        if self.cluster is not None or (port is None and not peers):
+            return
+        self.cluster = cluster.Cluster(self.server_config['node_id'], peers, self)
+        if port is not None:
+            sock = self.inherited_socket(CLUSTER_FD, True)
+            if sock is None:
+                try:
+                    sock = cluster.listen(self.server_config['host'], port)
+                except socket.error as why:
+                    self.usage('cannot open cluster port %d: %s' % (port, why))
+            else:
+                sock.setblocking(0)
+            self.cluster.serve(sock)
+        for config, server in self.chatserver:
+            server.cluster = self.cluster
+            server.rooms.watcher = server.nicks.watcher = self.cluster
+        self.metrics.cluster = self.cluster
+
+    def close_cluster(self):
+        if self.cluster is None:
+            return
+        self.cluster.close()
+        self.cluster = None
+        for config, server in self.chatserver:
+            server.cluster = None
+            server.rooms.watcher = server.nicks.watcher = None
+
+    def inherited_socket(self, name, binary, family=socket.AF_INET):
+        fd = os.environ.pop(name, None)
+        if not fd:
+            return None
+        return text_socket.fromfd(int(fd), family, binary=binary)
+
+    def inherited_listener(self, binary):
+        '''the chat listener handed over by a reload, None if there is none'''
+        return self.inherited_socket(LISTEN_FD, binary)
+
+    def inherited_bridge(self):
+        '''our end of the bridge to the chatserverd we replace, if any'''
+        return self.inherited_socket(BRIDGE_FD, True, socket.AF_UNIX)
+
+    def open_bridge(self, sock, on_message=None, map=None):
+        '''
+        Relay messages to and from the chatserverd at the other end of a
+        reload, so the clients of the old one and of the new one keep
+        seeing each other's until the old one has drained.  Each end
+        passes on its own clients' messages and fans out the other's;
+        ChatServerMaster hands them to its workers instead.
+        '''
+        if sock is None:
+            return
+        if self.engine is not None and map is None:
+            self.bridge = self.engine.open_bridge(sock, self.bridge_closed)
+        else:
+            if on_message is None:
+                on_message = self.relay_received
+            self.bridge = relay_channel(sock, self.logger, on_message,
+                                        self.bridge_closed, map=map)
+        for config, server in self.chatserver:
+            server.bridge = self.bridge
+
+    def bridge_closed(self, bridge):
+        if bridge is not self.bridge:
+            return
+        self.bridge = None
+        for config, server in self.chatserver:
+            server.bridge = None
+        self.logger.info('bridge to the other chatserverd closed')
+
+    def close_bridge(self):
+        if self.bridge is not None:
+            self.bridge.close()
+
+    def start_reload(self):
+        '''
+        Fork and exec a new chatserverd with our own arguments and hand it
+        our listeners, so connections keep being accepted while it starts.
+        The journal is closed first, it takes only one writer; the pidfile
+        tells when the new chatserverd is up, see reload_status().  Returns
+        our end of the bridge to it, see open_bridge().
+        '''
+        env = dict(os.environ)
+        fds = []
+        bridge, other_end = socket.socketpair()
+        fds.append(other_end.fileno())
+        env[BRIDGE_FD] = str(fds[-1])
+        for config, server in self.chatserver:
+            fds.append(server.socket.fileno())
+            env[LISTEN_FD] = str(fds[-1])
+        if self.admin is not None:
+            if self.engine is not None:
+                fds.append(self.admin.fileno())
+            else:
+                fds.append(self.admin.socket.fileno())
+            env[ADMIN_FD] = str(fds[-1])
+        if self.cluster is not None and self.cluster.listener is not None:
+            fds.append(self.cluster.listener.socket.fileno())
+            env[CLUSTER_FD] = str(fds[-1])
+        if hasattr(os, 'set_inheritable'):
+            # Python 3 opens every fd close-on-exec, the /dev/null stdio
+            # of the daemon too
+            for fd in [0, 1, 2] + fds:
+                os.set_inheritable(fd, True)
+        argv = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+
+        if self.journal is not None:
+            self.journal.close()
+            self.set_journal(None)
+
+        self.logger.before_fork()
+        try:
+            pid = os.fork()
+        except OSError:
+            self.logger.after_fork()
+            bridge.close()
+            other_end.close()
+            raise
+        if pid == 0:
+            # nothing but the listeners goes across; Python 2 would leave
+            # every client socket open in the new process.  The log file
+            # stays open until the exec, to say why if it fails
+            start = 3
+            for fd in sorted(fds + [self.logger.fd]):
+                os.closerange(start, fd)
+                start = fd + 1
+            os.closerange(start, os.sysconf('SC_OPEN_MAX'))
+            fcntl.fcntl(self.logger.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            try:
+                os.execve(sys.executable, argv, env)
+            except OSError as why:
+                self.logger.error('cannot exec %s: %s', sys.executable, why)
+            finally:
+                try:
+                    self.close_logger()
+                finally:
+                    os._exit(127)
+        self.logger.after_fork()
+        other_end.close()
+        self.successor = pid
+        self.successor_status = None
+        self.successor_deadline = clock() + self.successor_timeout
+        self.logger.info('reloading, started %s as %s', ' '.join(argv), pid)
+        return bridge
+
+    def reload_status(self):
+        '''
+        True once the chatserverd started by start_reload() is up, False if
+        it failed, None while it is starting
+        '''
+        if self.successor_status is None:
+            # its first process exits when it daemonizes
+            try:
+                pid, status = os.waitpid(self.successor, os.WNOHANG)
+            except OSError:
+                # reaped along with the workers
+                pid = 0
+            if pid:
+                self.successor_status = status
+        owner = self.read_pidfile()
+        if owner is not None and owner != os.getpid() and process_exists(owner):
+            self.successor = None
+            return True
+        if self.successor_status or clock() > self.successor_deadline:
+            self.logger.error('the new chatserverd did not start (status %s), '
+                              'carrying on', self.successor_status)
+            self.successor = None
+            if self.server_config['journal']:
+                try:
+                    self.set_journal(self.new_journal())
+                except (IOError, OSError) as why:
+                    self.logger.error('cannot reopen journal %s: %s',
+                                      self.server_config['journal'], why)
+            self.close_bridge()
+            return False
+        return None
+
+    def stop_accepting(self):
+        # the new chatserverd is up; new connections are its own
+        for config, server in self.chatserver:
+            server.stop_accepting()
+        if self.engine is not None:
+            self.engine.close_admin()
+        elif self.admin is not None:
+            self.admin.close()
+            self.admin = None
+        # the peers link up with the new chatserverd, which has the same
+        # node id; two processes sending for it would be one too many
+        self.close_cluster()
+
+    def client_channels(self):
+        channels = []
+        for config, server in self.chatserver:
+            if self.engine is not None:
+                channels.extend(server.channels.values())
+                continue
+            for dispatcher in self.get_socket_map().values():
+                if getattr(dispatcher, 'server', None) is server:
+                    channels.append(dispatcher)
+        return channels
+
     def broadcast_messages(self):
-        for key in asyncore.data_map.keys():
-            message = asyncore.data_map[key]
+        messages = asyncore.data_queue.drain()
+        journal = self.journal
+        if journal is not None:
+            # one write for everything read in this turn of the loop
+            for seq, key, message, target in messages:
+                if target is None or not target.private:
+                    journal.append(seq, getattr(target, 'name', None), message)
+            journal.commit()
+        deliveries = 0
+        fanout = self.fanout
+        if fanout is not None:
+            # numbered here, queued and sent by the fan-out threads
+            deliveries = fanout.put(messages)
+            for channel in fanout.take_failed():
+                channel.close()
+        else:
+            for seq, key, message, target in messages:
+                if target is None:
+                    # a lobby message; self.chatserver is the list of
+                    # (config, server) from make_server
+                    for config, server in self.chatserver:
+                        deliveries += server.broadcaster.fanout(key, message, seq)
+                else:
+                    deliveries += target.fanout(key, message, seq)
+            # one frame per client on the compact protocol
+            for config, server in self.chatserver:
+                if server.batching:
+                    server.flush_batches()
+        self.metrics.messages += len(messages)
+        self.metrics.deliveries += deliveries
+
+        # pass our own clients' messages on to the other workers
+        relay = self.relay
+        if relay is not None and relay.connected:
+            relay_fd = relay._fileno
+            relay.forward([(getattr(target, 'name', None), message)
+                           for seq, key, message, target in messages
+                           if key != relay_fd and not delivered(target)])
+
+        # and everything but what came from there to the other end of a
+        # reload
+        bridge = self.bridge
+        bridge_fd = None
+        if bridge is not None and bridge.connected:
+            bridge_fd = bridge._fileno
+            bridge.forward([(getattr(target, 'name', None), message)
+                            for seq, key, message, target in messages
+                            if key != bridge_fd and not delivered(target)])
+
+        # and to the other nodes of the cluster
+        if self.cluster is not None:
+            if self.successor is not None and bridge_fd is not None:
+                # the new chatserverd passes its clients' messages on to
+                # the cluster itself
+                messages = [(seq, key, message, target)
+                            for seq, key, message, target in messages
+                            if key != bridge_fd]
+            self.cluster.forward(messages)
+
+        # slow consumers found during the fan-out; closing them there
+        # would change the broadcaster while it is being walked
+        for channel in asyncore.out_backlog.take_evictions():
+            channel.close()
+
+    def after_fork(self):
+        # a worker must not share the master's poller or pending signals
+        self.poller = self.poller_class(self)
+        self.signal_receiver = SignalReceiver()
+        self.logger.after_fork()
+
+    def open_relay(self, sock, on_close):
+        if self.engine is not None:
+            self.engine.open_relay(sock, on_close)
+            return
+        self.relay = relay_channel(sock, self.logger,
+                                   self.relay_received, on_close)
+        for config, server in self.chatserver:
+            server.relay = self.relay
+
+    def relay_received(self, relay, room, message):
+        # messages from the other workers go through the ingress queue
+        # like local ones, so they are fanned out in the same batch
+        target = None
+        if room is not None:
+            target = self.find_target(room)
+            if target is None:
+                # nobody connected to this worker is in that room or
+                # has that nickname
+                return
+        relay.add_data(message, target)
+
+    def find_target(self, name):
+        for config, server in self.chatserver:
+            if name.startswith('#'):
+                target = server.rooms.get(name)
+            else:
+                target = server.nicks.get(name)
+            if target is not None:
+                return target
+        return None
 
-            for fd in asyncore.socket_map.keys():
-                dp = asyncore.socket_map[fd]
-                # self.logger.log("%d, %d" % (key, fd) + "\n")
-                if fd != key and isinstance(dp, chat_channel):
-                    dp.push_data(message)
+    def has_pending_messages(self):
+        return len(asyncore.data_queue) > 0 or len(asyncore.out_backlog.evictions) > 0
 
     def get_socket_map(self):
         return asyncore.socket_map
 
-    def clear_data_map(self):
-        asyncore.data_map.clear()
-
     def make_chat_server(self):
-        return make_server(self)
\ No newline at end of file
+        if self.engine is not None:
+            from chatserver import aio
+            return aio.make_server(self)
+        return make_server(self)
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as why:
+        return why.args[0] == errno.EPERM
+    return True
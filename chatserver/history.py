@@ -0,0 +1,51 @@
+import collections
+
+class History:
+    '''
+    Bounded ring of the most recent messages fanned out to a lobby or a
+    room, kept exactly as they went out on the wire, so a replay is a
+    join of stored frames and nothing is encoded or framed again.
+
+    Frames are kept with their message numbers.  floor is the number
+    before the oldest message the ring can answer for, so covers() tells
+    whether a replay from the ring is complete or has to go to the
+    journal.
+    '''
+
+    def __init__(self, max_messages=100, max_bytes=1<<20):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.frames = collections.deque()
+        self.nbytes = 0
+        self.floor = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def append(self, seq, frame):
+        frames = self.frames
+        if self.floor is None:
+            # nothing from before this message was ever kept
+            self.floor = seq - 1
+        frames.append((seq, frame))
+        self.nbytes += len(frame)
+        while len(frames) > self.max_messages or self.nbytes > self.max_bytes:
+            seq, frame = frames.popleft()
+            self.nbytes -= len(frame)
+            self.floor = seq
+
+    def covers(self, seq):
+        return self.floor is not None and seq >= self.floor
+
+    def since(self, seq=0, numbered=False):
+        '''
+        the frames after message number seq, as many as are kept, or
+        their (number, frame) if numbered
+        '''
+        frames = []
+        for item in reversed(self.frames):
+            if item[0] <= seq:
+                break
+            frames.append(numbered and item or item[1])
+        frames.reverse()
+        return frames
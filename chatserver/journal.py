@@ -0,0 +1,286 @@
+import os
+import mmap
+import time
+import errno
+import struct
+import bisect
+
+from chatserver.compat import as_bytes
+
+# every record is its payload length, its message number and the length
+# of the room name (0 for the lobby), then the room name and the payload
+RECORD = struct.Struct('!IQB')
+
+SEGMENT_SUFFIX = '.journal'
+
+class Segment:
+    '''
+    One journal file, named after the number of its first message, with
+    a sparse index of (message number, offset) pairs taken every
+    index_every bytes.  Reads go through an mmap of the file which is
+    only remapped once the file has grown past it.
+    '''
+
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.path = os.path.join(directory, '%020d%s' % (first_seq, SEGMENT_SUFFIX))
+        self.size = 0
+        self.index_seqs = []
+        self.index_offsets = []
+        self.indexed_to = None  # offset of the last index entry
+        self.map = None
+        self.mapped = 0
+
+    def add_index(self, seq, offset, index_every):
+        if self.indexed_to is None or offset - self.indexed_to >= index_every:
+            self.index_seqs.append(seq)
+            self.index_offsets.append(offset)
+            self.indexed_to = offset
+
+    def scan(self, index_every):
+        # rebuild the index of a segment written by an earlier run, and
+        # cut off a record torn by a crash in the middle of a write
+        size = os.path.getsize(self.path)
+        if size:
+            with open(self.path, 'rb') as f:
+                view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    offset = 0
+                    while offset + RECORD.size <= size:
+                        length, seq, room_length = RECORD.unpack_from(view, offset)
+                        end = offset + RECORD.size + room_length + length
+                        if end > size:
+                            break
+                        self.add_index(seq, offset, index_every)
+                        self.last_seq = seq
+                        offset = end
+                finally:
+                    view.close()
+            if offset != size:
+                with open(self.path, 'r+b') as f:
+                    f.truncate(offset)
+            size = offset
+        self.size = size
+
+    def view(self):
+        if self.map is None or self.mapped < self.size:
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped = self.size
+        return self.map
+
+    def read_since(self, seq, room):
+        # (number, payload) of the messages to room after seq, one at a
+        # time so that Journal.read_since() can stop early
+        mm = self.view()
+        try:
+            buf = memoryview(mm)
+        except TypeError:
+            # no buffer interface on Python 2's mmap; slices are copies
+            buf = mm
+        i = bisect.bisect_right(self.index_seqs, seq + 1) - 1
+        offset = i >= 0 and self.index_offsets[i] or 0
+        end_of_data = self.mapped
+        while offset + RECORD.size <= end_of_data:
+            length, rseq, room_length = RECORD.unpack_from(mm, offset)
+            start = offset + RECORD.size + room_length
+            offset = start + length
+            if rseq <= seq:
+                continue
+            if mm[start - room_length:start] == room:
+                yield rseq, buf[start:offset]
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # replays queued on slow clients still refer to it
+                pass
+            self.map = None
+
+
+class Journal:
+    '''
+    Append-only log of every message fanned out, kept as segment files
+    in one directory.
+
+    Messages are appended during a turn of the event loop and written
+    with one write() by commit(), which the loop calls once per turn;
+    fsync_interval is how many seconds may pass between fsyncs (0 for
+    one after every commit, None to leave it to the kernel).  A segment
+    is closed once it holds segment_bytes, and only the newest
+    max_segments are kept.
+
+    A write or fsync which fails once the journal is open (ENOSPC, EIO)
+    does not take the server down: what the failed write left behind is
+    cut off, the error is logged and counted in errors, and the journal
+    is disabled, so that messages go on being fanned out without it.
+    What it had written can still be read.
+    '''
+
+    index_every = 1<<16
+
+    def __init__(self, directory, segment_bytes=1<<26, max_segments=16,
+                 fsync_interval=1.0, logger=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync_interval = fsync_interval
+        self.logger = logger
+        self.segments = []
+        self.fd = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.unsynced = False
+        self.last_sync = time.time()
+        self.last_seq = 0
+        self.errors = 0
+        self.disabled = False
+
+    def open(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as why:
+            if why.args[0] != errno.EEXIST:
+                raise
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = Segment(self.directory, int(name[:-len(SEGMENT_SUFFIX)]))
+            segment.scan(self.index_every)
+            self.segments.append(segment)
+        if self.segments:
+            self.last_seq = self.segments[-1].last_seq
+            self.open_segment(self.segments[-1])
+        else:
+            self.rotate()
+        self.log('journal %s opened at message %d' % (self.directory, self.last_seq))
+
+    def open_segment(self, segment):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def append(self, seq, room, data):
+        if self.disabled:
+            return
+        segment = self.segments[-1]
+        room = as_bytes(room or '')
+        data = as_bytes(data)
+        segment.add_index(seq, segment.size + self.pending_bytes, self.index_every)
+        header = RECORD.pack(len(data), seq, len(room)) + room
+        self.pending.append(header)
+        self.pending.append(data)
+        self.pending_bytes += len(header) + len(data)
+        segment.last_seq = self.last_seq = seq
+
+    def commit(self):
+        if self.disabled:
+            return
+        try:
+            if self.pending:
+                data = b''.join(self.pending)
+                self.pending = []
+                self.pending_bytes = 0
+                written = 0
+                try:
+                    while written < len(data):
+                        written += os.write(self.fd, data[written:])
+                except OSError:
+                    if written:
+                        self.truncate()
+                    raise
+                self.segments[-1].size += written
+                self.unsynced = True
+                if self.segments[-1].size >= self.segment_bytes:
+                    self.rotate()
+            if self.unsynced and self.fsync_interval is not None:
+                now = time.time()
+                if now - self.last_sync >= self.fsync_interval:
+                    os.fsync(self.fd)
+                    self.unsynced = False
+                    self.last_sync = now
+        except OSError as why:
+            self.disable(why)
+
+    def truncate(self):
+        # back to the last whole record, so that no torn one is left
+        # for the next scan() or read_since() to stumble on
+        try:
+            os.ftruncate(self.fd, self.segments[-1].size)
+        except OSError:
+            pass
+
+    def disable(self, why):
+        self.errors += 1
+        self.disabled = True
+        self.pending = []
+        self.pending_bytes = 0
+        self.unsynced = False
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+        if self.logger is not None:
+            self.logger.error('journal %s disabled after an error: %s',
+                              self.directory, why)
+
+    def rotate(self):
+        if self.fd is not None and self.unsynced:
+            os.fsync(self.fd)
+            self.unsynced = False
+        segment = Segment(self.directory, self.last_seq + 1)
+        self.segments.append(segment)
+        self.open_segment(segment)
+        while len(self.segments) > self.max_segments:
+            old = self.segments.pop(0)
+            old.close()
+            try:
+                os.unlink(old.path)
+            except OSError:
+                pass
+            self.log('journal segment %s retired' % old.path)
+
+    def read_since(self, seq, room=None, numbered=False, limit=0, max_bytes=0):
+        '''
+        the payloads of the messages to room (None for the lobby) after
+        message number seq, as views onto the mapped segments, or their
+        (number, payload) if numbered; at most limit of them and not
+        much more than max_bytes, where those are given
+        '''
+        room = as_bytes(room or '')
+        frames = []
+        nbytes = 0
+        firsts = [segment.first_seq for segment in self.segments]
+        start = max(0, bisect.bisect_right(firsts, seq + 1) - 1)
+        for segment in self.segments[start:]:
+            if not segment.size or segment.last_seq <= seq:
+                continue
+            for rseq, frame in segment.read_since(seq, room):
+                frames.append(numbered and (rseq, frame) or frame)
+                nbytes += len(frame)
+                if len(frames) == limit or (max_bytes and nbytes >= max_bytes):
+                    return frames
+        return frames
+
+    def close(self):
+        self.commit()
+        if self.fd is not None:
+            try:
+                if self.unsynced:
+                    os.fsync(self.fd)
+            except OSError as why:
+                self.disable(why)
+            else:
+                os.close(self.fd)
+                self.fd = None
+        for segment in self.segments:
+            segment.close()
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.log(message)
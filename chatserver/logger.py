@@ -1,14 +1,170 @@
+import os
+import threading
+import collections
+
+from chatserver.compat import as_bytes, long, basestring
+
+# format arguments which cannot change before the writer gets to them
+SCALARS = (int, long, float, basestring, bytes, type(None))
+
+class LevelsByName:
+	CRIT = 50
+	ERRO = 40
+	WARN = 30
+	INFO = 20
+	DEBG = 10
+	TRAC = 5
+
+def getLevelNumByDescription(description):
+	levels = {
+		'critical': LevelsByName.CRIT,
+		'error': LevelsByName.ERRO,
+		'warn': LevelsByName.WARN,
+		'info': LevelsByName.INFO,
+		'debug': LevelsByName.DEBG,
+		'trace': LevelsByName.TRAC,
+		}
+	return levels.get(description.lower())
+
 class Logger:
-	def __init__(self):
-		self.log_file = '/tmp/chatserver.log'
-		self.stream = open(self.log_file, 'a')
+	"""
+	Log records are queued in a bounded in-memory ring and written out in
+	batches by a background thread, so the event loop never blocks on the
+	log file.  Formatting is deferred to the writer thread as well: pass
+	the format arguments separately, e.g. logger.trace('read %s', n).
+	That only holds for numbers, strings and None; a record with any other
+	argument, a channel for %r say, is formatted when it is logged, since
+	the object may have changed, or be changing in another thread, by the
+	time the writer gets to it.  When the writer falls behind, the oldest
+	records are dropped and the number lost is written to the log once it
+	catches up.
+	"""
+
+	def __init__(self, log_file='/tmp/chatserver.log', level=LevelsByName.INFO,
+			max_records=10000, flush_records=256, flush_interval=0.5):
+		self.log_file = log_file
+		self.level = level
+		self.max_records = max_records
+		self.flush_records = flush_records
+		self.flush_interval = flush_interval
+		self.fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
 		self.closed = False
+		self.dropped = 0
+		self.reported_dropped = 0
+		self._start()
+
+	def _start(self):
+		self.records = collections.deque()
+		self.cond = threading.Condition()
+		self.stopping = False
+		self.thread = threading.Thread(target=self._run, name='chatserver-logger')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _stop(self):
+		with self.cond:
+			self.stopping = True
+			self.cond.notify()
+		self.thread.join()
+		self.flush()
+
+	def _run(self):
+		while 1:
+			with self.cond:
+				if not self.stopping and len(self.records) < self.flush_records:
+					self.cond.wait(self.flush_interval)
+				stopping = self.stopping
+			self.flush()
+			if stopping:
+				return
+
+	def _emit(self, message, args):
+		for arg in args:
+			if not isinstance(arg, SCALARS):
+				message = self.format(message, args)
+				args = ()
+				break
+		records = self.records
+		if len(records) >= self.max_records:
+			# the writer is behind, make room by losing the oldest record;
+			# the fan-out threads log too
+			with self.cond:
+				try:
+					records.popleft()
+				except IndexError:
+					pass
+				self.dropped += 1
+		records.append((message, args))
+		if len(records) == self.flush_records:
+			with self.cond:
+				self.cond.notify()
+
+	def format(self, message, args):
+		if args:
+			try:
+				message = message % args
+			except (TypeError, ValueError):
+				message = '%s %r' % (message, args)
+		if message.endswith('\n'):
+			message = message[:-1]
+		return message
+
+	def flush(self):
+		lines = []
+		records = self.records
+		while records:
+			try:
+				message, args = records.popleft()
+			except IndexError:
+				break
+			lines.append(self.format(message, args))
+
+		dropped = self.dropped
+		if dropped != self.reported_dropped:
+			lines.append('logger overflow: %d records dropped so far'
+					% dropped)
+			self.reported_dropped = dropped
+
+		if lines:
+			data = as_bytes('\n'.join(lines) + '\n')
+			while data:
+				data = data[os.write(self.fd, data):]
+
+	def critical(self, message, *args):
+		if self.level <= LevelsByName.CRIT:
+			self._emit(message, args)
+
+	def error(self, message, *args):
+		if self.level <= LevelsByName.ERRO:
+			self._emit(message, args)
+
+	def warn(self, message, *args):
+		if self.level <= LevelsByName.WARN:
+			self._emit(message, args)
+
+	def info(self, message, *args):
+		if self.level <= LevelsByName.INFO:
+			self._emit(message, args)
+
+	log = info
+
+	def debug(self, message, *args):
+		if self.level <= LevelsByName.DEBG:
+			self._emit(message, args)
+
+	def trace(self, message, *args):
+		if self.level <= LevelsByName.TRAC:
+			self._emit(message, args)
+
+	def before_fork(self):
+		# no thread may hold our lock across fork()
+		self._stop()
 
-	def log(self, message):
-		self.stream.write(message + "\n")
-		self.stream.flush()
+	def after_fork(self):
+		self._start()
 
 	def close(self):
 		if not self.closed:
-			self.stream.close()
-			self.closed = True
\ No newline at end of file
+			self._stop()
+			os.close(self.fd)
+			self.closed = True
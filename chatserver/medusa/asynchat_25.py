@@ -46,23 +46,45 @@ method) up to the terminator, and then control will be returned to
 you - by calling your self.found_terminator() method.
 """
 
+import os
 import socket
+import collections
 from chatserver.medusa import asyncore_25 as asyncore
-from chatserver.compat import long
+from chatserver.compat import long, as_bytes
+
+# most chunks handed to a single sendmsg()
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
 
 class async_chat (asyncore.dispatcher):
     """This is an abstract class.  You must derive from this class, and add
     the two methods collect_incoming_data() and found_terminator()"""
 
+    __slots__ = ('ac_in_buffer', 'ac_out_buffer', 'ac_out_offset',
+                 'ac_out_bytes', 'producer_fifo', 'terminator')
+
     # these are overridable defaults
 
     ac_in_buffer_size       = 4096
     ac_out_buffer_size      = 4096
 
+    # the empty input buffer; set it to b'' to work on bytes under Python 3
+    ac_in_empty             = ''
+
     def __init__ (self, conn=None, map=None):
-        self.ac_in_buffer = ''
-        self.ac_out_buffer = ''
-        self.producer_fifo = fifo()
+        self.ac_in_buffer = self.ac_in_empty
+        # the output buffer is a queue of bytes chunks; ac_out_offset is
+        # how much of the first chunk has already been sent, so a partial
+        # send never copies the backlog.  The queue, and the fifo for
+        # producers, are only there while something is queued: an idle
+        # channel has the shared empty tuple instead
+        self.ac_out_buffer = EMPTY
+        self.ac_out_offset = 0
+        self.ac_out_bytes = 0
+        self.producer_fifo = EMPTY
+        self.terminator = None
         asyncore.dispatcher.__init__ (self, conn, map)
 
     def collect_incoming_data(self, data):
@@ -91,30 +113,54 @@ class async_chat (asyncore.dispatcher):
             self.handle_error()
             return
 
-        self.ac_in_buffer += data
-
-        # Continue to search for self.terminator in self.ac_in_buffer,
-        # while calling self.collect_incoming_data.  The while loop
-        # is necessary because we might read several data+terminator
-        # combos with a single recv(1024).
+        if not data:
+            # the connection was closed
+            return
 
-        while self.ac_in_buffer:
-            lb = len(self.ac_in_buffer)
+        if self.ac_in_buffer:
+            buf = self.ac_in_buffer + data
+        else:
+            buf = data
+        self.process_input (buf)
+
+    def input_paused (self):
+        """whether to stop framing what has been read, keeping the rest
+        in ac_in_buffer until process_input() is called on it again"""
+        return False
+
+    def process_input (self, buf):
+        lb = len(buf)
+
+        # Continue to search for self.terminator in buf, while calling
+        # self.collect_incoming_data.  The loop is necessary because we
+        # might read several data+terminator combos with a single recv().
+        # 'start' is how far into buf we have got: each frame is sliced
+        # out once and the leftover is kept once at the end, instead of
+        # re-slicing the whole remaining buffer after every frame.
+
+        start = 0
+        while start < lb:
+            if self.input_paused():
+                self.ac_in_buffer = buf[start:]
+                return
             terminator = self.get_terminator()
             if not terminator:
                 # no terminator, collect it all
-                self.collect_incoming_data (self.ac_in_buffer)
-                self.ac_in_buffer = ''
+                if start:
+                    self.collect_incoming_data (buf[start:])
+                else:
+                    self.collect_incoming_data (buf)
+                start = lb
             elif isinstance(terminator, int) or isinstance(terminator, long):
                 # numeric terminator
                 n = terminator
-                if lb < n:
-                    self.collect_incoming_data (self.ac_in_buffer)
-                    self.ac_in_buffer = ''
-                    self.terminator -= lb
+                if lb - start < n:
+                    self.collect_incoming_data (buf[start:])
+                    self.terminator -= lb - start
+                    start = lb
                 else:
-                    self.collect_incoming_data (self.ac_in_buffer[:n])
-                    self.ac_in_buffer = self.ac_in_buffer[n:]
+                    self.collect_incoming_data (buf[start:start+n])
+                    start += n
                     self.terminator = 0
                     self.found_terminator()
             else:
@@ -126,28 +172,32 @@ class async_chat (asyncore.dispatcher):
                 # 3) end of buffer does not match any prefix:
                 #    collect data
                 terminator_len = len(terminator)
-                index = self.ac_in_buffer.find(terminator)
+                index = buf.find(terminator, start)
                 if index != -1:
                     # we found the terminator
-                    if index > 0:
+                    if index > start:
                         # don't bother reporting the empty string (source of subtle bugs)
-                        self.collect_incoming_data (self.ac_in_buffer[:index])
-                    self.ac_in_buffer = self.ac_in_buffer[index+terminator_len:]
+                        self.collect_incoming_data (buf[start:index])
+                    start = index + terminator_len
                     # This does the Right Thing if the terminator is changed here.
                     self.found_terminator()
                 else:
-                    # check for a prefix of the terminator
-                    index = find_prefix_at_end (self.ac_in_buffer, terminator)
+                    # check for a prefix of the terminator, only the last
+                    # few bytes can hold one
+                    index = find_prefix_at_end (
+                        buf[max(start, lb - terminator_len):], terminator)
                     if index:
-                        if index != lb:
+                        if index != lb - start:
                             # we found a prefix, collect up to the prefix
-                            self.collect_incoming_data (self.ac_in_buffer[:-index])
-                            self.ac_in_buffer = self.ac_in_buffer[-index:]
-                        break
+                            self.collect_incoming_data (buf[start:lb-index])
+                        self.ac_in_buffer = buf[lb-index:]
+                        return
                     else:
                         # no prefix, collect it all
-                        self.collect_incoming_data (self.ac_in_buffer)
-                        self.ac_in_buffer = ''
+                        self.collect_incoming_data (buf[start:])
+                        start = lb
+
+        self.ac_in_buffer = self.ac_in_empty
 
     def handle_write (self):
         self.initiate_send ()
@@ -156,11 +206,32 @@ class async_chat (asyncore.dispatcher):
         self.close()
 
     def push (self, data):
-        self.producer_fifo.push (simple_producer (data))
+        if not self.producer_fifo:
+            self.push_buffer (data)
+        else:
+            self.push_producer (simple_producer (data))
         self.initiate_send()
 
-    def push_with_producer (self, producer):
+    def push_buffer (self, data):
+        """queue data on the output buffer by reference, without copying it"""
+        if not isinstance(data, memoryview):
+            data = as_bytes(data)
+        if not self.ac_out_buffer:
+            # writable() is about to change
+            asyncore.dirty.add (self._fileno)
+            if self.ac_out_buffer is EMPTY:
+                self.ac_out_buffer = collections.deque()
+        self.ac_out_buffer.append (data)
+        self.ac_out_bytes += len(data)
+
+    def push_producer (self, producer):
+        if self.producer_fifo is EMPTY:
+            self.producer_fifo = fifo()
         self.producer_fifo.push (producer)
+        asyncore.dirty.add (self._fileno)
+
+    def push_with_producer (self, producer):
+        self.push_producer (producer)
         self.initiate_send()
 
     def readable (self):
@@ -172,20 +243,20 @@ class async_chat (asyncore.dispatcher):
         # return len(self.ac_out_buffer) or len(self.producer_fifo) or (not self.connected)
         # this is about twice as fast, though not as clear.
         return not (
-                (self.ac_out_buffer == '') and
-                self.producer_fifo.is_empty() and
+                (not self.ac_out_buffer) and
+                (not self.producer_fifo) and
                 self.connected
                 )
 
     def close_when_done (self):
         """automatically close this channel once the outgoing queue is empty"""
-        self.producer_fifo.push (None)
+        self.push_producer (None)
 
     # refill the outgoing buffer by calling the more() method
     # of the first producer in the queue
     def refill_buffer (self):
         while 1:
-            if len(self.producer_fifo):
+            if self.producer_fifo:
                 p = self.producer_fifo.first()
                 # a 'None' in the producer fifo is a sentinel,
                 # telling us to close the channel.
@@ -194,43 +265,89 @@ class async_chat (asyncore.dispatcher):
                         self.producer_fifo.pop()
                         self.close()
                     return
-                elif isinstance(p, str):
+                elif isinstance(p, (str, bytes)):
                     self.producer_fifo.pop()
-                    self.ac_out_buffer += p
+                    self.push_buffer (p)
                     return
                 data = p.more()
                 if data:
-                    self.ac_out_buffer = self.ac_out_buffer + data
+                    self.push_buffer (data)
                     return
                 else:
                     self.producer_fifo.pop()
             else:
+                self.producer_fifo = EMPTY
                 return
 
     def initiate_send (self):
         obs = self.ac_out_buffer_size
         # try to refill the buffer
-        if len (self.ac_out_buffer) < obs:
+        if self.ac_out_bytes < obs:
             self.refill_buffer()
 
         if self.ac_out_buffer and self.connected:
             # try to send the buffer
             try:
-                num_sent = self.send (self.ac_out_buffer[:obs])
+                buffers = self.get_out_buffers (obs)
+                if HAS_SENDMSG:
+                    num_sent = self.sendmsg (buffers)
+                elif len(buffers) == 1:
+                    num_sent = self.send (buffers[0])
+                else:
+                    # no sendmsg(), copy at most ac_out_buffer_size bytes
+                    data = b''.join ([view.tobytes() for view in buffers])
+                    num_sent = self.send (data)
                 if num_sent:
-                    self.ac_out_buffer = self.ac_out_buffer[num_sent:]
+                    self.consume_out_buffer (num_sent)
 
             except socket.error:
                 self.handle_error()
                 return
 
+    def get_out_buffers (self, limit):
+        # views onto the queued chunks, about 'limit' bytes worth
+        buffers = []
+        total = 0
+        offset = self.ac_out_offset
+        for chunk in self.ac_out_buffer:
+            view = memoryview (chunk)
+            if offset:
+                view = view[offset:]
+                offset = 0
+            if total + len(view) > limit:
+                view = view[:limit - total]
+            buffers.append (view)
+            total += len(view)
+            if total >= limit or len(buffers) >= IOV_MAX:
+                break
+        return buffers
+
+    def consume_out_buffer (self, num_sent):
+        self.ac_out_bytes -= num_sent
+        queue = self.ac_out_buffer
+        num_sent += self.ac_out_offset
+        while queue and num_sent >= len(queue[0]):
+            num_sent -= len(queue.popleft())
+        self.ac_out_offset = num_sent
+        if not queue:
+            # let the empty queue go until there is output again
+            self.ac_out_buffer = EMPTY
+            asyncore.dirty.add (self._fileno)
+
     def discard_buffers (self):
         # Emergencies only!
-        self.ac_in_buffer = ''
-        self.ac_out_buffer = ''
-        while self.producer_fifo:
-            self.producer_fifo.pop()
+        self.ac_in_buffer = self.ac_in_empty
+        self.ac_out_buffer = EMPTY
+        self.ac_out_offset = 0
+        self.ac_out_bytes = 0
+        asyncore.dirty.add (self._fileno)
+        self.producer_fifo = EMPTY
+
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
 
+# the output queue and producer fifo of a channel with nothing queued
+EMPTY = ()
 
 class simple_producer:
 
@@ -57,6 +57,8 @@ from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, \
 
 from chatserver.compat import as_string, as_bytes
 from chatserver.medusa import text_socket
+from chatserver.message_queue import MessageQueue
+from chatserver.backlog import OutputBacklog
 
 try:
     socket_map
@@ -64,9 +66,22 @@ except NameError:
     socket_map = {}
 
 try:
-    data_map
+    data_queue
 except NameError:
-    data_map = {}
+    data_queue = MessageQueue()
+
+try:
+    out_backlog
+except NameError:
+    out_backlog = OutputBacklog()
+
+# fds whose readable() or writable() may have changed since the event
+# loop last asked; dispatchers add themselves when their buffers go from
+# empty to non-empty and back, and when they are added or removed
+try:
+    dirty
+except NameError:
+    dirty = set()
 
 class ExitNow(Exception):
     pass
@@ -203,13 +218,15 @@ def loop(timeout=30.0, use_poll=False, map=None, count=None):
             poll_fun(timeout, map)
             count -= 1
 
-class dispatcher:
+class dispatcher(object):
+
+    # there may be a great many channels; subclasses which list their
+    # own __slots__ as well do without a __dict__ per instance
+    __slots__ = ('_map', 'socket', '_fileno', 'connected', 'accepting',
+                 'addr', 'family_and_type')
 
     debug = False
-    connected = False
-    accepting = False
     closing = False
-    addr = None
 
     def __init__(self, sock=None, map=None):
         if map is None:
@@ -217,6 +234,11 @@ class dispatcher:
         else:
             self._map = map
 
+        self.connected = False
+        self.accepting = False
+        # a subclass may know it already, from accept()
+        self.addr = getattr(self, 'addr', None)
+
         if sock:
             self.set_socket(sock, map)
             # I think it should inherit this anyway
@@ -224,11 +246,12 @@ class dispatcher:
             self.connected = True
             # XXX Does the constructor require that the socket passed
             # be connected?
-            try:
-                self.addr = sock.getpeername()
-            except socket.error:
-                # The addr isn't crucial
-                pass
+            if self.addr is None:
+                try:
+                    self.addr = sock.getpeername()
+                except socket.error:
+                    # The addr isn't crucial
+                    pass
         else:
             self.socket = None
 
@@ -250,9 +273,10 @@ class dispatcher:
         if map is None:
             map = self._map
         map[self._fileno] = self
+        dirty.add(self._fileno)
 
-    def add_data(self, data):
-        data_map[self._fileno] = data
+    def add_data(self, data, target=None):
+        data_queue.put(self._fileno, data, target)
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -261,6 +285,7 @@ class dispatcher:
         if fd in map:
             #self.log_info('closing channel %d:%s' % (fd, self))
             del map[fd]
+            dirty.add(fd)
         self._fileno = None
 
     def create_socket(self, family, type):
@@ -347,10 +372,21 @@ class dispatcher:
             else:
                 raise
 
+    def sendmsg(self, buffers):
+        # scatter-gather send of several buffers in one system call
+        try:
+            result = self.socket.sendmsg(buffers)
+            return result
+        except socket.error as why:
+            if why.args[0] == EWOULDBLOCK:
+                return 0
+            else:
+                raise
+
     def recv(self, buffer_size):
         try:
             data = self.socket.recv(buffer_size)
-            self.logger.log("==> recv data: [%s]" % data[:-2])
+            self.logger.trace("==> recv data: [%s]", data)
             if not data:
                 # a closed connection is indicated by signaling
                 # a read condition, and having recv() return 0.
@@ -373,6 +409,9 @@ class dispatcher:
     # cheap inheritance, used to pass all other attribute
     # references to the underlying socket object.
     def __getattr__(self, attr):
+        if attr == 'socket':
+            # not set yet; asking the socket would recurse
+            raise AttributeError(attr)
         return getattr(self.socket, attr)
 
     # log and log_info may be overridden to provide more sophisticated
@@ -1,3 +1,4 @@
+import os
 import socket
 from chatserver.compat import PY3, as_string, as_bytes
 
@@ -43,3 +44,17 @@ if PY3:
 
 else:
     text_socket = bin_socket
+
+def fromfd(fd, family=socket.AF_INET, type=socket.SOCK_STREAM, binary=False):
+    # a socket object for an open fd, such as a listener inherited over
+    # exec(); the socket object owns the fd from then on
+    if PY3:
+        if binary:
+            sock = bin_socket(family, type, 0, fd)
+        else:
+            sock = text_socket(family, type, 0, fd)
+        sock.set_inheritable(False)
+        return sock
+    sock = socket.fromfd(fd, family, type)
+    os.close(fd)
+    return sock
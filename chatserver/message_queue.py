@@ -0,0 +1,42 @@
+import collections
+
+class MessageQueue:
+    '''
+    Ordered queue of the messages read during one turn of the event loop.
+
+    Every message gets a sequence number and nothing is overwritten, so
+    two reads from the same client in one turn are both delivered.  The
+    queue is bounded: once it holds max_messages or max_bytes, channels
+    stop reading (the data stays in the kernel socket buffer) until the
+    broadcaster has drained it.
+    '''
+
+    def __init__(self, max_messages=10000, max_bytes=1<<24):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = collections.deque()
+        self.nbytes = 0
+        self.seq = 0
+        # number of reads put off because the queue was full
+        self.deferred = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, fd, data, target=None):
+        # target is the room to deliver to, None for the lobby
+        self.seq += 1
+        self.messages.append((self.seq, fd, data, target))
+        self.nbytes += len(data)
+        return self.seq
+
+    def full(self):
+        return (len(self.messages) >= self.max_messages or
+                self.nbytes >= self.max_bytes)
+
+    def drain(self):
+        # hand the whole batch over and start a new one
+        messages = self.messages
+        self.messages = collections.deque()
+        self.nbytes = 0
+        return messages
@@ -0,0 +1,257 @@
+import socket
+import bisect
+
+from chatserver.compat import as_bytes, as_string
+from chatserver.medusa import asyncore_25 as asyncore
+from chatserver.medusa import asynchat_25 as asynchat
+
+# upper bounds of the histogram buckets, in seconds and in events
+SECONDS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0)
+EVENTS_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# longest request accepted on the admin port
+MAX_REQUEST = 8192
+
+class Histogram:
+    '''
+    Counts of observations in fixed buckets.  The list of counts is made
+    once; observe() is a bisect and two additions.
+    '''
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # one count per bucket and the last one for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def expose(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s histogram' % self.name)
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, total))
+        total += self.counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, total))
+        lines.append('%s_sum %r' % (self.name, float(self.sum)))
+        lines.append('%s_count %d' % (self.name, total))
+
+class Metrics:
+    '''
+    Counters and histograms of one event loop process, served in the
+    Prometheus text format on the admin port.
+
+    The counters are plain integer attributes which the channels and the
+    loop add to; the backlog, ingress queue and timer wheel are only
+    read when the metrics are scraped.
+    '''
+
+    def __init__(self, timers=None):
+        self.timers = timers
+        # set by make_server to those of the engine in use
+        self.backlog = None
+        self.queue = None
+        # the FanoutPool, whose threads count the bytes they send
+        self.fanout = None
+        # the Cluster with --cluster-port or --peers
+        self.cluster = None
+        # the Journal with --journal
+        self.journal = None
+        self.accepted = 0
+        self.closed = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        self.deliveries = 0
+        self.loop_seconds = Histogram(
+            'chatserver_loop_duration_seconds',
+            'Time spent in one turn of the event loop, poll() excluded.',
+            SECONDS_BUCKETS)
+        self.poll_seconds = Histogram(
+            'chatserver_poll_wait_seconds',
+            'Time spent waiting in poll().',
+            SECONDS_BUCKETS)
+        self.poll_events = Histogram(
+            'chatserver_poll_events',
+            'Read and write events returned by one poll().',
+            EVENTS_BUCKETS)
+
+    def expose(self):
+        lines = []
+        def add(name, type, help, value):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            lines.append('%s %s' % (name, value))
+        add('chatserver_connections_accepted_total', 'counter',
+            'Client connections accepted.', self.accepted)
+        add('chatserver_connections_closed_total', 'counter',
+            'Client connections closed.', self.closed)
+        add('chatserver_connections', 'gauge',
+            'Client connections open.', self.accepted - self.closed)
+        add('chatserver_accept_throttled_total', 'counter',
+            'Times the accept rate limit was reached.', self.throttled)
+        add('chatserver_rate_limited_total', 'counter',
+            'Times a client was not read because of a message rate limit.',
+            self.rate_limited)
+        add('chatserver_received_bytes_total', 'counter',
+            'Bytes read from clients.', self.bytes_in)
+        bytes_out = self.bytes_out
+        if self.fanout is not None:
+            bytes_out += self.fanout.bytes_out()
+        add('chatserver_sent_bytes_total', 'counter',
+            'Bytes written to clients.', bytes_out)
+        add('chatserver_messages_total', 'counter',
+            'Messages fanned out.', self.messages)
+        add('chatserver_deliveries_total', 'counter',
+            'Messages queued on recipients by the fan-out.', self.deliveries)
+        self.loop_seconds.expose(lines)
+        self.poll_seconds.expose(lines)
+        self.poll_events.expose(lines)
+        backlog = self.backlog
+        if backlog is not None:
+            add('chatserver_backlog_bytes', 'gauge',
+                'Bytes queued on all channels and not yet sent.', backlog.nbytes)
+            add('chatserver_backlog_peak_bytes', 'gauge',
+                'Most bytes ever queued on all channels.', backlog.peak_bytes)
+            add('chatserver_read_pauses_total', 'counter',
+                'Times reading stopped because of the backlog.', backlog.pauses)
+            add('chatserver_dropped_messages_total', 'counter',
+                'Messages dropped for slow consumers.', backlog.dropped_messages)
+            add('chatserver_dropped_bytes_total', 'counter',
+                'Bytes dropped for slow consumers.', backlog.dropped_bytes)
+            add('chatserver_evicted_total', 'counter',
+                'Slow consumers disconnected.', backlog.evicted)
+        queue = self.queue
+        if queue is not None:
+            add('chatserver_deferred_reads_total', 'counter',
+                'Reads put off because the ingress queue was full.', queue.deferred)
+        journal = self.journal
+        if journal is not None:
+            add('chatserver_journal_errors_total', 'counter',
+                'Journal writes or fsyncs which failed.', journal.errors)
+            add('chatserver_journal_disabled', 'gauge',
+                'Whether the journal was disabled after an error.',
+                int(journal.disabled))
+        cluster = self.cluster
+        if cluster is not None:
+            add('chatserver_cluster_nodes', 'gauge',
+                'Other nodes of the cluster linked to.', len(cluster.nodes))
+            add('chatserver_cluster_forwarded_total', 'counter',
+                'Messages sent on to other nodes.', cluster.forwarded)
+            add('chatserver_cluster_received_total', 'counter',
+                'Messages received from other nodes.', cluster.received_messages)
+        timers = self.timers
+        if timers is not None:
+            add('chatserver_timers', 'gauge',
+                'Timers scheduled.', timers.count)
+            add('chatserver_timers_fired_total', 'counter',
+                'Timers fired.', timers.fired)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def respond(self, request):
+        # the response to one HTTP request on the admin port
+        words = as_string(request).split(None, 2)
+        if len(words) < 2 or words[0] not in ('GET', 'HEAD'):
+            status, body = '405 Method Not Allowed', 'GET /metrics\n'
+        elif words[1].split('?')[0] not in ('/', '/metrics'):
+            status, body = '404 Not Found', 'GET /metrics\n'
+        else:
+            status, body = '200 OK', self.expose()
+        body = as_bytes(body)
+        header = ('HTTP/1.0 %s\r\n'
+                  'Content-Type: text/plain; version=0.0.4\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: close\r\n\r\n' % (status, len(body)))
+        if words and words[0] == 'HEAD':
+            body = b''
+        return as_bytes(header) + body
+
+def listen(host, port, backlog=64, reuse_port=False):
+    # the admin socket is made before daemonizing, like the chat one
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # the workers of a reloaded master bind next to the old ones
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+class metrics_channel(asynchat.async_chat):
+    '''
+    One scrape: reads the request up to the blank line, answers it and
+    closes the connection.
+    '''
+
+    ac_in_empty = b''
+
+    def __init__(self, metrics, conn, logger_object):
+        asynchat.async_chat.__init__(self, conn)
+        self.metrics = metrics
+        self.logger = logger_object
+        self.pieces = []
+        self.received = 0
+        self.set_terminator(b'\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.received += len(data)
+        if self.received > MAX_REQUEST:
+            self.close()
+            return
+        self.pieces.append(data)
+
+    def found_terminator(self):
+        request = b''.join(self.pieces)
+        self.pieces = []
+        self.set_terminator(None)
+        self.push(self.metrics.respond(request))
+        self.close_when_done()
+
+    def readable(self):
+        # nothing more is read once the request is answered
+        return (self.get_terminator() is not None and
+                asynchat.async_chat.readable(self))
+
+    def log_info(self, message, type='info'):
+        self.logger.log('%s %s' % (type, message))
+
+class metrics_server(asyncore.dispatcher):
+    '''The admin port of the medusa loop.'''
+
+    def __init__(self, sock, metrics, logger_object):
+        asyncore.dispatcher.__init__(self)
+        self.set_socket(sock)
+        self.accepting = True
+        self.metrics = metrics
+        self.logger = logger_object
+        host, port = sock.getsockname()
+        self.logger.log('metrics served on port %d' % port)
+
+    def readable(self):
+        return self.accepting
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            metrics_channel(self.metrics, pair[0], self.logger)
+
+    def log_info(self, message, type='info'):
+        self.logger.log('%s %s' % (type, message))
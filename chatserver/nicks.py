@@ -0,0 +1,90 @@
+from chatserver.compat import as_bytes
+from chatserver import protocol
+
+class Nick:
+    '''
+    The target of direct messages to one nickname.  It goes through the
+    ingress queue like a room, but a message to it is queued on its one
+    channel; it is neither journaled nor kept for replay.
+
+    A Nick without a channel stands for a nickname which is not known
+    here; with --workers its messages are relayed to the other workers,
+    which deliver them if one of their clients has that nickname, and
+    with --peers to the node which has it.
+    '''
+
+    # direct messages are between two clients only
+    private = True
+    history = None
+    id = protocol.DIRECT
+
+    def __init__(self, name, channel=None):
+        self.name = name
+        self.channel = channel
+
+    def record(self, message, seq=None):
+        return as_bytes(message)
+
+    def recipients(self, sender_fd):
+        return self.channel is not None and 1 or 0
+
+    def fanout(self, sender_fd, message, seq=None):
+        channel = self.channel
+        if channel is None:
+            return 0
+        data = as_bytes(message)
+        if channel.framing == 'compact':
+            channel.queue_entry(protocol.entry(
+                self.id, seq, data[channel.server.header_size:]))
+        else:
+            channel.push_data(data)
+        return 1
+
+class NickRegistry:
+    '''
+    Maps nicknames to the channels which took them, so that a direct
+    message costs one dict lookup instead of a walk over the clients.
+    Nicknames are taken with /nick and given up when the channel takes
+    another one or is closed.
+    '''
+
+    max_name_length = 32
+
+    def __init__(self):
+        self.nicks = {}
+        # told about nicknames being taken and given up, as the rooms'
+        self.watcher = None
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def get(self, name):
+        return self.nicks.get(name)
+
+    def valid_name(self, name):
+        # a leading '#' is a room; the rest keeps nicknames readable in
+        # the prefix of every message
+        return (0 < len(name) <= self.max_name_length and
+                name.replace('-', '').replace('_', '').isalnum())
+
+    def take(self, name, channel):
+        # the channel's Nick, or None if someone else has the name
+        nick = self.nicks.get(name)
+        if nick is None:
+            nick = self.nicks[name] = Nick(name, channel)
+            if self.watcher is not None:
+                self.watcher.subscribe(name)
+        elif nick.channel is not channel:
+            return None
+        return nick
+
+    def release(self, nick):
+        if self.nicks.get(nick.name) is nick:
+            del self.nicks[nick.name]
+            if self.watcher is not None:
+                self.watcher.unsubscribe(nick.name)
+        nick.channel = None
+
+def delivered(target):
+    # a direct message to one of our own nicknames is not relayed
+    return target is not None and target.private and target.channel is not None
@@ -3,6 +3,12 @@ import errno
 
 class BasePoller:
 
+    # every poller keeps its registrations between calls to poll() and
+    # is only told when a dispatcher's interest changes; one which had
+    # to drop them sets resync so the event loop registers everything
+    # again
+    resync = False
+
     def __init__(self, helpers):
         self.helpers = helpers
         self.initialize()
@@ -19,6 +25,9 @@ class BasePoller:
     def unregister(self, fd):
         raise NotImplementedError
 
+    def set_interest(self, fd, readable, writable):
+        raise NotImplementedError
+
     def poll(self, timeout):
         raise NotImplementedError
 
@@ -47,6 +56,16 @@ class SelectPoller(BasePoller):
         if fd in self.writables:
             self.writables.remove(fd)
 
+    def set_interest(self, fd, readable, writable):
+        if readable:
+            self.readables.add(fd)
+        else:
+            self.readables.discard(fd)
+        if writable:
+            self.writables.add(fd)
+        else:
+            self.writables.discard(fd)
+
     def unregister_all(self):
         self._init_fdsets()
 
@@ -64,6 +83,7 @@ class SelectPoller(BasePoller):
             if err.args[0] == errno.EBADF:
                 self.helpers.logger.log('EBADF encountered in poll')
                 self.unregister_all()
+                self.resync = True
                 return [], []
             raise
         return r, w
@@ -86,7 +106,25 @@ class PollPoller(BasePoller):
         self._poller.register(fd, self.WRITE)
 
     def unregister(self, fd):
-        self._poller.unregister(fd)
+        try:
+            self._poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def set_interest(self, fd, readable, writable):
+        # register() replaces the mask, so both kinds go in one call
+        mask = 0
+        if readable:
+            mask |= self.READ
+        if writable:
+            mask |= self.WRITE
+        if mask:
+            self._poller.register(fd, mask)
+        else:
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
 
     def poll(self, timeout):
         fds = self._poll_fds(timeout)
@@ -144,19 +182,35 @@ class KQueuePoller(BasePoller):
         self._kqueue_control(fd, kevent)
 
     def unregister(self, fd):
-        kevent = select.kevent(
-            fd,
-            filter=(select.KQ_FILTER_READ | select.KQ_FILTER_WRITE),
-            flags=select.KQ_EV_DELETE
-            )
+        # a closed fd has already been dropped by the kernel, so only
+        # delete the filters of one which is still open
+        if fd in self.readables:
+            self._kqueue_control(fd, select.kevent(
+                fd, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_DELETE))
+        if fd in self.writables:
+            self._kqueue_control(fd, select.kevent(
+                fd, filter=select.KQ_FILTER_WRITE, flags=select.KQ_EV_DELETE))
         self._forget_fd(fd)
-        self._kqueue_control(fd, kevent)
+
+    def set_interest(self, fd, readable, writable):
+        if readable and fd not in self.readables:
+            self.register_readable(fd)
+        elif not readable and fd in self.readables:
+            self.readables.remove(fd)
+            self._kqueue_control(fd, select.kevent(
+                fd, filter=select.KQ_FILTER_READ, flags=select.KQ_EV_DELETE))
+        if writable and fd not in self.writables:
+            self.register_writable(fd)
+        elif not writable and fd in self.writables:
+            self.writables.remove(fd)
+            self._kqueue_control(fd, select.kevent(
+                fd, filter=select.KQ_FILTER_WRITE, flags=select.KQ_EV_DELETE))
 
     def _kqueue_control(self, fd, kevent):
         try:
             self._kqueue.control([kevent], 0)
         except OSError as error:
-            if error.errno == errno.EBADF:
+            if error.errno in (errno.EBADF, errno.ENOENT):
                 self.helpers.logger.log('EBADF encountered in kqueue. '
                                             'Invalid file descriptor %s' % fd)
             else:
@@ -199,14 +253,122 @@ class KQueuePoller(BasePoller):
         for fd in self.writables:
             self.register_writable(fd)
 
+class EpollPoller(BasePoller):
+    '''
+    Wrapper for select.epoll() which keeps registrations persistent
+    and only touches the kernel interest list when it actually changes
+    '''
+
+    max_events = 1000
+
+    def initialize(self):
+        self._epoll = select.epoll()
+        self.READ = select.EPOLLIN | select.EPOLLPRI
+        self.WRITE = select.EPOLLOUT
+        self.ERROR = select.EPOLLERR | select.EPOLLHUP
+        self.interest = {}
+
+    def register_readable(self, fd):
+        mask = self.interest.get(fd, 0)
+        self._set_mask(fd, mask | self.READ)
+
+    def register_writable(self, fd):
+        mask = self.interest.get(fd, 0)
+        self._set_mask(fd, mask | self.WRITE)
+
+    def set_interest(self, fd, readable, writable):
+        mask = 0
+        if readable:
+            mask |= self.READ
+        if writable:
+            mask |= self.WRITE
+        self._set_mask(fd, mask)
+
+    def unregister(self, fd):
+        if self.interest.pop(fd, None) is None:
+            return
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError) as error:
+            # a closed fd has already been dropped by the kernel
+            if error.args[0] not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def _set_mask(self, fd, mask):
+        old = self.interest.get(fd)
+        if old == mask:
+            return
+        try:
+            if old is None:
+                self._epoll.register(fd, mask)
+            else:
+                self._epoll.modify(fd, mask)
+        except (IOError, OSError) as error:
+            if error.args[0] == errno.EEXIST:
+                self._epoll.modify(fd, mask)
+            elif error.args[0] == errno.ENOENT:
+                self._epoll.register(fd, mask)
+            elif error.args[0] == errno.EBADF:
+                self.helpers.logger.log('EBADF encountered in epoll. '
+                                            'Invalid file descriptor %s' % fd)
+                self.interest.pop(fd, None)
+                return
+            else:
+                raise
+        self.interest[fd] = mask
+
+    def poll(self, timeout):
+        readables, writables = [], []
+
+        try:
+            events = self._epoll.poll(timeout, self.max_events)
+        except (IOError, OSError) as error:
+            if error.args[0] == errno.EINTR:
+                self.helpers.logger.log('EINTR encountered in poll')
+                return readables, writables
+            raise
+
+        for fd, eventmask in events:
+            # hangups and errors are reported through a read so that
+            # recv() gets to notice the closed connection
+            if eventmask & (self.READ | self.ERROR):
+                readables.append(fd)
+            if eventmask & self.WRITE:
+                writables.append(fd)
+
+        return readables, writables
+
+    def before_daemonize(self):
+        self._epoll.close()
+        self._epoll = None
+
+    def after_daemonize(self):
+        self._epoll = select.epoll()
+        for fd, mask in self.interest.items():
+            self._epoll.register(fd, mask)
+
 def implements_poll():
     return hasattr(select, 'poll')
 
 def implements_kqueue():
     return hasattr(select, 'kqueue')
 
+def implements_epoll():
+    return hasattr(select, 'epoll')
+
+# backends which can be asked for by name with --poller
+pollers = {'select': SelectPoller}
+if implements_poll():
+    pollers['poll'] = PollPoller
+if implements_epoll():
+    pollers['epoll'] = EpollPoller
+if implements_kqueue():
+    pollers['kqueue'] = KQueuePoller
+
 if implements_kqueue():
     Poller = KQueuePoller
+elif implements_epoll():
+    Poller = EpollPoller
 elif implements_poll():
     Poller = PollPoller
 else:
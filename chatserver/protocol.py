@@ -0,0 +1,97 @@
+'''
+The compact protocol, which a client switches to with /protocol compact
+on a --binary server, in place of the text framing the server runs
+with.  Plain clients never see it.
+
+Every frame is a varint with the size of what follows, the frame's kind
+in one byte and its body; varints are unsigned LEB128, seven bits a
+byte, least significant first.  A client sends
+
+    MESSAGE   varint room id, then the message; room id 0 is where a
+              plain message would go, the current room or the lobby
+    COMMAND   a command such as /join #room, without a terminator
+
+and the server sends
+
+    BATCH     one entry per message fanned out to the client in one turn
+              of the loop: varint room id, varint message number, varint
+              size and the message as a plain client gets it, less the
+              length header in length framing
+    NOTICE    what a plain client gets as a *** line, without the stars
+    ROOM      varint room id and the name of a room the client joined
+
+The lobby is room 0 and direct messages come from room 1; rooms are
+numbered from 2 as they are made, and a room made again after its last
+member left gets a new number.
+'''
+
+import struct
+
+MESSAGE, COMMAND, BATCH, NOTICE, ROOM = range(1, 6)
+
+LOBBY, DIRECT = 0, 1
+FIRST_ROOM = 2
+
+KIND = struct.Struct('!B')
+
+def varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def read_varint(buf, offset):
+    # (value, offset after it) from a bytearray, None if it ends first
+    value = shift = 0
+    end = len(buf)
+    while offset < end:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError('varint too long')
+    return None
+
+def header(kind, size):
+    # size is that of the body
+    return varint(size + 1) + KIND.pack(kind)
+
+def frame(kind, body):
+    return header(kind, len(body)) + body
+
+def parse(buf, offset, max_size):
+    # (kind, start, end) of the body of the frame at offset in a
+    # bytearray, None while it is incomplete
+    size = read_varint(buf, offset)
+    if size is None:
+        return None
+    size, start = size
+    if not 0 < size <= max_size:
+        raise ValueError('frame of %d bytes' % size)
+    end = start + size
+    if end > len(buf):
+        return None
+    return buf[start], start + 1, end
+
+def message(body):
+    # (room id, message) of a MESSAGE body
+    room_id = read_varint(body, 0)
+    if room_id is None:
+        raise ValueError('truncated message frame')
+    room_id, start = room_id
+    return room_id, bytes(body[start:])
+
+def entry(room_id, seq, data):
+    # made once per message and shared by all the batches it goes in
+    return varint(room_id) + varint(seq or 0) + varint(len(data)) + data
+
+def batch(entries):
+    size = 0
+    for data in entries:
+        size += len(data)
+    return b''.join([header(BATCH, size)] + entries)
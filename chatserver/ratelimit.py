@@ -0,0 +1,99 @@
+from chatserver.timers import clock
+
+class TokenBucket(object):
+    '''
+    Allows rate events a second on average and bursts of up to burst
+    events.  The bucket is only refilled when it is looked at, so an
+    idle one costs nothing.
+    '''
+
+    # a RateTable holds one per client
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = clock()
+
+    def refill(self):
+        now = clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, n=1):
+        '''seconds until n tokens are there, 0 if they are now'''
+        self.refill()
+        if self.tokens >= n:
+            return 0
+        return (n - self.tokens) / self.rate
+
+    def take(self, n=1):
+        '''take n tokens if they are there, returns whether they were'''
+        self.refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def spend(self, n=1):
+        '''
+        take n tokens even if they are not there, returns the seconds
+        until there is a token again, 0 if there is one now
+        '''
+        self.refill()
+        self.tokens -= n
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+class RateTable:
+    '''
+    A TokenBucket of the same rate and burst for each of many keys, such
+    as connections or source addresses, made when a key first spends a
+    token.  A bucket which has filled up again is no different from a
+    new one, so expire() drops those every expire_interval seconds and
+    the table only holds the keys which sent something lately.
+    '''
+
+    expire_interval = 60
+
+    def __init__(self, rate, burst=None, timers=None):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.timers = timers
+        if timers is not None:
+            timers.schedule(self.expire_interval, self.expire)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def spend(self, key, n=1):
+        # see TokenBucket.spend()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket.spend(n)
+
+    def wait(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return 0
+        return bucket.wait()
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
+
+    def expire(self):
+        buckets = self.buckets
+        for key in [key for key, bucket in buckets.items() if bucket.full()]:
+            del buckets[key]
+        if self.timers is not None:
+            self.timers.schedule(self.expire_interval, self.expire)
@@ -0,0 +1,78 @@
+import struct
+
+from chatserver.compat import as_bytes, as_string
+from chatserver.medusa import asynchat_25 as asynchat
+
+# every relayed message is preceded by its length, then comes the
+# length of the room name (0 for the lobby) and the name itself
+HEADER = struct.Struct('!I')
+ROOM_HEADER = struct.Struct('!B')
+
+class relay_channel(asynchat.async_chat):
+    '''
+    One end of a Unix socketpair between the master process and an event
+    loop worker, or between a reloading chatserverd and the one replacing
+    it.  Messages are length-prefixed; the payload is queued by reference
+    so one message can be relayed to many workers unchanged.
+    '''
+
+    ac_in_empty = b''
+    ac_in_buffer_size = 1<<16
+    ac_out_buffer_size = 1<<16
+
+    def __init__(self, sock, logger_object, on_message, on_close=None,
+                 map=None):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.logger = logger_object
+        self.on_message = on_message
+        self.on_close = on_close
+        self.pieces = []
+        self.in_header = True
+        self.set_terminator(HEADER.size)
+
+    def repr(self):
+        ar = asynchat.async_chat.__repr__(self)[1:-1]
+        return '<%s>' %(ar)
+
+    def forward(self, messages):
+        # messages are (room name or None, message) pairs
+        for room, message in messages:
+            data = as_bytes(message)
+            name = as_bytes(room or '')
+            size = ROOM_HEADER.size + len(name) + len(data)
+            self.push_buffer(HEADER.pack(size) + ROOM_HEADER.pack(len(name)) + name)
+            self.push_buffer(data)
+        self.initiate_send()
+
+    def collect_incoming_data(self, data):
+        self.pieces.append(data)
+
+    def found_terminator(self):
+        data = b''.join(self.pieces)
+        self.pieces = []
+        if self.in_header:
+            size = HEADER.unpack(data)[0]
+            if size:
+                self.in_header = False
+                self.set_terminator(size)
+            return
+        self.in_header = True
+        self.set_terminator(HEADER.size)
+
+        start = ROOM_HEADER.size
+        end = start + ROOM_HEADER.unpack(data[:start])[0]
+        room = as_string(data[start:end]) or None
+        self.on_message(self, room, data[end:])
+
+    def handle_expt(self):
+        # POLLHUP once the other end has gone
+        self.close()
+
+    def close(self):
+        asynchat.async_chat.close(self)
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close(self)
+
+    def log_info(self, message, type='info'):
+        self.logger.log('%s %s' % (type, message))
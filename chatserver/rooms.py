@@ -0,0 +1,65 @@
+from chatserver.broadcast import Broadcaster
+from chatserver.history import History
+from chatserver import protocol
+
+class Room(Broadcaster):
+    '''
+    A named set of subscribed channels; a message sent to the room costs
+    O(members) instead of O(connected clients).
+    '''
+
+    def __init__(self, name, shards=0, header_size=0, id=None):
+        Broadcaster.__init__(self, shards, header_size)
+        self.name = name
+        self.id = id
+
+class RoomRegistry:
+    '''
+    Maps room names to rooms.  A room is created by its first JOIN and
+    dropped again when its last member leaves, so only rooms with
+    members take up memory.
+    '''
+
+    max_name_length = 64
+
+    def __init__(self, history_size=0, shards=0, header_size=0):
+        self.rooms = {}
+        # messages each room keeps for replay, 0 for none; a room's
+        # history goes with the room when its last member leaves
+        self.history_size = history_size
+        # the number of fan-out threads, see Broadcaster
+        self.shards = shards
+        self.header_size = header_size
+        # the compact protocol's id of the next room made
+        self.next_id = protocol.FIRST_ROOM
+        # told about rooms coming and going, see cluster.Cluster
+        self.watcher = None
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def valid_name(self, name):
+        # names come from split(), so they never contain whitespace
+        return name.startswith('#') and 1 < len(name) <= self.max_name_length
+
+    def join(self, name, fd, channel):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, self.shards,
+                                           self.header_size, self.next_id)
+            self.next_id += 1
+            if self.history_size:
+                room.history = History(self.history_size)
+            if self.watcher is not None:
+                self.watcher.subscribe(name)
+        room.register(fd, channel)
+        return room
+
+    def part(self, room, fd):
+        room.unregister(fd)
+        if not len(room) and self.rooms.pop(room.name, None) is not None:
+            if self.watcher is not None:
+                self.watcher.unsubscribe(room.name)
@@ -0,0 +1,170 @@
+import sys
+import time
+
+from chatserver.medusa.counter import counter
+
+# a clock which does not jump when the wall clock is set, where there is one
+clock = getattr(time, 'monotonic', time.time)
+
+class Timer(object):
+    '''
+    A callback scheduled on a TimerWheel.
+
+    reset() only moves the deadline unless it comes earlier than the
+    slot the timer sits in; a timer which is found in its slot before its
+    deadline is put back further on.  Idle timers are reset on every
+    read, so that keeps the common case to an assignment.
+    '''
+
+    # every channel has one or two
+    __slots__ = ('wheel', 'deadline', 'callback', 'args', 'expires', 'slot')
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.expires = None     # tick of the slot the timer is in
+        self.slot = None
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+    def reset(self, delay):
+        wheel = self.wheel
+        self.deadline = wheel.now() + delay
+        if self.slot is None:
+            wheel.add(self)
+        elif wheel.ticks_for(self.deadline) < self.expires:
+            self.cancel()
+            wheel.add(self)
+
+class TimerWheel:
+    '''
+    Hierarchical timing wheel, as used for the kernel's timer lists.
+
+    Level 0 has one slot per tick, each further level covers 'slots'
+    times the range of the one below it.  Adding and cancelling a timer
+    is O(1); the timers in a slot of a higher level are moved down a
+    level when the wheel below wraps around.  next_timeout() tells the
+    event loop how long it may sleep in poll().
+    '''
+
+    def __init__(self, tick=0.1, slot_bits=6, levels=4, logger=None):
+        self.tick = tick
+        self.slot_bits = slot_bits
+        self.slots = 1 << slot_bits
+        self.mask = self.slots - 1
+        self.levels = levels
+        self.logger = logger
+        self.start = clock()
+        self.ticks = 0          # last tick which has been run
+        self.count = 0
+        self.wheels = [[set() for i in range(self.slots)]
+                       for level in range(levels)]
+        self.fired = counter()
+
+    def now(self):
+        return clock()
+
+    def ticks_for(self, deadline):
+        # round up, a timer never fires early
+        ticks = int((deadline - self.start) / self.tick)
+        if self.start + ticks * self.tick < deadline:
+            ticks += 1
+        return ticks
+
+    def schedule(self, delay, callback, *args):
+        timer = Timer(self, self.now() + delay, callback, args)
+        self.add(timer)
+        return timer
+
+    def add(self, timer, earliest=None):
+        if earliest is None:
+            # the current tick has already been run
+            earliest = self.ticks + 1
+        expires = max(self.ticks_for(timer.deadline), earliest)
+        delta = expires - self.ticks
+        for level in range(self.levels):
+            if delta < 1 << (self.slot_bits * (level + 1)):
+                break
+        else:
+            # past the end of the wheel; it is put back when reached
+            expires = self.ticks + (1 << (self.slot_bits * self.levels)) - 1
+        index = (expires >> (self.slot_bits * level)) & self.mask
+        timer.expires = expires
+        timer.slot = self.wheels[level][index]
+        timer.slot.add(timer)
+        self.count += 1
+
+    def next_timeout(self):
+        '''seconds until the next timer may fire, None if there are none'''
+        if not self.count:
+            return None
+        level0 = self.wheels[0]
+        ticks = self.ticks
+        for i in range(1, self.slots + 1):
+            if level0[(ticks + i) & self.mask]:
+                break
+            if (ticks + i) & self.mask == 0:
+                # the next level is cascaded here
+                break
+        deadline = self.start + (ticks + i) * self.tick
+        return max(0, deadline - self.now())
+
+    def run(self):
+        '''fire the timers which are due, returns how many ran'''
+        target = int((self.now() - self.start) / self.tick)
+        fired = 0
+        while self.ticks < target:
+            if not self.count:
+                self.ticks = target
+                break
+            self.ticks += 1
+            if not self.ticks & self.mask:
+                self.cascade(1)
+            slot = self.wheels[0][self.ticks & self.mask]
+            while slot:
+                timer = slot.pop()
+                timer.slot = None
+                self.count -= 1
+                if self.ticks_for(timer.deadline) > self.ticks:
+                    # reset after it was put in this slot
+                    self.add(timer)
+                    continue
+                fired += 1
+                self.fire(timer)
+        return fired
+
+    def cascade(self, level):
+        if level >= self.levels:
+            return
+        shift = self.slot_bits * level
+        index = (self.ticks >> shift) & self.mask
+        if not index:
+            self.cascade(level + 1)
+        slot = self.wheels[level][index]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            timer.slot = None
+            self.count -= 1
+            # the level 0 slot of the current tick is run right after this
+            self.add(timer, self.ticks)
+
+    def fire(self, timer):
+        self.fired.increment()
+        try:
+            timer.callback(*timer.args)
+        except:
+            if self.logger is None:
+                raise
+            self.logger.error('timer %r raised %s: %s',
+                              timer.callback, sys.exc_info()[0].__name__,
+                              sys.exc_info()[1])
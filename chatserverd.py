@@ -3,19 +3,35 @@
 import sys
 import os
 import time
+import math
+import errno
 import signal
+import socket
 
 from chatserver.medusa import asyncore_25 as asyncore
 from chatserver.helpers import Helpers
+from chatserver.relay import relay_channel
+from chatserver.timers import clock
 
 class ChatServerStates:
     RUNNING = 1
+    RESTARTING = 0
     SHUTDOWN = -1
 
 class ChatServer:
 
+    # how often a reload looks at whether the new chatserverd is up, and
+    # a draining one closes some of its remaining clients
+    reload_interval = 0.1
+    drain_interval = 1
+
     def __init__(self, helpers):
         self.helpers = helpers
+        self.registered = {}
+        # a worker is drained by its master, which does the reloading
+        self.worker = False
+        self.draining = False
+        self.drain_deadline = None
 
     def main(self):
         self.run()
@@ -23,6 +39,9 @@ class ChatServer:
     def run(self):
         try:
             self.helpers.openchatserver(self)
+            self.helpers.open_admin()
+            self.helpers.open_cluster()
+            self.helpers.open_bridge(self.helpers.inherited_bridge())
             self.helpers.setsignals()
             self.helpers.daemonize()
             self.helpers.write_pidfile()
@@ -30,73 +49,439 @@ class ChatServer:
         finally:
             self.helpers.cleanup()
 
+    def run_worker(self, relay_sock):
+        # runs in a process forked by ChatServerMaster, which owns the
+        # pidfile and has already daemonized
+        self.worker = True
+        self.helpers.after_fork()
+        if not self.helpers.chatserver:
+            self.helpers.openchatserver(self)
+        self.helpers.open_admin()
+        self.helpers.open_relay(relay_sock, self.relay_closed)
+        self.helpers.setsignals()
+        self.runforever()
+
+    def relay_closed(self, relay):
+        self.helpers.relay = None
+        self.helpers.logger.log('relay to master closed, shutting down')
+        self.helpers.mood = ChatServerStates.SHUTDOWN
+
     def runforever(self):
+        # longest sleep in poll(), signals are looked at in between
         timeout = 1
 
         socket_map = self.helpers.get_socket_map()
+        poller = self.helpers.poller
+        timers = self.helpers.timers
+        metrics = self.helpers.metrics
         self.helpers.mood = ChatServerStates.RUNNING
 
+        if self.helpers.engine is not None:
+            # --engine=asyncio or uvloop runs its own loop
+            self.helpers.engine.runforever(self)
+            return
+
+        if self.helpers.fanout is not None:
+            # threads are started here, in the process which runs the loop
+            self.helpers.fanout.start()
+
+        if self.helpers.cluster is not None:
+            # the peers are dialed once we are daemonized
+            self.helpers.cluster.start()
+
+        # only the fds in asyncore.dirty, whose dispatchers reported a
+        # change in their buffers, are re-examined each time round;
+        # everything is only looked at again when something changed for
+        # all of them
+        dirty = asyncore.dirty
+        resync = True
+        reads_paused = False
+        # when the last poll() returned; what lies between that and the
+        # next poll() is the time one turn of the loop took
+        polled = None
+
         while 1:
 
             self.helpers.broadcast_messages()
-            self.helpers.clear_data_map()
 
-            combined_map = {}
-            combined_map.update(socket_map)
+            # every channel's readable() depends on the aggregate backlog
+            if asyncore.out_backlog.full() != reads_paused:
+                reads_paused = not reads_paused
+                resync = True
+                if reads_paused:
+                    self.helpers.logger.warn('%d bytes waiting to be sent, '
+                                             'not reading from clients',
+                                             asyncore.out_backlog.nbytes)
+                else:
+                    self.helpers.logger.info('backlog down to %d bytes, '
+                                             'reading from clients again',
+                                             asyncore.out_backlog.nbytes)
+
+            if resync or poller.resync:
+                self.update_interest(socket_map, list(socket_map.keys()))
+                self.prune_interest(socket_map)
+                resync = poller.resync = False
+            elif dirty:
+                self.update_interest(socket_map, dirty)
+            dirty.clear()
 
             if self.helpers.mood < ChatServerStates.RUNNING:
                 raise asyncore.ExitNow
 
-            for fd, dispatcher in combined_map.items():
-                if dispatcher.readable():
-                    self.helpers.poller.register_readable(fd)
-                if dispatcher.writable():
-                    self.helpers.poller.register_writable(fd)
-
-            r, w = self.helpers.poller.poll(timeout)
+            poll_timeout = timers.next_timeout()
+            if poll_timeout is None or poll_timeout > timeout:
+                poll_timeout = timeout
+            started = clock()
+            if polled is not None:
+                metrics.loop_seconds.observe(started - polled)
+            r, w = poller.poll(poll_timeout)
+            polled = clock()
+            metrics.poll_seconds.observe(polled - started)
+            metrics.poll_events.observe(len(r) + len(w))
 
             for fd in r:
-                if fd in combined_map:
+                dispatcher = socket_map.get(fd)
+                if dispatcher is not None:
                     try:
-                        dispatcher = combined_map[fd]
-                        self.helpers.logger.log('read event caused by %s' % dispatcher.repr())
+                        self.helpers.logger.trace('read event caused by %r', dispatcher)
                         dispatcher.handle_read_event()
                     except asyncore.ExitNow:
                         self.helpers.logger.log("ExitNow\n")
                         raise
                     except:
-                        combined_map[fd].handle_error()
+                        dispatcher.handle_error()
 
             for fd in w:
-                if fd in combined_map:
+                dispatcher = socket_map.get(fd)
+                if dispatcher is not None:
                     try:
-                        dispatcher = combined_map[fd]
-                        self.helpers.logger.log('write event caused by %s' % dispatcher.repr())
+                        self.helpers.logger.trace('write event caused by %r', dispatcher)
                         dispatcher.handle_write_event()
                     except asyncore.ExitNow:
                         self.helpers.logger.log("ExitNow\n")
                         raise
                     except:
-                        combined_map[fd].handle_error()
+                        dispatcher.handle_error()
+
+            # a read can fill the input buffer, which readable() looks at
+            dirty.update(r)
+
+            timers.run()
 
             self.handle_signal()
 
+    def update_interest(self, socket_map, fds):
+        poller = self.helpers.poller
+        registered = self.registered
+        for fd in fds:
+            dispatcher = socket_map.get(fd)
+            if dispatcher is None:
+                registered.pop(fd, None)
+                poller.unregister(fd)
+                continue
+            if registered.get(fd) is not dispatcher:
+                # the fd number has been reused by a new channel
+                poller.unregister(fd)
+                registered[fd] = dispatcher
+            poller.set_interest(fd, dispatcher.readable(), dispatcher.writable())
+
+    def prune_interest(self, socket_map):
+        for fd in list(self.registered.keys()):
+            if fd not in socket_map:
+                del self.registered[fd]
+                self.helpers.poller.unregister(fd)
+
     def handle_signal(self):
         sig = self.helpers.get_signal()
         if sig:
-            if sig in (signal.SIGTERM):
-                self.helpers.logger.log('received SIGTERM indicating exit request')
-                self.helpers.mood = SupervisorStates.SHUTDOWN
+            if sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+                self.helpers.logger.info('received %s indicating exit request', signame(sig))
+                self.helpers.mood = ChatServerStates.SHUTDOWN
+            elif sig in (signal.SIGHUP, signal.SIGUSR2):
+                self.helpers.logger.info('received %s indicating reload request', signame(sig))
+                if self.worker:
+                    self.drain()
+                else:
+                    self.reload()
+
+    def reload(self):
+        if self.draining or self.helpers.successor is not None:
+            self.helpers.logger.warn('already reloading')
+            return
+        try:
+            bridge = self.helpers.start_reload()
+        except OSError as why:
+            self.helpers.logger.error('cannot reload: %s', why)
+            return
+        self.helpers.open_bridge(bridge)
+        self.helpers.timers.schedule(self.reload_interval, self.check_reload)
+
+    def check_reload(self):
+        status = self.helpers.reload_status()
+        if status is None:
+            self.helpers.timers.schedule(self.reload_interval, self.check_reload)
+        elif status:
+            self.drain()
+
+    def drain(self):
+        """
+        Stop accepting and let the clients go a few at a time, so they do
+        not all reconnect to the new chatserverd at once; whoever is still
+        connected after --drain-timeout is closed then.  Until the last
+        one has gone, messages go both ways over the bridge to the new
+        chatserverd.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        self.helpers.stop_accepting()
+        self.drain_deadline = clock() + self.helpers.server_config['drain_timeout']
+        self.helpers.logger.info('draining %d clients',
+                                 len(self.helpers.client_channels()))
+        self.drain_step()
+
+    def drain_step(self):
+        channels = self.helpers.client_channels()
+        if not channels:
+            self.helpers.logger.info('drained, shutting down')
+            self.helpers.mood = ChatServerStates.SHUTDOWN
+            return
+        left = self.drain_deadline - clock()
+        if left > self.drain_interval:
+            # spread over what is left of the drain timeout
+            channels = channels[:int(math.ceil(len(channels) * self.drain_interval / left))]
+        for channel in channels:
+            channel.close()
+        self.helpers.timers.schedule(self.drain_interval, self.drain_step)
+
+class ChatServerMaster:
+    """
+    Forks the event loop workers, relays broadcasts between them over
+    Unix socketpairs and restarts any worker which dies.
+    """
+
+    # a worker dying sooner than this after being forked is restarted
+    # only after the same delay, so a crash loop cannot spin the master
+    restart_delay = 1
+
+    def __init__(self, helpers):
+        self.helpers = helpers
+        self.workers = {}       # pid -> (relay_channel, start time, number)
+        self.relay_map = {}
+        self.pending = []       # (time, number) of replacements to fork
+        # when to drain the workers once a reload has started the new
+        # master, whose workers need a moment to bind
+        self.drain_at = None
+        self.draining = False
+
+    def main(self):
+        self.run()
+
+    def run(self):
+        config = self.helpers.server_config
+        config['reuse_port'] = hasattr(socket, 'SO_REUSEPORT')
+        try:
+            if not config['reuse_port']:
+                # no SO_REUSEPORT, the workers share our listener
+                self.helpers.openchatserver(self)
+            self.open_bridge(self.helpers.inherited_bridge())
+            self.helpers.setsignals()
+            self.helpers.daemonize()
+            self.helpers.write_pidfile()
+            self.helpers.mood = ChatServerStates.RUNNING
+            for number in range(config['workers']):
+                self.spawn(number)
+            self.runforever()
+        finally:
+            self.stop_workers()
+            self.helpers.close_bridge()
+            self.helpers.cleanup()
+
+    def spawn(self, number):
+        # a replacement takes over the number, and so the admin port,
+        # of the worker it replaces
+        master_end, worker_end = socket.socketpair()
+        self.helpers.logger.before_fork()
+        pid = os.fork()
+        if pid == 0:
+            master_end.close()
+            for relay, started, n in self.workers.values():
+                relay.socket.close()
+            if self.helpers.bridge is not None:
+                self.helpers.bridge.socket.close()
+                self.helpers.bridge = None
+            self.relay_map.clear()
+            self.helpers.worker_number = number
+            status = 0
+            try:
+                try:
+                    ChatServer(self.helpers).run_worker(worker_end)
+                except asyncore.ExitNow:
+                    pass
+                self.helpers.close_chatserver()
+            except:
+                nil, t, v, tbinfo = asyncore.compact_traceback()
+                self.helpers.logger.log('worker %s crashed: %s:%s %s' % (
+                    os.getpid(), t, v, tbinfo))
+                status = 1
+            finally:
+                # os._exit() skips everything else on the way out; what
+                # the worker logged last would be lost with the writer
+                try:
+                    self.helpers.close_logger()
+                finally:
+                    os._exit(status)
+
+        self.helpers.logger.after_fork()
+        worker_end.close()
+        relay = relay_channel(master_end, self.helpers.logger,
+                              self.relay_received, map=self.relay_map)
+        self.workers[pid] = (relay, time.time(), number)
+        self.helpers.logger.log('spawned worker %s' % pid)
+
+    def open_bridge(self, sock):
+        # what comes over the bridge goes to every worker, like what one
+        # worker relays to the others
+        self.helpers.open_bridge(sock, self.relay_received, self.relay_map)
+
+    def relay_received(self, sender, room, message):
+        relays = [relay for relay, started, number in self.workers.values()]
+        if self.helpers.bridge is not None:
+            relays.append(self.helpers.bridge)
+        for relay in relays:
+            if relay is not sender:
+                relay.forward(((room, message),))
+
+    def runforever(self):
+        while 1:
+            if self.helpers.mood < ChatServerStates.RUNNING:
+                raise asyncore.ExitNow
+
+            if self.relay_map:
+                asyncore.loop(timeout=1.0, use_poll=True, map=self.relay_map,
+                              count=1)
+            else:
+                # every worker is waiting to be restarted
+                time.sleep(self.restart_delay)
+
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                self.spawn(self.pending.pop(0)[1])
+
+            if self.helpers.successor is not None:
+                if self.helpers.reload_status():
+                    self.drain_at = now + self.restart_delay
+            if self.drain_at is not None and self.drain_at <= now:
+                self.drain()
+            if self.draining and not self.workers:
+                self.helpers.logger.info('workers drained, shutting down')
+                self.helpers.mood = ChatServerStates.SHUTDOWN
+
+            self.handle_signal()
+
+    def reload(self):
+        if self.draining or self.drain_at is not None or \
+           self.helpers.successor is not None:
+            self.helpers.logger.warn('already reloading')
+            return
+        try:
+            bridge = self.helpers.start_reload()
+        except OSError as why:
+            self.helpers.logger.error('cannot reload: %s', why)
+            return
+        self.open_bridge(bridge)
+
+    def drain(self):
+        # the workers drain their clients and exit, and are not replaced
+        self.drain_at = None
+        self.draining = True
+        self.pending = []
+        self.helpers.stop_accepting()
+        for pid in list(self.workers.keys()):
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except OSError:
+                pass
+
+    def reap_workers(self):
+        while 1:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as why:
+                if why.args[0] == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid == self.helpers.successor:
+                # the first process of the new master, see reload_status()
+                self.helpers.successor_status = status
+                continue
+            if pid not in self.workers:
+                continue
+            relay, started, number = self.workers.pop(pid)
+            relay.close()
+            self.helpers.logger.log('worker %s exited with status %s' % (pid, status))
+            if self.helpers.mood < ChatServerStates.RUNNING or self.draining:
+                continue
+            now = time.time()
+            if now - started < self.restart_delay:
+                self.pending.append((now + self.restart_delay, number))
+            else:
+                self.spawn(number)
+
+    def stop_workers(self):
+        for pid in list(self.workers.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + 5
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+
+        for pid in list(self.workers.keys()):
+            self.helpers.logger.log('killing worker %s' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.reap_workers()
+
+    def handle_signal(self):
+        sig = self.helpers.get_signal()
+        while sig:
+            if sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+                self.helpers.logger.info('received %s indicating exit request', signame(sig))
+                self.helpers.mood = ChatServerStates.SHUTDOWN
+            elif sig == signal.SIGCHLD:
+                self.reap_workers()
+            elif sig in (signal.SIGHUP, signal.SIGUSR2):
+                self.helpers.logger.info('received %s indicating reload request', signame(sig))
+                self.reload()
+            sig = self.helpers.get_signal()
+
+def signame(sig):
+    for name in dir(signal):
+        if name.startswith('SIG') and not name.startswith('SIG_'):
+            if getattr(signal, name) == sig:
+                return name
+    return 'signal %s' % sig
 
 # Main program
 def main():
     assert os.name == "posix", "This code makes Unix-specific assumptions"
-    print "cwd: %s" % os.getcwd()
+    print("cwd: %s" % os.getcwd())
     sys.path.append(os.getcwd())
     while 1:
         helpers = Helpers()
         helpers.getopts()
-        d = ChatServer(helpers)
+        if helpers.server_config['workers'] > 1:
+            d = ChatServerMaster(helpers)
+        else:
+            d = ChatServer(helpers)
 
         try:
             d.main()
@@ -106,7 +491,7 @@ def main():
         helpers.close_chatserver()
         helpers.close_logger()
 
-        if helpers.mood < ChatServerStates.SHUTDOWN:
+        if helpers.mood < ChatServerStates.RESTARTING:
             break
 
 if __name__ == "__main__":
@@ -0,0 +1,274 @@
+"""
+What the tests share.  The unit tests get a logger which keeps its
+records and chat servers in their own process, whose channels they
+drive by hand.  The functional tests get chatserverd processes started
+on free ports with a pidfile of their own, and blocking clients which
+read with a deadline.
+
+The daemons are the real thing, started and stopped the way chatbench
+does it, so every functional test goes through the sockets and the
+event loop of the engine it is run with.
+"""
+
+import os
+import re
+import sys
+import time
+import select
+import signal
+import socket
+import struct
+import subprocess
+
+from chatserver.medusa import asyncore_25 as asyncore
+from chatserver.chat_server import af_inet_server
+from chatserver.timers import TimerWheel
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHATSERVERD = os.path.join(os.path.dirname(HERE), 'chatserverd.py')
+
+# the peer prefix of a message, as the server adds it
+PREFIX = re.compile(br'\[[^\]]*\]: ')
+
+# --------------------------------------------------
+# unit tests
+# --------------------------------------------------
+
+class NullLogger:
+    '''A logger which keeps what it is given in records.'''
+
+    def __init__(self):
+        self.records = []
+
+    def log(self, message, *args):
+        if args:
+            message = message % args
+        self.records.append(message)
+
+    critical = error = warn = info = debug = trace = log
+
+class Helpers:
+    '''What pollers and fan-out pools ask of the helpers.'''
+
+    def __init__(self):
+        self.logger = NullLogger()
+
+class ManualWheel(TimerWheel):
+    '''A TimerWheel whose clock only moves when advance() is called.'''
+
+    def __init__(self, **options):
+        self.time = 0.0
+        TimerWheel.__init__(self, **options)
+        self.start = 0.0
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += seconds
+        return self.run()
+
+def chat_server(**options):
+    # a chat server on a free port of the loopback interface, which
+    # nothing polls: the tests call its handlers themselves
+    return af_inet_server('127.0.0.1', 0, NullLogger(), **options)
+
+def accept(server):
+    # a connected client socket and the server's channel for it
+    client = socket.create_connection(server.socket.getsockname(), timeout=5)
+    before = set(asyncore.socket_map)
+    server.handle_accept()
+    channels = [channel for fd, channel in asyncore.socket_map.items()
+                if fd not in before]
+    assert len(channels) == 1
+    return client, channels[0]
+
+def read(channel):
+    # one handle_read() of what the client has sent
+    select.select([channel.socket], [], [], 5)
+    channel.handle_read()
+
+def queued():
+    # the data of the messages read since last time
+    return [message[2] for message in asyncore.data_queue.drain()]
+
+def close_all():
+    for dispatcher in list(asyncore.socket_map.values()):
+        dispatcher.close()
+    asyncore.socket_map.clear()
+    asyncore.dirty.clear()
+    asyncore.data_queue.drain()
+
+# --------------------------------------------------
+# functional tests
+# --------------------------------------------------
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def can_connect(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.connect(('127.0.0.1', port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def wait_for(predicate, timeout=5.0, interval=0.05):
+    # the predicate's last value, true or not once the timeout is up
+    deadline = time.time() + timeout
+    while 1:
+        value = predicate()
+        if value or time.time() >= deadline:
+            return value
+        time.sleep(interval)
+
+class Server:
+    '''One chatserverd, daemonized, with its own port and pidfile.'''
+
+    def __init__(self, directory, args=(), port=None, name='chatserver'):
+        self.port = port or free_port()
+        self.pidfile = os.path.join(directory, '%s.pid' % name)
+        self.args = ['--port=%d' % self.port,
+                     '--pidfile=%s' % self.pidfile] + list(args)
+        self.pid = None
+
+    def start(self):
+        command = [sys.executable, CHATSERVERD] + self.args
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(command, stdout=devnull) != 0:
+                raise RuntimeError('could not start %s' % ' '.join(command))
+        self.pid = wait_for(self.read_pidfile)
+        if self.pid is None or not wait_for(lambda: can_connect(self.port)):
+            self.stop()
+            raise RuntimeError('server did not come up on port %d' % self.port)
+        return self
+
+    def read_pidfile(self):
+        try:
+            with open(self.pidfile) as f:
+                return int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def stop(self):
+        pid = self.pid or self.read_pidfile()
+        self.pid = None
+        if pid is None:
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            return
+        if not wait_for(lambda: not os.path.exists('/proc/%d' % pid), 10):
+            os.kill(pid, signal.SIGKILL)
+
+    def client(self, framing='line'):
+        return Client(self.port, framing)
+
+def metrics(port):
+    # the counters and gauges on an admin port, name -> value
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    try:
+        sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        data = b''
+        while 1:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    values = {}
+    for line in data.decode('ascii').split('\r\n\r\n', 1)[-1].splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            name, value = line.split()
+            values[name] = float(value)
+    return values
+
+class Client:
+    '''
+    A blocking client.  Everything read is kept in buf until a read_*
+    method takes it, so a test can wait for what it expects without
+    losing what came with it.
+    '''
+
+    def __init__(self, port, framing='line'):
+        self.framing = framing
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.buf = b''
+        self.eof = False
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data):
+        if self.framing == 'length':
+            data = struct.pack('!I', len(data)) + data
+        elif self.framing == 'line':
+            data = data + b'\n'
+        self.sock.sendall(data)
+
+    def fill(self, timeout):
+        # reads for at most timeout seconds, returns whether anything came
+        if self.eof:
+            return False
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.timeout:
+            return False
+        except socket.error:
+            data = b''
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def read_until(self, needle, timeout=5.0):
+        # everything up to and including needle, None if it did not come
+        deadline = time.time() + timeout
+        while needle not in self.buf:
+            left = deadline - time.time()
+            if left <= 0 or (not self.fill(left) and self.eof):
+                return None
+        end = self.buf.index(needle) + len(needle)
+        data, self.buf = self.buf[:end], self.buf[end:]
+        return data
+
+    def read_quiet(self, quiet=0.3, timeout=5.0):
+        # everything read until nothing came for quiet seconds
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.fill(quiet):
+            pass
+        data, self.buf = self.buf, b''
+        return data
+
+    def messages(self, quiet=0.3):
+        # what was read as a list of messages, prefixes taken off
+        data = self.read_quiet(quiet)
+        if self.framing == 'length':
+            items = []
+            while len(data) >= 4:
+                size = struct.unpack('!I', data[:4])[0]
+                items.append(data[4:4 + size])
+                data = data[4 + size:]
+        else:
+            items = data.split(b'\n')
+        return [PREFIX.sub(b'', item, 1) for item in items if item]
+
+    def closed(self, timeout=5.0):
+        # whether the server closes the connection within timeout
+        deadline = time.time() + timeout
+        while not self.eof and time.time() < deadline:
+            self.fill(deadline - time.time())
+            self.buf = b''
+        return self.eof
@@ -0,0 +1,100 @@
+"""
+Unit tests of the output backlog and of what a chat channel does with a
+client which does not read what is sent to it.
+"""
+
+import pytest
+
+from chatserver.backlog import OutputBacklog
+from chatserver.medusa import asyncore_25 as asyncore
+
+from support import chat_server, accept, close_all
+
+def test_backlog_pauses_reads_between_the_watermarks():
+    backlog = OutputBacklog(max_bytes=100, low_bytes=40)
+    backlog.add(60)
+    assert not backlog.full()
+    backlog.add(40)
+    assert backlog.full()
+    backlog.remove(50)
+    assert backlog.full()
+    backlog.remove(10)
+    assert not backlog.full()
+    assert backlog.pauses == 1
+    assert backlog.peak_bytes == 100
+
+def test_backlog_collects_evictions_once():
+    backlog = OutputBacklog()
+    backlog.evict('a')
+    backlog.evict('b')
+    assert backlog.take_evictions() == ['a', 'b']
+    assert backlog.take_evictions() == []
+    assert backlog.evicted == 2
+
+# --------------------------------------------------
+# slow consumers
+# --------------------------------------------------
+
+MESSAGE = b'x' * 100
+
+@pytest.fixture
+def backlog(monkeypatch):
+    backlog = OutputBacklog()
+    monkeypatch.setattr(asyncore, 'out_backlog', backlog)
+    yield backlog
+    close_all()
+
+def slow_consumer(overflow):
+    # the channel of a client which never reads, with nothing queued
+    server = chat_server(binary=True, high_watermark=1000,
+                         low_watermark=400, overflow=overflow)
+    client, channel = accept(server)
+    channel.discard_buffers()
+    asyncore.out_backlog.nbytes = 0
+    return channel
+
+def test_disconnect_evicts_the_channel(backlog):
+    channel = slow_consumer('disconnect')
+    for i in range(10):
+        channel.push_data(MESSAGE)
+    assert not channel.evicted
+    channel.push_data(MESSAGE)
+    assert channel.evicted
+    assert backlog.take_evictions() == [channel]
+    # and nothing more is queued for it meanwhile
+    channel.push_data(MESSAGE)
+    assert channel.ac_out_bytes == 1000
+    assert backlog.dropped_messages == 2
+    assert backlog.nbytes == 1000
+
+def test_drop_newest_drops_until_the_low_watermark(backlog):
+    channel = slow_consumer('drop-newest')
+    for i in range(10):
+        channel.push_data(MESSAGE)
+    channel.push_data(b'dropped')
+    assert channel.overflowing
+    # sending 550 bytes is not enough to take new messages again
+    channel.consume_out_buffer(550)
+    channel.push_data(b'dropped')
+    assert channel.ac_out_bytes == 450
+    channel.consume_out_buffer(50)
+    assert not channel.overflowing
+    channel.push_data(b'queued')
+    assert channel.ac_out_bytes == 406
+    assert channel.dropped_messages == 2
+    assert backlog.nbytes == 406
+
+def test_drop_oldest_drops_whole_messages(backlog):
+    channel = slow_consumer('drop-oldest')
+    for i in range(10):
+        channel.push_data(b'%02d%s' % (i, MESSAGE[2:]))
+    # half of the first message has gone out, it has to go out whole
+    channel.consume_out_buffer(50)
+    channel.push_data(b'10' + MESSAGE[2:])
+    channel.push_data(b'11' + MESSAGE[2:])
+    queued = [bytes(chunk[:2]) for chunk in channel.ac_out_buffer]
+    # down to the low watermark, less the message which went over it
+    assert queued == [b'00', b'08', b'09', b'10', b'11']
+    assert channel.ac_out_bytes == 450
+    assert backlog.nbytes == 450
+    assert channel.dropped_messages == 7
@@ -0,0 +1,172 @@
+"""
+Functional tests of a cluster of three chatserverd nodes on localhost,
+each with its own --pidfile, --cluster-port and --node-id, and unit
+tests of what a node does when it hears of a nickname it gave out too.
+
+    python -m pytest tests/test_cluster.py
+"""
+
+import pytest
+
+from chatserver.cluster import Cluster
+
+from support import Server, metrics, free_port, wait_for
+from support import Helpers, chat_server, accept, close_all
+
+NODES = 3
+
+class Node(Server):
+    '''A cluster node with an admin port to read its counters from.'''
+
+    def __init__(self, directory, index, cluster_ports, args=()):
+        self.admin_port = free_port()
+        peers = ','.join('127.0.0.1:%d' % port
+                         for port in cluster_ports[index + 1:])
+        args = ['--framing=line',
+                '--node-id=node%d' % index,
+                '--cluster-port=%d' % cluster_ports[index],
+                '--admin-port=%d' % self.admin_port] + list(args)
+        if peers:
+            args.append('--peers=%s' % peers)
+        Server.__init__(self, directory, args, name='node%d' % index)
+
+    def metrics(self):
+        return metrics(self.admin_port)
+
+@pytest.fixture
+def nodes(tmp_path):
+    # every node dials the ones after it, so all of them are linked
+    cluster_ports = [free_port() for i in range(NODES)]
+    nodes = [Node(str(tmp_path), i, cluster_ports) for i in range(NODES)]
+    try:
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            assert wait_for(lambda: node.metrics()['chatserver_cluster_nodes']
+                            == NODES - 1, 10)
+        yield nodes
+    finally:
+        for node in nodes:
+            node.stop()
+
+def connect(nodes):
+    # a client on each node, past the greetings they get of each other
+    clients = [node.client() for node in nodes]
+    for client in clients:
+        client.read_quiet()
+    return clients
+
+def settle():
+    # subscriptions go out with the next batch to the peers
+    wait_for(lambda: False, 0.5)
+
+def counter(node, name):
+    return node.metrics()['chatserver_cluster_%s_total' % name]
+
+def test_lobby_messages_arrive_once_without_echo(nodes):
+    a, b, c = connect(nodes)
+    local = nodes[0].client()
+    settle()
+    for client in (a, b, c, local):
+        client.read_quiet()
+    forwarded = [counter(node, 'forwarded') for node in nodes]
+    a.send(b'hello cluster')
+    assert local.messages() == [b'hello cluster']
+    assert b.messages() == [b'hello cluster']
+    assert c.messages() == [b'hello cluster']
+    assert a.messages() == []
+    # and nothing is passed on from one peer to the next
+    assert [counter(node, 'forwarded') for node in nodes] == [
+        forwarded[0] + NODES - 1, forwarded[1], forwarded[2]]
+
+def test_room_messages_go_to_subscribed_nodes_only(nodes):
+    a, b, c = connect(nodes)
+    for client in (a, b):
+        client.send(b'/join #r')
+        assert client.read_until(b'joined #r') is not None
+    settle()
+    for client in (a, b, c):
+        client.read_quiet()
+    forwarded = counter(nodes[0], 'forwarded')
+    received = counter(nodes[2], 'received')
+    a.send(b'to the room')
+    assert b.messages() == [b'to the room']
+    assert a.messages() == []
+    assert c.messages() == []
+    # node2 has no one in #r, so it is not even sent there
+    assert counter(nodes[0], 'forwarded') == forwarded + 1
+    assert counter(nodes[2], 'received') == received
+
+def test_direct_messages_reach_remote_nicknames(nodes):
+    a, b, c = connect(nodes)
+    c.send(b'/nick Carol')
+    assert c.read_until(b'you are now Carol') is not None
+    settle()
+    for client in (a, b, c):
+        client.read_quiet()
+    a.send(b'/msg carol just for you')
+    assert c.messages() == [b'(private) just for you']
+    assert a.messages() == []
+    assert b.messages() == []
+
+def test_a_remote_nickname_is_taken(nodes):
+    a, b, c = connect(nodes)
+    c.send(b'/nick Carol')
+    assert c.read_until(b'you are now Carol') is not None
+    settle()
+    a.send(b'/nick carol')
+    assert a.read_until(b'nickname carol is taken') is not None
+    # and free again once its client has gone
+    c.close()
+    settle()
+    a.send(b'/nick carol')
+    assert a.read_until(b'you are now carol') is not None
+
+def test_a_nickname_claimed_twice_stays_with_one_node(nodes):
+    a, b, c = connect(nodes)
+    a.send(b'/nick dave')
+    b.send(b'/nick dave')
+    settle()
+    outputs = [a.read_quiet(), b.read_quiet()]
+    holders = [client for client, output in zip((a, b), outputs)
+               if b'taken' not in output]
+    assert len(holders) == 1
+    c.send(b'/msg dave which one')
+    assert holders[0].messages() == [b'(private) which one']
+    assert [client for client in (a, b) if client.messages()] == []
+
+# --------------------------------------------------
+# nicknames given out on two nodes at once
+# --------------------------------------------------
+
+class Link:
+    '''What Cluster.claimed() looks at of a peer_channel.'''
+
+    def __init__(self, node):
+        self.node = node
+
+@pytest.fixture
+def cluster():
+    helpers = Helpers()
+    server = chat_server(framing='line')
+    helpers.chatserver = [(None, server)]
+    helpers.find_target = lambda name: server.nicks.get(name)
+    cluster = Cluster('node1', [], helpers)
+    server.cluster = server.nicks.watcher = cluster
+    client, channel = accept(server)
+    channel.set_nick('Dave')
+    cluster.changes.clear()
+    yield cluster, channel
+    close_all()
+
+def test_the_node_whose_id_sorts_first_keeps_the_nickname(cluster):
+    cluster, channel = cluster
+    cluster.claimed(Link('node2'), ['dave', '#room'])
+    assert channel.nick.name == 'dave'
+    cluster.claimed(Link('node0'), ['#room', 'dave'])
+    assert channel.nick is None
+    assert channel.server.nicks.get('dave') is None
+    assert channel.prefix.startswith('[127.0.0.1:')
+    assert cluster.changes == {'dave': False}
+    data = b''.join(bytes(chunk) for chunk in channel.ac_out_buffer)
+    assert data.endswith(b'*** nickname dave is taken on node0\n')
@@ -0,0 +1,195 @@
+"""
+Functional tests of chatserverd, run once with each engine so that the
+asyncore and asyncio engines keep behaving the same.
+
+    python -m pytest tests
+"""
+
+import re
+import socket
+import struct
+
+import pytest
+
+from support import Server, metrics, free_port, wait_for
+
+ENGINES = ('asyncore', 'asyncio')
+
+@pytest.fixture(params=ENGINES)
+def engine(request):
+    return request.param
+
+@pytest.fixture
+def serve(engine, tmp_path):
+    servers = []
+    def serve(*args):
+        server = Server(str(tmp_path), ('--engine=%s' % engine,) + args)
+        servers.append(server)
+        return server.start()
+    yield serve
+    for server in servers:
+        server.stop()
+
+def connect(server, n, framing='line'):
+    # n clients, past the greetings they get of each other
+    clients = [server.client(framing) for i in range(n)]
+    for client in clients:
+        client.read_quiet()
+    return clients
+
+# --------------------------------------------------
+# framing
+# --------------------------------------------------
+
+def test_raw_framing(serve):
+    server = serve()
+    a, b, c = connect(server, 3, framing='raw')
+    a.send(b'hello there')
+    assert b.read_until(b'hello there') is not None
+    assert c.read_until(b'hello there') is not None
+    # nothing comes back to the sender
+    assert a.read_quiet() == b''
+
+def test_line_framing_joins_and_splits_reads(serve):
+    server = serve('--framing=line')
+    a, b = connect(server, 2)
+    a.sock.sendall(b'par')
+    a.sock.sendall(b'tial\nsecond\n')
+    assert b.messages() == [b'partial', b'second']
+
+def test_length_framing(serve):
+    server = serve('--framing=length')
+    a, b = connect(server, 2, framing='length')
+    a.send(b'with a\nnewline')
+    a.send(b'second')
+    assert b.messages() == [b'with a\nnewline', b'second']
+
+def test_line_without_terminator_is_cut_off(serve):
+    server = serve('--framing=line')
+    a, b, c = connect(server, 3)
+    try:
+        for i in range(4):
+            a.sock.sendall(b'x' * (1 << 20))
+    except socket.error:
+        pass
+    assert a.closed()
+    b.send(b'still here')
+    assert c.read_until(b'still here') is not None
+
+def test_oversized_length_frame_is_refused(serve):
+    server = serve('--framing=length')
+    a, = connect(server, 1, framing='length')
+    a.sock.sendall(struct.pack('!I', 1 << 30))
+    assert a.closed()
+
+# --------------------------------------------------
+# rooms, nicknames and history
+# --------------------------------------------------
+
+def test_rooms(serve):
+    server = serve('--framing=line')
+    a, b, c = connect(server, 3)
+    a.send(b'/join #r')
+    assert a.read_until(b'joined #r (1 members)') is not None
+    b.send(b'/join #r')
+    assert b.read_until(b'joined #r (2 members)') is not None
+    a.send(b'to the room')
+    assert b.messages() == [b'to the room']
+    # the lobby does not get room messages, room members not the lobby's
+    assert c.messages() == []
+    c.send(b'to the lobby')
+    assert a.messages() == []
+    b.send(b'/part')
+    assert b.read_until(b'left #r') is not None
+    c.send(b'back in the lobby')
+    assert b.messages() == [b'back in the lobby']
+
+def test_direct_messages(serve):
+    server = serve('--framing=line')
+    a, b, c = connect(server, 3)
+    b.send(b'/nick Bob')
+    assert b.read_until(b'you are now Bob') is not None
+    c.send(b'/nick bob')
+    assert c.read_until(b'nickname bob is taken') is not None
+    a.send(b'/msg BOB just for you')
+    assert b.messages() == [b'(private) just for you']
+    assert c.messages() == []
+    a.send(b'/msg nobody hello')
+    assert a.read_until(b'no such nickname nobody') is not None
+
+def test_history_replays_the_last_messages(serve):
+    server = serve('--framing=line', '--history=3')
+    a, = connect(server, 1)
+    for i in range(6):
+        a.send(b'message %d' % i)
+    wait_for(lambda: False, 0.3)
+    b = server.client()
+    replayed = b.read_until(b'*** history')
+    assert replayed is not None
+    assert re.findall(br'message \d', replayed) == [b'message 3', b'message 4',
+                                                    b'message 5']
+
+# --------------------------------------------------
+# workers
+# --------------------------------------------------
+
+def test_workers_deliver_everywhere_once(serve):
+    server = serve('--framing=line', '--workers=2')
+    clients = connect(server, 6)
+    for i, client in enumerate(clients):
+        client.send(b'from %d' % i)
+    for i, client in enumerate(clients):
+        got = sorted(m for m in client.messages(0.5) if m.startswith(b'from'))
+        assert got == sorted(b'from %d' % j for j in range(6) if j != i)
+
+# --------------------------------------------------
+# slow consumers, idle clients and rate limits
+# --------------------------------------------------
+
+def flood(sender, n=2000, size=1000):
+    payload = b'x' * size
+    for i in range(n):
+        sender.send(b'%06d %s' % (i, payload))
+
+def test_overflow_disconnect(serve):
+    admin = free_port()
+    server = serve('--framing=line', '--high-watermark=65536',
+                   '--low-watermark=16384', '--overflow=disconnect',
+                   '--sndbuf=16384', '--admin-port=%d' % admin)
+    sender, slow = connect(server, 2)
+    flood(sender)
+    assert wait_for(lambda: metrics(admin)['chatserver_evicted_total'] >= 1)
+    assert slow.closed()
+
+def test_overflow_drop_newest_keeps_messages_whole(serve):
+    admin = free_port()
+    server = serve('--framing=line', '--high-watermark=65536',
+                   '--low-watermark=16384', '--overflow=drop-newest',
+                   '--sndbuf=16384', '--admin-port=%d' % admin)
+    sender, slow = connect(server, 2)
+    flood(sender)
+    assert wait_for(lambda: metrics(admin)['chatserver_dropped_messages_total'] > 0)
+    received = slow.messages(1.0)
+    assert 0 < len(received) < 2000
+    assert all(re.match(br'^\d{6} x{1000}$', m) for m in received)
+    assert not slow.eof
+
+def test_idle_clients_are_closed(serve):
+    server = serve('--framing=line', '--idle-timeout=1')
+    quiet, talking = connect(server, 2)
+    for i in range(6):
+        talking.send(b'still here')
+        wait_for(lambda: False, 0.3)
+    assert quiet.closed(3)
+    talking.read_quiet()
+    assert not talking.eof
+
+def test_message_rate_limit(serve):
+    server = serve('--framing=line', '--max-message-rate=10')
+    sender, reader = connect(server, 2)
+    sender.sock.sendall(b''.join(b'flood %d\n' % i for i in range(200)))
+    wait_for(lambda: False, 1.0)
+    received = [m for m in reader.messages(0.1) if m.startswith(b'flood')]
+    # a burst of 10 and 10 a second
+    assert 10 <= len(received) <= 30
+    assert received == [b'flood %d' % i for i in range(len(received))]
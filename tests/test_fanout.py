@@ -0,0 +1,81 @@
+"""
+Unit tests of the fan-out shards, whose work() the tests run in their
+own thread instead of the shard's.
+"""
+
+import pytest
+
+from chatserver import poller
+from chatserver.fanout import FanoutPool, PUSH, CLOSE
+from chatserver.timers import clock
+
+from support import Helpers, ManualWheel, chat_server, accept, queued, close_all
+
+@pytest.fixture
+def sharded():
+    timers = ManualWheel(tick=1.0)
+    server = chat_server(binary=True, fanout_threads=2, timers=timers,
+                         keepalive=30)
+    server.fanout = FanoutPool(server, 2, poller.SelectPoller, Helpers())
+    for shard in server.fanout.shards:
+        shard.open()
+    yield server, timers
+    close_all()
+    for shard in server.fanout.shards:
+        shard.close()
+
+def work(server):
+    for shard in server.fanout.shards:
+        shard.work()
+
+def received(client, size):
+    client.settimeout(5)
+    data = b''
+    while len(data) < size:
+        data += client.recv(size - len(data))
+    return data
+
+def test_messages_go_out_in_the_order_they_were_queued(sharded):
+    server, timers = sharded
+    clients = [accept(server) for i in range(3)]
+    queued()
+    sender, channel = clients[0]
+    channel.push_data(b'before\n')
+    server.fanout.put([(1, channel._fileno, b'one\n', None),
+                       (2, channel._fileno, b'two\n', None)])
+    channel.push_data(b'after\n')
+    work(server)
+    # the sender's messages go to everyone else, and what was pushed to
+    # it is not overtaken by the batch
+    assert received(sender, 13) == b'before\nafter\n'
+    for client, other in clients[1:]:
+        assert received(client, 8) == b'one\ntwo\n'
+
+def test_only_the_shard_writes(sharded):
+    server, timers = sharded
+    client, channel = accept(server)
+    shard = channel.shard
+    channel.push_data(b'pushed\n')
+    assert [op for op, a, b in shard.inbox] == [PUSH]
+    assert not channel.writable()
+    assert channel.ac_out_bytes == 0
+    work(server)
+    assert received(client, 7) == b'pushed\n'
+    channel.close()
+    assert [op for op, a, b in shard.inbox] == [CLOSE]
+    # the loop thread has let go of it, the shard closes the socket
+    assert channel.socket.fileno() != -1
+    work(server)
+    assert channel.socket.fileno() == -1
+
+def test_keepalive_leaves_a_channel_with_recent_output_alone(sharded):
+    server, timers = sharded
+    client, channel = accept(server)
+    shard = channel.shard
+    channel.last_output = clock()
+    timers.advance(30)
+    assert len(shard.inbox) == 0
+    # nothing sent for longer than the keepalive, the shard pings it
+    channel.last_output = clock() - 31
+    timers.advance(30)
+    assert [op for op, a, b in shard.inbox] == [PUSH]
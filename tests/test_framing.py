@@ -0,0 +1,125 @@
+"""
+Unit tests of the input scanner of async_chat and of the line and
+length framing of chat channels.
+"""
+
+import struct
+
+import pytest
+
+from chatserver.medusa import asynchat_25 as asynchat
+
+from support import chat_server, accept, read, queued, close_all
+
+class scripted_channel(asynchat.async_chat):
+    '''Reads the chunks it is given, one per handle_read().'''
+
+    ac_in_empty = b''
+
+    def __init__(self, chunks, terminator):
+        asynchat.async_chat.__init__(self, map={})
+        self.chunks = list(chunks)
+        self.frames = []
+        self.pieces = []
+        self.set_terminator(terminator)
+
+    def recv(self, buffer_size):
+        return self.chunks.pop(0)
+
+    def collect_incoming_data(self, data):
+        self.pieces.append(data)
+
+    def found_terminator(self):
+        self.frames.append(b''.join(self.pieces))
+        self.pieces = []
+
+def scan(chunks, terminator=b'\r\n'):
+    channel = scripted_channel(chunks, terminator)
+    while channel.chunks:
+        channel.handle_read()
+    return channel
+
+def test_several_frames_in_one_read():
+    channel = scan([b'one\r\ntwo\r\nthree\r\n'])
+    assert channel.frames == [b'one', b'two', b'three']
+    assert channel.ac_in_buffer == b''
+
+def test_frame_split_across_reads():
+    channel = scan([b'on', b'e\r\ntw', b'o\r\n'])
+    assert channel.frames == [b'one', b'two']
+
+def test_terminator_split_across_reads():
+    channel = scan([b'one\r', b'\ntwo\r', b'\n'])
+    assert channel.frames == [b'one', b'two']
+    # what could be the start of a terminator waits for the next read
+    channel = scan([b'one\r'])
+    assert channel.frames == []
+    assert channel.ac_in_buffer == b'\r'
+
+def test_terminator_one_byte_per_read():
+    data = b'one\r\n\r\ntwo\r\n'
+    channel = scan([data[i:i + 1] for i in range(len(data))])
+    assert channel.frames == [b'one', b'', b'two']
+
+def test_numeric_terminator():
+    channel = scan([b'abc', b'defgh'], 4)
+    assert channel.frames == [b'abcd']
+    # it counts down to 0, after which everything is collected
+    assert channel.get_terminator() == 0
+    assert channel.pieces == [b'efgh']
+
+# --------------------------------------------------
+# chat channels
+# --------------------------------------------------
+
+@pytest.fixture
+def server():
+    servers = []
+    def server(**options):
+        servers.append(chat_server(binary=True, **options))
+        return servers[-1]
+    yield server
+    close_all()
+
+def test_line_framing(server):
+    client, channel = accept(server(framing='line'))
+    queued()
+    client.sendall(b'hel')
+    read(channel)
+    assert queued() == []
+    client.sendall(b'lo\nworld\n')
+    read(channel)
+    got = queued()
+    assert len(got) == 2
+    assert got[0].endswith(b']: hello\n')
+    assert got[1].endswith(b']: world\n')
+
+def test_line_without_terminator_closes_the_channel(server, monkeypatch):
+    client, channel = accept(server(framing='line'))
+    monkeypatch.setattr(type(channel), 'max_frame_size', 64)
+    client.sendall(b'x' * 40)
+    read(channel)
+    assert channel._fileno is not None
+    client.sendall(b'x' * 40)
+    read(channel)
+    assert channel._fileno is None
+    assert 'without a terminator' in channel.logger.records[-1]
+
+def test_length_framing(server):
+    client, channel = accept(server(framing='length'))
+    queued()
+    client.sendall(struct.pack('!I', 11) + b'with a\nline' + struct.pack('!I', 3))
+    read(channel)
+    client.sendall(b'abc')
+    read(channel)
+    got = queued()
+    assert len(got) == 2
+    assert got[0][4:].endswith(b']: with a\nline')
+    assert struct.unpack('!I', got[0][:4])[0] == len(got[0]) - 4
+    assert got[1][4:].endswith(b']: abc')
+
+def test_length_frame_over_the_limit_closes_the_channel(server):
+    client, channel = accept(server(framing='length'))
+    client.sendall(struct.pack('!I', channel.max_frame_size + 1))
+    read(channel)
+    assert channel._fileno is None
@@ -0,0 +1,184 @@
+"""
+Unit tests of the message journal, in a directory of their own.
+"""
+
+import os
+import errno
+
+import pytest
+
+from chatserver import journal as journal_module
+from chatserver.journal import Journal, RECORD
+from chatserver.metrics import Metrics
+
+from support import NullLogger
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / 'journal')
+
+def journal(directory, **options):
+    options.setdefault('fsync_interval', None)
+    j = Journal(directory, logger=NullLogger(), **options)
+    j.open()
+    return j
+
+def write(j, first, last, room=None):
+    for seq in range(first, last + 1):
+        j.append(seq, room, b'message %d\n' % seq)
+    j.commit()
+
+def segment_names(directory):
+    return sorted(os.listdir(directory))
+
+def test_reopened_journal_carries_on(directory):
+    j = journal(directory)
+    write(j, 1, 3)
+    j.close()
+    j = journal(directory)
+    assert j.last_seq == 3
+    write(j, 4, 4)
+    assert j.read_since(2) == [b'message 3\n', b'message 4\n']
+    j.close()
+
+def test_torn_record_is_cut_off(directory):
+    j = journal(directory)
+    write(j, 1, 3)
+    j.close()
+    path = j.segments[-1].path
+    good = os.path.getsize(path)
+    # a crash in the middle of the write of message 4
+    with open(path, 'ab') as f:
+        f.write(RECORD.pack(100, 4, 0) + b'only part of it')
+    j = journal(directory)
+    assert j.last_seq == 3
+    assert os.path.getsize(path) == good
+    assert j.segments[-1].size == good
+    write(j, 4, 4)
+    assert j.read_since(0, numbered=True) == [
+        (1, b'message 1\n'), (2, b'message 2\n'),
+        (3, b'message 3\n'), (4, b'message 4\n')]
+    j.close()
+
+def test_torn_header_is_cut_off(directory):
+    j = journal(directory)
+    write(j, 1, 1)
+    j.close()
+    path = j.segments[-1].path
+    good = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(RECORD.pack(10, 2, 0)[:5])
+    j = journal(directory)
+    assert j.last_seq == 1
+    assert os.path.getsize(path) == good
+    j.close()
+
+def test_segments_rotate_at_their_size(directory):
+    record = RECORD.size + len(b'message 1\n')
+    j = journal(directory, segment_bytes=3 * record)
+    for seq in range(1, 8):
+        write(j, seq, seq)
+    # a new segment after every third message, named after its first
+    assert [segment.first_seq for segment in j.segments] == [1, 4, 7]
+    assert segment_names(directory) == ['%020d.journal' % seq
+                                        for seq in (1, 4, 7)]
+    assert [len(j.read_since(seq)) for seq in range(8)] == [7, 6, 5, 4, 3, 2, 1, 0]
+    j.close()
+    # and read back as they were written
+    j = journal(directory, segment_bytes=3 * record)
+    assert [(s.first_seq, s.last_seq) for s in j.segments] == [(1, 3), (4, 6), (7, 7)]
+    j.close()
+
+def test_only_the_newest_segments_are_kept(directory):
+    record = RECORD.size + len(b'message 1\n')
+    j = journal(directory, segment_bytes=2 * record, max_segments=2)
+    for seq in range(1, 10):
+        write(j, seq, seq)
+    assert segment_names(directory) == ['%020d.journal' % seq for seq in (7, 9)]
+    # what was retired is gone from the reads too
+    assert j.read_since(0, numbered=True) == [
+        (7, b'message 7\n'), (8, b'message 8\n'), (9, b'message 9\n')]
+    assert any('retired' in record for record in j.logger.records)
+    j.close()
+
+def test_read_since_by_room(directory):
+    j = journal(directory)
+    write(j, 1, 2)
+    write(j, 3, 4, '#room')
+    write(j, 5, 5)
+    assert j.read_since(0, numbered=True) == [
+        (1, b'message 1\n'), (2, b'message 2\n'), (5, b'message 5\n')]
+    assert j.read_since(3, '#room', numbered=True) == [(4, b'message 4\n')]
+    assert j.read_since(0, '#other') == []
+    j.close()
+
+def test_read_since_in_pages(directory):
+    record = RECORD.size + len(b'message 1\n')
+    j = journal(directory, segment_bytes=4 * record)
+    write(j, 1, 10)
+    write(j, 11, 20)
+    pages = []
+    seq = 0
+    while True:
+        page = j.read_since(seq, numbered=True, limit=3)
+        if not page:
+            break
+        pages.append([n for n, frame in page])
+        seq = page[-1][0]
+    # pages go on across the segments
+    assert pages == [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12],
+                     [13, 14, 15], [16, 17, 18], [19, 20]]
+    # not much more than max_bytes: the message which goes over it is in
+    size = len(b'message 1\n')
+    assert len(j.read_since(0, max_bytes=2 * size)) == 2
+    assert len(j.read_since(0, max_bytes=2 * size + 1)) == 3
+    assert len(j.read_since(0, limit=5, max_bytes=1 << 20)) == 5
+    j.close()
+
+# --------------------------------------------------
+# write errors
+# --------------------------------------------------
+
+def test_failed_write_is_cut_off_and_disables_the_journal(directory, monkeypatch):
+    j = journal(directory)
+    write(j, 1, 2)
+    path = j.segments[-1].path
+    good = os.path.getsize(path)
+    real_write = os.write
+    def write_then_fail(fd, data):
+        # half of the first record, then the disk is full
+        if not calls:
+            calls.append(fd)
+            return real_write(fd, data[:len(data) // 2])
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    calls = []
+    monkeypatch.setattr(journal_module.os, 'write', write_then_fail)
+    write(j, 3, 4)
+    assert j.disabled
+    assert j.errors == 1
+    assert os.path.getsize(path) == good
+    assert 'disabled' in j.logger.records[-1]
+    # messages go on without it, and what was written can still be read
+    write(j, 5, 5)
+    assert j.pending == []
+    assert j.read_since(0) == [b'message 1\n', b'message 2\n']
+    j.close()
+    monkeypatch.undo()
+    j = journal(directory)
+    assert j.last_seq == 2
+    j.close()
+
+def test_failed_fsync_disables_the_journal(directory, monkeypatch):
+    j = journal(directory, fsync_interval=0)
+    def fsync(fd):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+    monkeypatch.setattr(journal_module.os, 'fsync', fsync)
+    write(j, 1, 1)
+    assert j.disabled
+    assert j.fd is None
+    j.close()
+    metrics = Metrics()
+    metrics.journal = j
+    text = metrics.expose()
+    assert 'chatserver_journal_errors_total 1\n' in text
+    assert 'chatserver_journal_disabled 1\n' in text
@@ -0,0 +1,66 @@
+"""
+Unit tests of the asynchronous logger, writing to a file of its own.
+"""
+
+import threading
+
+import pytest
+
+from chatserver.logger import Logger, LevelsByName
+
+@pytest.fixture
+def log_file(tmp_path):
+    return str(tmp_path / 'chatserver.log')
+
+def quiet_logger(log_file, **options):
+    # a writer which only wakes up when the logger is closed
+    options.setdefault('flush_records', 1 << 20)
+    return Logger(log_file, flush_interval=60, **options)
+
+def lines(log_file):
+    with open(log_file) as f:
+        return f.read().splitlines()
+
+def test_records_are_written_on_close(log_file):
+    logger = quiet_logger(log_file, level=LevelsByName.INFO)
+    logger.info('one %d', 1)
+    logger.debug('not at this level')
+    logger.error('two\n')
+    logger.close()
+    assert lines(log_file) == ['one 1', 'two']
+
+def test_scalars_are_formatted_by_the_writer(log_file):
+    logger = quiet_logger(log_file)
+    logger.info('%s %d %r %s', 'a', 1, b'b', None)
+    assert list(logger.records) == [('%s %d %r %s', ('a', 1, b'b', None))]
+    logger.close()
+
+def test_other_arguments_are_formatted_when_logged(log_file):
+    logger = quiet_logger(log_file)
+    members = ['a']
+    logger.info('members %r of %d', members, 1)
+    members.append('b')
+    assert list(logger.records) == [("members ['a'] of 1", ())]
+    logger.close()
+    assert lines(log_file) == ["members ['a'] of 1"]
+
+def test_overflow_drops_the_oldest_records(log_file):
+    logger = quiet_logger(log_file, max_records=2)
+    for i in range(5):
+        logger.info('record %d', i)
+    logger.close()
+    assert lines(log_file) == ['record 3', 'record 4',
+                               'logger overflow: 3 records dropped so far']
+
+def test_every_dropped_record_is_counted(log_file):
+    logger = quiet_logger(log_file, max_records=10)
+    def log():
+        for i in range(2000):
+            logger.info('record %d', i)
+    threads = [threading.Thread(target=log) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert logger.dropped + len(logger.records) == 8000
+    logger.close()
@@ -0,0 +1,74 @@
+"""
+Unit tests of the metrics and of the text format they are served in.
+"""
+
+import re
+
+from chatserver.metrics import Histogram, Metrics
+
+# a sample line of the Prometheus text format
+SAMPLE = re.compile(r'^([a-z_]+)(\{le="[^"]+"\})? (\S+)$')
+
+def parse(text):
+    # name -> value of the samples, and name -> type of the metrics
+    samples, types = {}, {}
+    helped = set()
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            helped.add(line.split()[2])
+        elif line.startswith('# TYPE '):
+            name, kind = line.split()[2:]
+            # every metric has its help line first
+            assert name in helped
+            types[name] = kind
+        elif line:
+            match = SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            samples[name + (labels or '')] = float(value)
+    return samples, types
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('h', 'A histogram.', (1, 2, 4))
+    for value in (0.5, 1, 3, 3, 10):
+        histogram.observe(value)
+    lines = []
+    histogram.expose(lines)
+    samples, types = parse('\n'.join(lines))
+    assert types == {'h': 'histogram'}
+    assert samples == {
+        'h_bucket{le="1"}': 2,
+        'h_bucket{le="2"}': 2,
+        'h_bucket{le="4"}': 4,
+        'h_bucket{le="+Inf"}': 5,
+        'h_sum': 17.5,
+        'h_count': 5,
+    }
+
+def test_expose():
+    metrics = Metrics()
+    metrics.accepted = 5
+    metrics.closed = 2
+    metrics.loop_seconds.observe(0.001)
+    text = metrics.expose()
+    assert text.endswith('\n')
+    samples, types = parse(text)
+    assert samples['chatserver_connections_accepted_total'] == 5
+    assert samples['chatserver_connections'] == 3
+    assert samples['chatserver_loop_duration_seconds_count'] == 1
+    for name, kind in types.items():
+        assert name.startswith('chatserver_')
+        # counters, and only counters, end in _total
+        assert name.endswith('_total') == (kind == 'counter')
+
+def test_respond():
+    metrics = Metrics()
+    response = metrics.respond(b'GET /metrics HTTP/1.0')
+    header, body = response.split(b'\r\n\r\n', 1)
+    assert header.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert b'Content-Length: %d\r\n' % len(body) in header
+    assert body == metrics.expose().encode('ascii')
+    head = metrics.respond(b'HEAD / HTTP/1.0')
+    assert head.startswith(b'HTTP/1.0 200 OK') and head.endswith(b'\r\n\r\n')
+    assert metrics.respond(b'GET /other HTTP/1.0').startswith(b'HTTP/1.0 404')
+    assert metrics.respond(b'POST /metrics HTTP/1.0').startswith(b'HTTP/1.0 405')
@@ -0,0 +1,234 @@
+"""
+Unit tests of the pollers and of the dirty set the event loop uses to
+only look again at the dispatchers whose interest may have changed.
+"""
+
+import socket
+
+import pytest
+
+from chatserver import poller
+from chatserver.medusa import asyncore_25 as asyncore
+from chatserver.medusa import asynchat_25 as asynchat
+
+from chatserverd import ChatServer
+from support import Helpers
+
+class CountingEpoll:
+    '''An epoll object which counts what it is asked to do.'''
+
+    def __init__(self, epoll):
+        self.epoll = epoll
+        self.calls = []
+
+    def register(self, fd, mask):
+        self.calls.append('register')
+        self.epoll.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self.calls.append('modify')
+        self.epoll.modify(fd, mask)
+
+    def unregister(self, fd):
+        self.calls.append('unregister')
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout, max_events):
+        return self.epoll.poll(timeout, max_events)
+
+    def close(self):
+        self.epoll.close()
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+def poll(p, timeout=0.1):
+    r, w = p.poll(timeout)
+    return sorted(r), sorted(w)
+
+needs_epoll = pytest.mark.skipif(not poller.implements_epoll(),
+                                 reason='no epoll on this platform')
+
+@needs_epoll
+def test_epoll_only_tells_the_kernel_about_changes(pair):
+    a, b = pair
+    p = poller.EpollPoller(Helpers())
+    epoll = p._epoll = CountingEpoll(p._epoll)
+    fd = a.fileno()
+    p.set_interest(fd, True, False)
+    p.set_interest(fd, True, False)
+    p.register_readable(fd)
+    assert epoll.calls == ['register']
+    p.set_interest(fd, True, True)
+    p.register_writable(fd)
+    assert epoll.calls == ['register', 'modify']
+    p.unregister(fd)
+    p.unregister(fd)
+    assert epoll.calls == ['register', 'modify', 'unregister']
+    assert p.interest == {}
+
+@needs_epoll
+def test_epoll_reports_what_it_is_interested_in(pair):
+    a, b = pair
+    p = poller.EpollPoller(Helpers())
+    fd = a.fileno()
+    p.set_interest(fd, True, True)
+    assert poll(p) == ([], [fd])
+    b.send(b'x')
+    assert poll(p) == ([fd], [fd])
+    p.set_interest(fd, True, False)
+    assert poll(p) == ([fd], [])
+    p.set_interest(fd, False, False)
+    assert poll(p) == ([], [])
+
+@needs_epoll
+def test_epoll_reports_hangups_as_reads(pair):
+    a, b = pair
+    p = poller.EpollPoller(Helpers())
+    p.set_interest(a.fileno(), False, False)
+    b.close()
+    assert poll(p) == ([a.fileno()], [])
+
+@needs_epoll
+def test_epoll_forgets_closed_fds(pair):
+    a, b = pair
+    p = poller.EpollPoller(Helpers())
+    fd = a.fileno()
+    p.set_interest(fd, True, False)
+    a.close()
+    # the kernel has dropped it with the socket
+    p.unregister(fd)
+    assert p.interest == {}
+
+@needs_epoll
+def test_epoll_registers_everything_again_after_daemonizing(pair):
+    a, b = pair
+    p = poller.EpollPoller(Helpers())
+    fd = a.fileno()
+    p.set_interest(fd, False, True)
+    p.before_daemonize()
+    p.after_daemonize()
+    assert poll(p) == ([], [fd])
+
+@pytest.mark.parametrize('name', sorted(poller.pollers))
+def test_set_interest(name, pair):
+    a, b = pair
+    p = poller.pollers[name](Helpers())
+    fd = a.fileno()
+    p.set_interest(fd, True, False)
+    assert poll(p) == ([], [])
+    b.send(b'x')
+    assert poll(p) == ([fd], [])
+    p.set_interest(fd, False, True)
+    assert poll(p) == ([], [fd])
+    p.set_interest(fd, True, True)
+    assert poll(p) == ([fd], [fd])
+    p.set_interest(fd, False, False)
+    assert poll(p) == ([], [])
+    # an fd it does not know about
+    p.unregister(fd)
+
+def test_select_asks_for_a_resync_after_ebadf(pair):
+    a, b = pair
+    p = poller.SelectPoller(Helpers())
+    p.set_interest(a.fileno(), True, False)
+    a.close()
+    assert poll(p) == ([], [])
+    assert p.resync
+    assert not p.readables
+
+# --------------------------------------------------
+# the dirty set
+# --------------------------------------------------
+
+class channel(asynchat.async_chat):
+
+    def collect_incoming_data(self, data):
+        pass
+
+    def found_terminator(self):
+        pass
+
+@pytest.fixture
+def dirty():
+    asyncore.dirty.clear()
+    yield asyncore.dirty
+    asyncore.dirty.clear()
+
+def test_channels_mark_themselves_dirty(pair, dirty):
+    a, b = pair
+    c = channel(a, map={})
+    fd = c._fileno
+    assert dirty == set([fd])
+    dirty.clear()
+    c.push_buffer(b'one')
+    assert dirty == set([fd])
+    dirty.clear()
+    # only going from empty to queued changes writable()
+    c.push_buffer(b'two')
+    assert dirty == set()
+    c.consume_out_buffer(3)
+    assert dirty == set()
+    c.consume_out_buffer(3)
+    assert dirty == set([fd])
+    dirty.clear()
+    c.del_channel(c._map)
+    assert dirty == set([fd])
+
+class FakePoller:
+
+    resync = False
+
+    def __init__(self):
+        self.interest = {}
+
+    def set_interest(self, fd, readable, writable):
+        self.interest[fd] = (readable, writable)
+
+    def unregister(self, fd):
+        self.interest.pop(fd, None)
+
+class FakeDispatcher:
+
+    def __init__(self, readable=True, writable=False):
+        self.interest = (readable, writable)
+
+    def readable(self):
+        return self.interest[0]
+
+    def writable(self):
+        return self.interest[1]
+
+def test_update_interest_only_looks_at_the_fds_given():
+    helpers = Helpers()
+    helpers.poller = FakePoller()
+    server = ChatServer(helpers)
+    socket_map = {3: FakeDispatcher(), 4: FakeDispatcher(True, True)}
+    server.update_interest(socket_map, [3, 4])
+    assert helpers.poller.interest == {3: (True, False), 4: (True, True)}
+    socket_map[3].interest = (False, True)
+    socket_map[4].interest = (False, False)
+    server.update_interest(socket_map, [3])
+    assert helpers.poller.interest == {3: (False, True), 4: (True, True)}
+    # a closed dispatcher is unregistered, and an fd reused by a new one
+    # registered again from scratch
+    del socket_map[3]
+    socket_map[4] = FakeDispatcher(False, True)
+    server.update_interest(socket_map, [3, 4])
+    assert helpers.poller.interest == {4: (False, True)}
+    assert server.registered == {4: socket_map[4]}
+
+def test_prune_interest_drops_what_left_the_socket_map():
+    helpers = Helpers()
+    helpers.poller = FakePoller()
+    server = ChatServer(helpers)
+    socket_map = {3: FakeDispatcher(), 4: FakeDispatcher()}
+    server.update_interest(socket_map, [3, 4])
+    del socket_map[3]
+    server.prune_interest(socket_map)
+    assert list(helpers.poller.interest) == [4]
+    assert list(server.registered) == [4]
@@ -0,0 +1,125 @@
+"""
+Unit tests of the compact protocol's varints and frames.
+"""
+
+import pytest
+
+from chatserver import protocol
+
+from support import chat_server, accept, read, queued, close_all
+
+def read_entries(buf, start, end):
+    # the (room id, message number, message) of a BATCH body
+    entries = []
+    while start < end:
+        room_id, start = protocol.read_varint(buf, start)
+        seq, start = protocol.read_varint(buf, start)
+        size, start = protocol.read_varint(buf, start)
+        entries.append((room_id, seq, bytes(buf[start:start + size])))
+        start += size
+    return entries
+
+def test_varint_round_trip():
+    for n in (0, 1, 127, 128, 300, 16383, 16384, 1 << 32, (1 << 63) - 1):
+        data = protocol.varint(n)
+        assert protocol.read_varint(bytearray(data), 0) == (n, len(data))
+
+def test_varint_sizes():
+    assert protocol.varint(0) == b'\x00'
+    assert protocol.varint(127) == b'\x7f'
+    assert protocol.varint(128) == b'\x80\x01'
+    assert protocol.varint(300) == b'\xac\x02'
+
+def test_read_varint_at_an_offset():
+    buf = bytearray(b'xx' + protocol.varint(300) + b'yy')
+    assert protocol.read_varint(buf, 2) == (300, 4)
+
+def test_truncated_varint_waits_for_more():
+    assert protocol.read_varint(bytearray(b'\xac'), 0) is None
+    assert protocol.read_varint(bytearray(), 0) is None
+
+def test_overlong_varint_is_refused():
+    with pytest.raises(ValueError):
+        protocol.read_varint(bytearray(b'\xff' * 10 + b'\x01'), 0)
+
+def test_parse_frame():
+    body = b'\x00hello'
+    buf = bytearray(protocol.frame(protocol.MESSAGE, body) + b'next')
+    kind, start, end = protocol.parse(buf, 0, 1 << 20)
+    assert kind == protocol.MESSAGE
+    assert bytes(buf[start:end]) == body
+    assert protocol.message(buf[start:end]) == (protocol.LOBBY, b'hello')
+
+def test_parse_incomplete_frame():
+    data = protocol.frame(protocol.COMMAND, b'/join #room')
+    for n in range(len(data)):
+        assert protocol.parse(bytearray(data[:n]), 0, 1 << 20) is None
+
+def test_parse_refuses_empty_and_oversized_frames():
+    with pytest.raises(ValueError):
+        protocol.parse(bytearray(b'\x00'), 0, 1 << 20)
+    data = protocol.frame(protocol.MESSAGE, b'\x00' + b'x' * 200)
+    with pytest.raises(ValueError):
+        protocol.parse(bytearray(data), 0, 100)
+
+def test_truncated_message_body():
+    with pytest.raises(ValueError):
+        protocol.message(bytearray(b'\x80'))
+
+def test_batch_of_entries():
+    entries = [protocol.entry(protocol.LOBBY, 7, b'one'),
+               protocol.entry(protocol.FIRST_ROOM, 300, b'x' * 200),
+               protocol.entry(protocol.DIRECT, None, b'three')]
+    buf = bytearray(protocol.batch(entries))
+    kind, start, end = protocol.parse(buf, 0, 1 << 20)
+    assert kind == protocol.BATCH
+    assert end == len(buf)
+    assert read_entries(buf, start, end) == [
+        (protocol.LOBBY, 7, b'one'),
+        (protocol.FIRST_ROOM, 300, b'x' * 200),
+        (protocol.DIRECT, 0, b'three')]
+
+# --------------------------------------------------
+# a channel on the compact protocol
+# --------------------------------------------------
+
+@pytest.fixture
+def compact():
+    server = chat_server(binary=True, framing='line')
+    client, channel = accept(server)
+    client.sendall(b'/protocol compact\n' +
+                   protocol.frame(protocol.MESSAGE,
+                                  protocol.varint(protocol.LOBBY) + b'hello'))
+    read(channel)
+    yield server, channel
+    close_all()
+
+def batches(channel):
+    # the entries of the BATCH frames queued on a channel
+    buf = bytearray(b''.join(bytes(chunk) for chunk in channel.ac_out_buffer))
+    frames = []
+    offset = 0
+    while offset < len(buf):
+        kind, start, offset = protocol.parse(buf, offset, 1 << 20)
+        if kind == protocol.BATCH:
+            frames.append(read_entries(buf, start, offset))
+    return frames
+
+def test_switching_to_compact(compact):
+    server, channel = compact
+    assert channel.framing == 'compact'
+    assert server.broadcaster.compact == {channel._fileno: channel}
+    # what a compact client sends goes out in the server's framing
+    assert queued()[-1].endswith(b']: hello\n')
+
+def test_a_turn_of_messages_goes_out_as_one_batch(compact):
+    server, channel = compact
+    channel.discard_buffers()
+    server.broadcaster.fanout(None, b'[a]: one\n', 1)
+    server.broadcaster.fanout(None, b'[b]: two\n', 2)
+    assert batches(channel) == []
+    server.flush_batches()
+    assert batches(channel) == [[(protocol.LOBBY, 1, b'[a]: one\n'),
+                                 (protocol.LOBBY, 2, b'[b]: two\n')]]
+    server.flush_batches()
+    assert len(batches(channel)) == 1
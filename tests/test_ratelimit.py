@@ -0,0 +1,121 @@
+"""
+Unit tests of the token buckets and of the message rate limits of chat
+channels, on a clock the tests move by hand.
+"""
+
+import pytest
+
+from chatserver import ratelimit
+from chatserver.ratelimit import TokenBucket, RateTable
+from chatserver.medusa import asyncore_25 as asyncore
+
+from support import ManualWheel, chat_server, accept, read, queued, close_all
+
+class Clock:
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'clock', clock)
+    return clock
+
+def test_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(10, burst=3)
+    assert [bucket.take() for i in range(4)] == [True, True, True, False]
+    assert bucket.wait() == pytest.approx(0.1)
+    clock.time += 0.1
+    assert bucket.take()
+    assert not bucket.take()
+    # never more than the burst, however long it was idle
+    clock.time += 60
+    assert bucket.full()
+    assert bucket.tokens == 3
+
+def test_burst_defaults_to_a_seconds_worth(clock):
+    assert TokenBucket(20).burst == 20
+    assert TokenBucket(0.5).burst == 1
+
+def test_spend_goes_into_debt(clock):
+    bucket = TokenBucket(4, burst=2)
+    assert bucket.spend() == 0
+    # the last token; the next one is a quarter of a second away
+    assert bucket.spend() == 0.25
+    assert bucket.spend(3) == 1.0
+    assert bucket.wait() == 1.0
+    clock.time += 1.0
+    assert bucket.wait() == 0
+
+def test_table_has_a_bucket_per_key(clock):
+    table = RateTable(10, burst=1)
+    assert table.spend('a') == pytest.approx(0.1)
+    assert table.spend('b') == pytest.approx(0.1)
+    assert table.wait('a') == pytest.approx(0.1)
+    assert table.wait('unknown') == 0
+    table.forget('a')
+    assert table.wait('a') == 0
+    assert len(table) == 1
+
+def test_table_expires_full_buckets(clock):
+    timers = ManualWheel(tick=1.0)
+    table = RateTable(1, burst=5, timers=timers)
+    table.spend('idle')
+    table.spend('busy', 5)
+    clock.time += 2
+    timers.advance(table.expire_interval)
+    # 'idle' has filled up again and is no different from a new bucket
+    assert list(table.buckets) == ['busy']
+    clock.time += 60
+    timers.advance(table.expire_interval)
+    assert len(table) == 0
+
+# --------------------------------------------------
+# chat channels
+# --------------------------------------------------
+
+@pytest.fixture
+def limited(clock):
+    timers = ManualWheel(tick=0.01)
+    server = chat_server(binary=True, framing='line', timers=timers,
+                         message_rate=10)
+    client, channel = accept(server)
+    queued()
+    yield timers, client, channel
+    close_all()
+
+def sent():
+    return [data.split(b': ', 1)[1] for data in queued()]
+
+def test_channel_stops_reading_over_its_rate(limited, clock):
+    timers, client, channel = limited
+    client.sendall(b''.join(b'%d\n' % i for i in range(15)))
+    read(channel)
+    # a burst of a second's worth, the rest waits
+    assert sent() == [b'%d\n' % i for i in range(10)]
+    assert channel.limited
+    assert not channel.readable()
+    assert channel._fileno in asyncore.dirty
+    # a quarter of a second later, two and a half more
+    clock.time += 0.25
+    timers.advance(0.25)
+    assert sent() == [b'10\n', b'11\n']
+    assert channel.limited
+    clock.time += 1
+    timers.advance(1)
+    assert sent() == [b'12\n', b'13\n', b'14\n']
+    assert not channel.limited
+    assert channel.readable()
+
+def test_closed_channel_gives_its_bucket_back(limited):
+    timers, client, channel = limited
+    client.sendall(b'x\n' * 20)
+    read(channel)
+    assert channel.limited
+    fd = channel._fileno
+    channel.close()
+    assert fd not in channel.server.conn_limits.buckets
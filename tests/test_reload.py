@@ -0,0 +1,109 @@
+"""
+Functional tests of reloading chatserverd: the new process takes over
+the listener, and until the old one has drained, the clients of both
+keep seeing each other's messages.
+
+    python -m pytest tests/test_reload.py
+"""
+
+import os
+import signal
+import socket
+import time
+
+import pytest
+
+from support import Server, can_connect, wait_for
+
+DRAIN_TIMEOUT = 6
+
+MODES = {
+    'asyncore': ('--engine=asyncore',),
+    'asyncio': ('--engine=asyncio',),
+    'workers': ('--engine=asyncore', '--workers=2'),
+}
+
+@pytest.fixture(params=sorted(MODES))
+def server(request, tmp_path):
+    server = Server(str(tmp_path), MODES[request.param] +
+                    ('--framing=line', '--drain-timeout=%d' % DRAIN_TIMEOUT))
+    server.start()
+    yield server
+    server.stop()
+
+def gone(pid):
+    # whether the process has exited, zombies included
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except (IOError, OSError):
+        return True
+
+def reload(server):
+    # the pid of the new chatserverd, once it has written the pidfile;
+    # the port has to take connections all along
+    old = server.pid
+    os.kill(old, signal.SIGHUP)
+    refused = []
+    def replaced():
+        if not can_connect(server.port):
+            refused.append(time.time())
+        pid = server.read_pidfile()
+        return pid if pid != old else None
+    new = wait_for(replaced, 10)
+    assert new is not None
+    assert refused == []
+    server.pid = new
+    # the old one stops accepting, with --workers a second later
+    time.sleep(1.5)
+    return old, new
+
+def send(client, data):
+    # to an old client which may have been closed by the drain meanwhile
+    try:
+        client.send(data)
+    except socket.error:
+        pass
+
+def test_old_and_new_clients_see_each_other(server):
+    olds = [server.client() for i in range(DRAIN_TIMEOUT)]
+    for client in olds:
+        client.read_quiet()
+    old, new = reload(server)
+    assert not gone(old)
+
+    young = server.client()
+    young.read_quiet()
+    young.send(b'from the new one')
+    # some of the old clients are gone already, a few a second
+    reached = [client for client in olds
+               if client.read_until(b'from the new one', 2) is not None]
+    assert reached
+    for client in reached:
+        send(client, b'from the old one')
+    assert young.read_until(b'from the old one') is not None
+
+    # drained: every old client is closed and the old process exits
+    for client in olds:
+        assert client.closed(DRAIN_TIMEOUT + 5)
+    assert wait_for(lambda: gone(old), 10)
+
+    other = server.client()
+    other.read_quiet()
+    other.send(b'still here')
+    assert young.read_until(b'still here') is not None
+
+def test_a_second_reload_after_the_first(server):
+    client = server.client()
+    client.read_quiet()
+    first, second = reload(server)
+    assert client.closed(DRAIN_TIMEOUT + 5)
+    assert wait_for(lambda: gone(first), 10)
+    # the new chatserverd hands the listener on in its turn
+    second, third = reload(server)
+    assert wait_for(lambda: gone(second), DRAIN_TIMEOUT + 10)
+    young = server.client()
+    other = server.client()
+    young.read_quiet()
+    other.send(b'third one')
+    assert young.read_until(b'third one') is not None
@@ -0,0 +1,87 @@
+"""
+Unit tests of the timer wheel, on a clock the tests move by hand.
+"""
+
+from support import NullLogger, ManualWheel
+
+def small_wheel():
+    # four slots of a second a level, so that timers cascade early on
+    return ManualWheel(tick=1.0, slot_bits=2, levels=3)
+
+def test_timer_fires_on_its_tick_and_not_before():
+    wheel = small_wheel()
+    fired = []
+    wheel.schedule(2.5, fired.append, 'a')
+    assert wheel.advance(2) == 0
+    assert fired == []
+    assert wheel.advance(1) == 1
+    assert fired == ['a']
+    assert wheel.count == 0
+
+def test_timers_on_higher_levels_cascade_down():
+    wheel = small_wheel()
+    fired = []
+    for delay in (5, 17, 40):
+        wheel.schedule(delay, fired.append, delay)
+    for second in range(1, 41):
+        wheel.advance(1)
+        # each one fires in the tick it is due, after the cascades
+        assert fired == [delay for delay in (5, 17, 40) if delay <= second]
+    assert wheel.count == 0
+
+def test_timer_past_the_end_of_the_wheel_is_put_back():
+    # three levels of four slots cover 64 ticks
+    wheel = small_wheel()
+    fired = []
+    wheel.schedule(100, fired.append, 'late')
+    wheel.advance(99)
+    assert fired == []
+    wheel.advance(1)
+    assert fired == ['late']
+
+def test_cancel_and_reset():
+    wheel = small_wheel()
+    fired = []
+    cancelled = wheel.schedule(2, fired.append, 'cancelled')
+    moved = wheel.schedule(2, fired.append, 'moved')
+    cancelled.cancel()
+    assert not cancelled.active()
+    moved.reset(6)
+    wheel.advance(5)
+    assert fired == []
+    wheel.advance(1)
+    assert fired == ['moved']
+    # reset() on a timer which has fired schedules it again
+    moved.reset(1)
+    wheel.advance(1)
+    assert fired == ['moved', 'moved']
+
+def test_next_timeout():
+    wheel = small_wheel()
+    assert wheel.next_timeout() is None
+    wheel.schedule(2.5, lambda: None)
+    assert wheel.next_timeout() == 3.0
+    wheel.time = 1.25
+    assert wheel.next_timeout() == 1.75
+
+def test_next_timeout_stops_at_the_next_cascade():
+    # a timer on level 1 may be moved to level 0 when the first level
+    # wraps, so poll() must not sleep past that
+    wheel = small_wheel()
+    wheel.schedule(10, lambda: None)
+    assert wheel.next_timeout() == 4.0
+    wheel.advance(4)
+    assert wheel.next_timeout() == 4.0
+    wheel.advance(4)
+    assert wheel.next_timeout() == 2.0
+
+def test_timer_which_raises_is_logged():
+    logger = NullLogger()
+    wheel = ManualWheel(tick=1.0, logger=logger)
+    fired = []
+    wheel.schedule(1, lambda: 1 // 0)
+    wheel.schedule(1, fired.append, 'after')
+    wheel.advance(1)
+    assert fired == ['after']
+    assert len(logger.records) == 1
+    assert 'ZeroDivisionError' in logger.records[0]